@@ -0,0 +1,93 @@
+# mpd-remote-streamer
+# Dylan Forbes
+# Computer Networks
+
+# album art we've already fetched, kept on disk so showing it again never touches the network.
+# each image is a file in one directory, named by a hash of the song's uri and its Last-Modified
+# time, so if the file changes on the server the old image just stops being used (and ages
+# out). the directory is kept under max_bytes by deleting the least recently used images; a
+# file's mtime is when it was last used, so that survives restarts
+
+
+import os, hashlib, collections
+import metrics
+
+# what cached images are named with (anything else in the directory is left alone)
+SUFFIX = ".img"
+
+class art_cache():
+    def __init__(self, path, max_bytes):
+        self.path = path
+        self.max_bytes = max_bytes
+        os.makedirs(path, exist_ok=True)
+        self.files = collections.OrderedDict() # name -> size, least recently used first
+        self.total = 0
+        found = []
+        for name in os.listdir(path):
+            full = os.path.join(path, name)
+            if name.endswith(SUFFIX + ".tmp"):
+                # left over from a write that didn't finish
+                self.remove(full)
+            elif name.endswith(SUFFIX):
+                try:
+                    st = os.stat(full)
+                except OSError:
+                    continue
+                found.append((st.st_mtime, name, st.st_size))
+        for mtime, name, size in sorted(found):
+            self.files[name] = size
+            self.total += size
+        self.evict()
+        self.hits = metrics.counter("art_cache_hits_total", "album art found in the cache")
+        self.misses = metrics.counter("art_cache_misses_total", "album art that had to be fetched from mpd")
+        metrics.function("gauge", "art_cache_bytes", "size of the album art cache", lambda: self.total)
+
+    def name(self, uri, mtime):
+        return hashlib.sha1((uri + "\n" + (mtime or "")).encode("UTF-8")).hexdigest() + SUFFIX
+
+    # the file holding the image for `uri` as it was at `mtime`, or None if it's not cached
+    def get(self, uri, mtime):
+        name = self.name(uri, mtime)
+        if name not in self.files:
+            self.misses.inc()
+            return None
+        full = os.path.join(self.path, name)
+        try:
+            os.utime(full)
+        except OSError:
+            # someone deleted it under us
+            self.total -= self.files.pop(name)
+            self.misses.inc()
+            return None
+        self.files.move_to_end(name)
+        self.hits.inc()
+        return full
+
+    # store an image; returns its file, or None if it's too big to keep
+    def put(self, uri, mtime, data):
+        if len(data) > self.max_bytes:
+            return None
+        name = self.name(uri, mtime)
+        full = os.path.join(self.path, name)
+        # write it under another name first, so a crash can't leave half an image behind
+        with open(full + ".tmp", "wb") as f:
+            f.write(data)
+        os.replace(full + ".tmp", full)
+        if name in self.files:
+            self.total -= self.files.pop(name)
+        self.files[name] = len(data)
+        self.total += len(data)
+        self.evict()
+        return full
+
+    def evict(self):
+        while self.total > self.max_bytes and self.files:
+            name, size = self.files.popitem(last=False)
+            self.total -= size
+            self.remove(os.path.join(self.path, name))
+
+    def remove(self, full):
+        try:
+            os.remove(full)
+        except OSError:
+            pass
@@ -0,0 +1,214 @@
+# mpd-remote-streamer
+# Dylan Forbes
+# Computer Networks
+
+# non-interactive mode, for scripts. runs commands from -c arguments or a file (-f, or -f - for
+# stdin), without starting mpv or the stream:
+#     python3 mpdrs.py <server_ip> <mpd_port> -c clear -c 'findadd artist "Some Band"' -c play
+#     python3 mpdrs.py <server_ip> <mpd_port> --json -f queue.txt
+#     some_script | python3 mpdrs.py <server_ip> <mpd_port> -f -
+# a line can be any command in mpd's protocol, which is passed on as it is, or one of mpdrs's
+# own that work without the player: prev, resume, search and enqueue (stats is mpd's own).
+# rewind, live, art and help need the prompt, so they fail. the commands that have been read
+# so far are sent together in command lists, so a whole script costs a round trip per
+# MAX_LIST_LENGTH commands (or mpd_client.BULK_LIST_BYTES) rather than one per command. it
+# stops at the first command that fails. with --json, each command's result is printed as one
+# line of json
+
+
+import sys, os, json
+import mpd_client, mpd_parser, enqueue, log, engine
+
+# exit codes
+EXIT_OK = 0
+EXIT_FAILED = 1 # mpd refused a command
+EXIT_USAGE = 2
+EXIT_CONNECTION = 3 # couldn't connect to mpd, or lost the connection
+
+# the most commands to send in one command list
+MAX_LIST_LENGTH = 256
+READ_SIZE = 65536
+
+# mpdrs's commands whose names (or arguments) aren't the same as mpd's
+COMMANDS = {"prev": "previous", "pause": "pause 1", "resume": "pause 0"}
+# mpdrs's commands that only work at its prompt
+PROMPT_COMMANDS = ("rewind", "live", "art", "help")
+# responses that start with one of these keys are lists of entries, rather than one set of values
+ENTRY_KEYS = ("file", "directory", "playlist")
+# tags a song can have more than one of, which are always lists in an entry
+MULTIPLE_TAGS = ("Artist", "ArtistSort", "AlbumArtist", "AlbumArtistSort", "Genre", "Composer",
+                 "ComposerSort", "Performer", "Conductor", "Ensemble", "Comment")
+
+# the mpd command for one line of a script, or None if there's nothing to send. raises
+# ValueError for mpdrs's commands that need the prompt
+def translate(line):
+    line = line.strip()
+    if not line or line.startswith("#"):
+        return None
+    if line.split(" ", 1)[0] in PROMPT_COMMANDS:
+        raise ValueError("only works at mpdrs's prompt")
+    if line in COMMANDS:
+        return COMMANDS[line]
+    args = line.split(" ", 2)
+    if args[0] == "search" and len(args) == 3 and not args[2].startswith('"'):
+        # mpdrs's search takes the rest of the line as the words to look for; mpd wants them quoted
+        return 'search %s "%s"' % (args[1], args[2].replace("\\", "\\\\").replace('"', '\\"'))
+    return line
+
+# the lines of `fd`, a list of them at a time: whatever has arrived in one read, so a script
+# piped in starts running without waiting for the end of it
+def read_batches(fd):
+    pending = b''
+    while True:
+        chunk = os.read(fd, READ_SIZE)
+        if not chunk:
+            if pending:
+                yield [pending.decode("UTF-8", "replace")]
+            return
+        lines = (pending + chunk).split(b'\n')
+        pending = lines.pop()
+        if lines:
+            yield [line.decode("UTF-8", "replace") for line in lines]
+
+# a response as something json can hold: a list of entries for songs and the like, otherwise
+# a dict (with a list for keys mpd repeats, like "changed")
+def to_json(pairs):
+    pairs = [(key, len(value) if key == "binary" else value) for key, value in pairs]
+    if pairs and pairs[0][0] in ENTRY_KEYS:
+        return list(mpd_parser.records(pairs, ENTRY_KEYS, MULTIPLE_TAGS))
+    result = {}
+    for key, value in pairs:
+        if key in result:
+            if not isinstance(result[key], list):
+                result[key] = [result[key]]
+            result[key].append(value)
+        else:
+            result[key] = value
+    return result
+
+class batch():
+    def __init__(self, client, json_output=False, out=sys.stdout, err=sys.stderr):
+        self.client = client
+        self.json_output = json_output
+        self.out = out
+        self.err = err
+        self.lineno = 0 # of the last line read, for error messages
+        self.quitting = False # if the script said "quit"
+
+    # runs the commands in `lines`, in as few command lists as it can. returns an exit code
+    def run(self, lines):
+        cmds = []
+        for line in lines:
+            self.lineno += 1
+            line = line.strip()
+            if line == "quit":
+                self.quitting = True
+                break
+            if line[:8] == "enqueue ":
+                # the commands before it go first, then its playlist, in lists of its own
+                code = self.send(cmds)
+                cmds = []
+                if code != EXIT_OK:
+                    return code
+                code = self.enqueue(self.lineno, line)
+                if code != EXIT_OK:
+                    return code
+                continue
+            try:
+                cmd = translate(line)
+            except ValueError as e:
+                code = self.send(cmds)
+                if code == EXIT_OK:
+                    self.error(self.lineno, line, str(e))
+                    code = EXIT_USAGE
+                return code
+            if cmd != None:
+                cmds.append((self.lineno, line, cmd))
+        return self.send(cmds)
+
+    # sends `cmds` ((line number, line, command) for each) in command lists, and prints what
+    # they return. returns an exit code
+    def send(self, cmds):
+        start = 0
+        while start < len(cmds):
+            end = mpd_client.list_end([cmd for lineno, line, cmd in cmds], start, MAX_LIST_LENGTH)
+            chunk = cmds[start:end]
+            start = end
+            results = self.client.send_cmd_list([cmd for lineno, line, cmd in chunk])
+            if results == None:
+                self.error(chunk[0][0], chunk[0][1], "lost the connection to mpd")
+                return EXIT_CONNECTION
+            for (lineno, line, cmd), (code, pairs) in zip(chunk, results):
+                if code != "OK":
+                    self.error(lineno, line, code)
+                    return EXIT_FAILED
+                self.output(lineno, line, pairs)
+        return EXIT_OK
+
+    # "enqueue <file>": adds every song in it, with the same command lists as the prompt's
+    # enqueue (see enqueue.py). the songs mpd doesn't have are reported by line, and fail the
+    # command once the rest have been added
+    def enqueue(self, lineno, line):
+        path = line[8:].strip()
+        try:
+            cmds = enqueue.read_list(path)
+        except OSError as e:
+            self.error(lineno, line, "couldn't read %s: %s" % (path, e.strerror))
+            return EXIT_FAILED
+        added, failures = enqueue.load(self.client, cmds)
+        if not failures:
+            self.output(lineno, line, [("added", str(added))])
+            return EXIT_OK
+        if any(error == "lost the connection to mpd" for failed, song, error in failures):
+            code = EXIT_CONNECTION
+        else:
+            code = EXIT_FAILED
+        for failed, song, error in failures:
+            self.err.write("mpdrs: %s:%d: %s: %s\n" % (path, failed, song, error))
+        self.error(lineno, line, "added %d of %d" % (added, len(cmds)))
+        return code
+
+    def output(self, lineno, line, pairs):
+        if self.json_output:
+            self.out.write(json.dumps({"line": lineno, "command": line, "ok": True, "result": to_json(pairs)}) + "\n")
+        elif pairs and pairs[0][0] == "file":
+            for item in mpd_parser.records(pairs, ENTRY_KEYS, MULTIPLE_TAGS):
+                self.out.write("%s\t\t%s\t\t%s\n" % (", ".join(item.get("Artist", ["[no artist]"])), item.get("Album", "[no album]"), item.get("Title", item["file"])))
+        else:
+            for key, value in pairs:
+                self.out.write("%s: %s\n" % (key, len(value) if key == "binary" else value))
+
+    def error(self, lineno, line, message):
+        if self.json_output:
+            self.out.write(json.dumps({"line": lineno, "command": line, "ok": False, "error": message}) + "\n")
+        self.err.write("mpdrs: line %d: %s: %s\n" % (lineno, line, message))
+
+# runs `commands` (from -c), then the file at `path` ("-" for stdin). returns an exit code
+def main(ip, port, commands, path, json_output):
+    log.set_all(-1) # stdout is for the results
+    client = engine.blocking(mpd_client.mpd_client(ip, port))
+    try:
+        client.connect_cmd_conn()
+    except OSError as e:
+        sys.stderr.write("mpdrs: couldn't connect to mpd at %s:%d: %s\n" % (ip, port, e))
+        return EXIT_CONNECTION
+    runner = batch(client, json_output)
+    code = runner.run(commands)
+    if code == EXIT_OK and path != None and not runner.quitting:
+        try:
+            fd = sys.stdin.fileno() if path == "-" else os.open(path, os.O_RDONLY)
+        except OSError as e:
+            sys.stderr.write("mpdrs: %s\n" % e)
+            fd = None
+            code = EXIT_USAGE
+        if fd != None:
+            for lines in read_batches(fd):
+                code = runner.run(lines)
+                if code != EXIT_OK or runner.quitting:
+                    break
+                runner.out.flush()
+            if path != "-":
+                os.close(fd)
+    runner.out.flush()
+    client.quit()
+    return code
@@ -0,0 +1,943 @@
+# mpd-remote-streamer
+# Dylan Forbes
+# Computer Networks
+
+# benchmarks for the hot paths. run with:
+#     python3 bench.py [--json] [name ...] [trace.csv ...]
+# with no names every benchmark is run. trace files (recorded with STREAMER_TRACE_PATH in
+# mpdrs.py) are replayed by the jitter benchmark, along with the synthetic ones. the ones that
+# need an mpd server use the fake one in fake_server.py. with --json, the results are printed
+# to stdout as one json object (and everything else goes to stderr), for keeping track of them
+
+
+import sys, os, io, socket, select, selectors, threading, multiprocessing, queue, time, random, json, platform, tempfile, asyncio
+from ring_buffer import ring_buffer
+from playlist_cache import playlist_cache
+from jitter_buffer import jitter_buffer
+import http_client, mpd_client, mpd_parser, mpd_status, fake_server, log, relay, batch, enqueue, supervisor, mpdrs, engine
+
+STREAM_MB = 64
+PLAYLIST_LENGTH = 10000
+# what mpd's http server sends while paused: 128 kbps, in small packets
+PAUSE_SECONDS = 3
+PAUSE_RATE = 16000
+PAUSE_PACKET = 1024
+# for the benchmarks against the fake server
+PING_COUNT = 2000
+STATUS_COUNT = 500
+STATUS_QUEUE_LENGTH = 1000
+STATUS_RTT = 0.005 # a typical lan
+LIBRARY_SIZE = 100000
+THROUGHPUT_SECONDS = 3
+TTFA_COUNT = 10
+TTFA_PLAY_DELAY = 0.05 # how long the fake mpd takes to start playing
+DISPLAY_COUNT = 200
+# what the command-to-display latency has to stay under (test_display.py checks it too)
+DISPLAY_LATENCY_BOUND = 0.05
+LOG_CALLS = 1000000
+RELAY_LISTENERS = [0, 1, 10, 50, 200]
+RELAY_BITRATE = 1024 # kbps; higher than any real stream, to make the per-listener cost show
+RELAY_SECONDS = 3
+BATCH_COMMANDS = 1000
+REFRESH_COUNT = 100000
+ART_CHUNK_SIZES = [8192, 65536, 262144, 1048576]
+ART_COUNT = 5
+ENQUEUE_TRACKS = 5000
+ENQUEUE_RTT = 0.05 # a typical wan
+ENQUEUE_SAMPLE = 100 # adding one at a time is too slow to do all of them
+RECONNECT_OUTAGE = 2 # seconds the fake servers are gone for
+LOOP_CLIENTS = [1, 10, 100]
+LOOP_PINGS = 50 # per client
+
+json_output = False
+results = {} # benchmark -> {metric: value}, for --json
+
+# human-readable results go to stdout, unless it's reserved for json
+def say(line):
+    print(line, file=sys.stderr if json_output else sys.stdout, flush=True)
+
+def record(benchmark, metric, value):
+    results.setdefault(benchmark, {})[metric] = round(value, 6) if isinstance(value, float) else value
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+# runs fn() `count` times, returns the times it took in seconds
+def timings(fn, count):
+    times = []
+    for i in range(count):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    return times
+
+def report_timings(benchmark, name, times):
+    record(benchmark, name + "_p50_ms", percentile(times, 50) * 1000)
+    record(benchmark, name + "_p99_ms", percentile(times, 99) * 1000)
+    say("%s %-28s p50 %8.3f ms  p99 %8.3f ms" % (benchmark, name, percentile(times, 50) * 1000, percentile(times, 99) * 1000))
+
+def report_time(benchmark, name, seconds):
+    record(benchmark, name + "_ms", seconds * 1000)
+    say("%s %-28s %10.2f ms" % (benchmark, name, seconds * 1000))
+
+# cpu seconds the process `pid` has used, or None if we can't tell (/proc is linux's)
+def process_cpu(pid):
+    try:
+        with open("/proc/%d/stat" % pid) as f:
+            fields = f.read().rsplit(")", 1)[1].split()
+    except OSError:
+        return None
+    return (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+
+# an mpd_client, through the blocking front end mpdrs uses (see engine.py)
+def connect_client(mpd_port):
+    client = engine.blocking(mpd_client.mpd_client("127.0.0.1", mpd_port))
+    client.connect_to_server()
+    return client
+
+# another client of the (fake) mpd server, on a plain blocking socket, for changing things
+# behind our clients' backs
+class other_client():
+    def __init__(self, port):
+        self.sock = socket.create_connection(("127.0.0.1", port))
+        self.parser = mpd_parser.response_parser()
+        while self.parser.readline() == None:
+            self.parser.feed(self.sock.recv(4096)) # the greeting
+
+    # runs cmd, returns the response's (key, value) pairs
+    def command(self, cmd):
+        self.sock.sendall((cmd + "\n").encode("UTF-8"))
+        return list(mpd_parser.pairs(self.parser, lambda: self.sock.recv(4096)))
+
+    def close(self):
+        self.sock.close()
+
+# does nothing, whatever it's asked to: stands in for the player and the streamer in display_rig
+class stand_in():
+    def __init__(self, **attributes):
+        self.__dict__.update(attributes)
+        self.target = self # (like engine.blocking)
+
+    def __getattr__(self, name):
+        return lambda *args: None
+
+# mpdrs's own REPL loop (listen) and watcher, against a fake server started with `options`, with
+# stand-ins for mpv and the stream. command() types a command at the prompt; every time the
+# info display is drawn, `drawn` gets (time, title of the current song). what they print is
+# thrown away
+class display_rig():
+    def __init__(self, **options):
+        self.process, mpd_port, http_port = fake_server.spawn(**options)
+        self.stdout = sys.stdout
+        sys.stdout = io.StringIO()
+        self.commands = queue.Queue()
+        self.drawn = []
+        self.draws = threading.Condition()
+        app = mpdrs.mpd_remote_streamer.__new__(mpdrs.mpd_remote_streamer)
+        app.remote = connect_client(mpd_port)
+        app.streamer = stand_in(health=supervisor.supervisor("stand_in"))
+        app.player = stand_in()
+        app.capture = None
+        app.relay = None
+        app.message = None
+        app.prompting = False
+        app.progress_shown = False
+        app.output_lock = threading.Lock()
+        display_info = app.display_info
+        def draw():
+            display_info()
+            with self.draws:
+                self.drawn.append((time.perf_counter(), app.remote.status.song_title))
+                self.draws.notify_all()
+        app.display_info = draw
+        self.app = app
+        # the prompt's input() reads from self.commands instead; EOFError ends the loop
+        mpdrs.input = self.next_command
+        self.listener = threading.Thread(target=self.listen, daemon=True)
+        self.listener.start()
+        app.engine = engine.get()
+        app.watcher = app.engine.spawn(app.watch())
+        self.wait_drawn(0) # the display the prompt starts with, before any command
+
+    def listen(self):
+        try:
+            self.app.listen()
+        except EOFError:
+            pass
+
+    def next_command(self, prompt):
+        cmd = self.commands.get()
+        if cmd == None:
+            raise EOFError
+        return cmd
+
+    # returns the time it was typed
+    def command(self, cmd):
+        start = time.perf_counter()
+        self.commands.put(cmd)
+        return start
+
+    # waits for the display to be drawn after `since`. returns (when, the title it showed), or
+    # None if it isn't within `timeout`
+    def wait_drawn(self, since, timeout=5):
+        def found():
+            return [draw for draw in self.drawn if draw[0] >= since]
+        with self.draws:
+            self.draws.wait_for(found, timeout)
+            draws = found()
+        return draws[0] if draws else None
+
+    # how many times the display has been drawn since `since`
+    def draws_since(self, since):
+        with self.draws:
+            return len([t for t, title in self.drawn if t >= since])
+
+    def close(self):
+        self.commands.put(None)
+        self.listener.join()
+        self.app.remote.quit()
+        self.app.watcher.result()
+        del mpdrs.input
+        sys.stdout = self.stdout
+        self.process.terminate()
+
+# reads the streamer's fifo on a separate thread, the way mpv would, reopening it whenever
+# the streamer closes it
+class fifo_reader():
+    def __init__(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, "fifo")
+        os.mkfifo(self.path)
+        self.received = 0
+        self.first_data = threading.Event()
+        threading.Thread(target=self.read, daemon=True).start()
+
+    def read(self):
+        while True:
+            try:
+                fd = os.open(self.path, os.O_RDONLY)
+            except FileNotFoundError:
+                return # closed
+            while True:
+                data = os.read(fd, 1 << 20)
+                if not data:
+                    break
+                self.received += len(data)
+                self.first_data.set()
+            os.close(fd)
+
+    def close(self):
+        # the reader thread (a daemon) may be blocked opening the fifo; unlinking it is enough
+        os.remove(self.path)
+        os.rmdir(self.dir)
+
+# feeds `total` bytes into one end of a socketpair from a separate thread, and drains a
+# pipe from another, so that the only work done on the calling thread is the copy itself
+class stream_rig():
+    def __init__(self, total):
+        self.total = total
+        self.send_sock, self.recv_sock = socket.socketpair()
+        self.pipe_r, self.pipe_w = os.pipe()
+        self.out = os.fdopen(self.pipe_w, "wb", buffering=0)
+        self.feeder = threading.Thread(target=self.feed)
+        self.drainer = threading.Thread(target=self.drain)
+
+    def feed(self):
+        chunk = b'\0' * 65536
+        remaining = self.total
+        while remaining > 0:
+            n = min(remaining, len(chunk))
+            self.send_sock.sendall(chunk[:n])
+            remaining -= n
+        self.send_sock.close()
+
+    def drain(self):
+        while os.read(self.pipe_r, 1 << 20):
+            pass
+
+    # runs copy(recv_sock, out) until it returns 0, returns cpu seconds used by this thread
+    def run(self, copy):
+        self.feeder.start()
+        self.drainer.start()
+        start = time.thread_time()
+        while copy(self.recv_sock, self.out):
+            pass
+        cpu = time.thread_time() - start
+        self.out.close()
+        self.recv_sock.close()
+        self.feeder.join()
+        self.drainer.join()
+        os.close(self.pipe_r)
+        return cpu
+
+def copy_legacy():
+    # what http_client.stream did originally: a fresh bytes object per recv
+    def copy(sock, out):
+        data = sock.recv(2048)
+        out.write(data)
+        return len(data)
+    return copy
+
+def copy_ring():
+    ring = ring_buffer(65536)
+    def copy(sock, out):
+        n = ring.recv_into(sock)
+        # (the way http_client.write_out writes to the fifo)
+        while ring:
+            ring.consume(out.write(ring.data_region()))
+        return n
+    return copy
+
+def copy_splice():
+    def copy(sock, out):
+        return os.splice(sock.fileno(), out.fileno(), http_client.SPLICE_CHUNK_SIZE)
+    return copy
+
+def bench_stream():
+    modes = [("legacy", copy_legacy), ("ring", copy_ring)]
+    if http_client.splice_available():
+        modes.append(("splice", copy_splice))
+    for name, make_copy in modes:
+        cpu = stream_rig(STREAM_MB << 20).run(make_copy())
+        record("stream", name + "_cpu_ms_per_mb", cpu * 1000 / STREAM_MB)
+        say("stream %-8s %8.3f ms cpu per MB" % (name, cpu * 1000 / STREAM_MB))
+
+def song_entry(pos, songid):
+    return ("file: music/artist %d/album %d/%02d track %d.ogg\nLast-Modified: 2016-05-01T12:00:00Z\n"
+            "Time: 215\nduration: 215.000\nArtist: artist %d\nAlbum: album %d\nTitle: track %d\n"
+            "Track: %d\nGenre: rock\nDate: 2016\nPos: %d\nId: %d\n"
+            % (songid, songid, songid % 20, songid, songid, songid, songid, songid % 20, pos, songid)).encode("UTF-8")
+
+# feeds a canned response to a parser in socket-sized chunks
+def parse(response):
+    chunks = iter([response[i:i + 4096] for i in range(0, len(response), 4096)])
+    return mpd_parser.pairs(mpd_parser.response_parser(), lambda: next(chunks, b''))
+
+def bench_playlist():
+    # a queue of PLAYLIST_LENGTH songs, from which the first song is then removed, so that
+    # every other song moves up one position (the worst case for a delta sync)
+    full = b''.join(song_entry(pos, pos + 1) for pos in range(PLAYLIST_LENGTH)) + b'OK\n'
+    after = b''.join(song_entry(pos, pos + 2) for pos in range(PLAYLIST_LENGTH - 1)) + b'OK\n'
+    changes = b''.join(b'cpos: %d\nId: %d\n' % (pos, pos + 2) for pos in range(PLAYLIST_LENGTH - 1)) + b'OK\n'
+
+    cache = playlist_cache()
+    cache.replace(mpd_parser.records(parse(full)), 1)
+
+    start = time.perf_counter()
+    playlist_cache().replace(mpd_parser.records(parse(after)), 2)
+    full_time = time.perf_counter() - start
+    record("playlist", "full_fetch_ms", full_time * 1000)
+    say("playlist full fetch  %8d bytes %8.2f ms" % (len(after), full_time * 1000))
+
+    start = time.perf_counter()
+    missing = cache.apply_changes(parse(changes), 2, PLAYLIST_LENGTH - 1)
+    delta_time = time.perf_counter() - start
+    assert missing == []
+    record("playlist", "delta_sync_ms", delta_time * 1000)
+    say("playlist delta sync  %8d bytes %8.2f ms" % (len(changes), delta_time * 1000))
+
+# sends PAUSE_RATE bytes per second into sock for PAUSE_SECONDS, then closes it
+def pause_feeder(sock):
+    packet = b'\0' * PAUSE_PACKET
+    start = time.monotonic()
+    sent = 0
+    while time.monotonic() - start < PAUSE_SECONDS:
+        sock.sendall(packet)
+        sent += len(packet)
+        time.sleep(max(0, start + sent / PAUSE_RATE - time.monotonic()))
+    sock.close()
+
+# runs drain(sock) on what pause_feeder sends until it returns 0. returns
+# (cpu seconds used by this thread, number of wakeups, bytes received)
+def run_pause(drain, setup=None):
+    send_sock, recv_sock = socket.socketpair()
+    if setup:
+        setup(recv_sock)
+    feeder = threading.Thread(target=pause_feeder, args=(send_sock,))
+    feeder.start()
+    wakeups = 0
+    received = 0
+    start = time.thread_time()
+    while True:
+        select.select([recv_sock], [], [])
+        wakeups += 1
+        n = drain(recv_sock)
+        if n == 0:
+            break
+        received += n
+    cpu = time.thread_time() - start
+    feeder.join()
+    recv_sock.close()
+    return cpu, wakeups, received
+
+# time to connect to an http server and get the first bytes of audio back: what resuming
+# costs if we disconnected while paused (on localhost, so a lower bound)
+def reconnect_cost():
+    server = socket.socket()
+    server.bind(("127.0.0.1", 0))
+    server.listen()
+    def serve():
+        conn, _ = server.accept()
+        conn.recv(4096)
+        conn.sendall(b'HTTP/1.1 200 OK\r\n\r\n' + b'\0' * PAUSE_PACKET)
+        conn.close()
+    thread = threading.Thread(target=serve)
+    thread.start()
+    start = time.perf_counter()
+    sock = socket.create_connection(server.getsockname())
+    sock.sendall(b'GET /mpd.ogg HTTP/1.1\r\n\r\n')
+    sock.recv(4096)
+    cost = time.perf_counter() - start
+    sock.close()
+    thread.join()
+    server.close()
+    return cost
+
+def bench_pause():
+    # what http_client.stream did originally: a 2 KB recv whenever anything arrives
+    legacy = run_pause(lambda sock: len(sock.recv(2048)))
+    # what it does now if it keeps the connection: wait for a lot to arrive, then take it all at once
+    scratch = bytearray(1 << 20)
+    def lowat(sock):
+        if hasattr(socket, "SO_RCVLOWAT"):
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVLOWAT, http_client.PAUSE_DRAIN_LOWAT)
+    drain = run_pause(lambda sock: sock.recv_into(scratch), lowat)
+    for name, (cpu, wakeups, received) in [("legacy", legacy), ("drain", drain)]:
+        record("pause", name + "_cpu_ms_per_s", cpu * 1000 / PAUSE_SECONDS)
+        record("pause", name + "_wakeups_per_s", wakeups / PAUSE_SECONDS)
+        record("pause", name + "_bytes_per_s", received / PAUSE_SECONDS)
+        say("pause %-10s %7.3f ms cpu/s  %6.1f wakeups/s  %7.1f KB/s received"
+              % (name, cpu * 1000 / PAUSE_SECONDS, wakeups / PAUSE_SECONDS, received / 1024 / PAUSE_SECONDS))
+    cost = reconnect_cost()
+    record("pause", "disconnect_resume_ms", cost * 1000)
+    say("pause %-10s %7.3f ms cpu/s  %6.1f wakeups/s  %7.1f KB/s received  (resume costs a reconnect: %.2f ms here)"
+          % ("disconnect", 0, 0, 0, cost * 1000))
+
+# synthetic arrival traces: lists of (time, bytes) for a 128 kbps stream in 1000-byte packets
+def steady_trace(seconds, jitter, seed):
+    rng = random.Random(seed)
+    return [(i / 16 + rng.uniform(0, jitter), 1000) for i in range(seconds * 16)]
+
+def stalling_trace(seconds, seed):
+    # every so often the link stalls, and then everything that was held up arrives at once
+    rng = random.Random(seed)
+    trace = []
+    stall_until = 0
+    for i in range(seconds * 16):
+        t = i / 16
+        if t > stall_until and rng.random() < 0.01:
+            stall_until = t + rng.uniform(0.3, 2)
+        trace.append((max(t, stall_until), 1000))
+    return trace
+
+def load_trace(path):
+    trace = []
+    with open(path) as f:
+        for line in f:
+            t, nbytes = line.split(",")
+            trace.append((float(t), int(nbytes)))
+    start = trace[0][0] if trace else 0
+    return [(t - start, nbytes) for t, nbytes in trace]
+
+# plays back a trace against a player consuming at the stream's rate, which stops whenever
+# it runs out, until `target()` bytes are buffered again. on_underrun gets the time and the gap
+# in the data that caused it. returns
+# (ms until playback started, number of underruns, seconds spent stalled after starting)
+def replay(trace, target, on_underrun=None, on_arrival=None, rate=16000):
+    buffered = 0
+    playing = False
+    started = None
+    underruns = 0
+    stalled = 0
+    stall_start = None
+    last = 0
+    for t, nbytes in sorted(trace):
+        if playing:
+            buffered -= rate * (t - last)
+            if buffered < 0:
+                # ran dry partway between the last arrival and this one
+                stall_start = t + buffered / rate
+                buffered = 0
+                playing = False
+                underruns += 1
+                if on_underrun:
+                    on_underrun(t, t - last)
+        last = t
+        buffered += nbytes
+        if on_arrival:
+            on_arrival(nbytes, t)
+        if not playing and buffered >= target():
+            playing = True
+            if started == None:
+                started = t
+            else:
+                stalled += t - stall_start
+    return (started * 1000 if started != None else None, underruns, stalled)
+
+def bench_jitter(trace_files=[]):
+    traces = [("lan", steady_trace(300, 0.005, 1)),
+              ("wifi", steady_trace(300, 0.3, 2)),
+              ("flaky", stalling_trace(300, 3))]
+    traces += [(os.path.basename(path), load_trace(path)) for path in trace_files]
+    for name, trace in traces:
+        # the old fixed-size buffer
+        start, underruns, stalled = replay(trace, lambda: 7000)
+        record("jitter", name + "_fixed_underruns", underruns)
+        record("jitter", name + "_fixed_stalled_s", stalled)
+        say("jitter %-10s fixed 7000 B   start %7.1f ms  underruns %3d  stalled %6.2f s" % (name, start, underruns, stalled))
+        jitter = jitter_buffer(http_client.MIN_BUFFER_MS, http_client.MIN_BUFFER_MS, http_client.MAX_BUFFER_MS)
+        start, underruns, stalled = replay(trace, jitter.target_bytes, jitter.underrun, jitter.record_arrival)
+        record("jitter", name + "_adaptive_underruns", underruns)
+        record("jitter", name + "_adaptive_stalled_s", stalled)
+        say("jitter %-10s adaptive       start %7.1f ms  underruns %3d  stalled %6.2f s  (final target %d ms)" % (name, start, underruns, stalled, jitter.target_ms))
+
+# round trip of the simplest command, over a connection with no added latency: the client's
+# own overhead
+def bench_rtt():
+    process, mpd_port, http_port = fake_server.spawn()
+    client = connect_client(mpd_port)
+    report_timings("rtt", "ping", timings(lambda: client.send_cmd("ping"), PING_COUNT))
+    client.quit()
+    process.terminate()
+
+# fetching the status (which also keeps the queue cache in sync), with no added latency and
+# over a lan, with the queue unchanged, and after another client removes a song from it
+def bench_status():
+    for name, rtt in [("local", 0), ("lan", STATUS_RTT)]:
+        process, mpd_port, http_port = fake_server.spawn(queue=STATUS_QUEUE_LENGTH, rtt=rtt)
+        client = connect_client(mpd_port)
+        client.retrieve_status()
+        count = STATUS_COUNT if rtt == 0 else STATUS_COUNT // 10
+        report_timings("status", name + "_unchanged", timings(client.retrieve_status, count))
+        other = other_client(mpd_port)
+        times = []
+        for i in range(count):
+            other.command("delete 0")
+            start = time.perf_counter()
+            client.retrieve_status()
+            times.append(time.perf_counter() - start)
+        report_timings("status", name + "_after_delete", times)
+        other.close()
+        client.quit()
+        process.terminate()
+
+# a LIBRARY_SIZE-song library, all of which is in the queue
+def bench_library():
+    process, mpd_port, http_port = fake_server.spawn(library=LIBRARY_SIZE, queue=LIBRARY_SIZE)
+    client = connect_client(mpd_port)
+    start = time.perf_counter()
+    client.retrieve_status()
+    report_time("library", "first_status_full_queue", time.perf_counter() - start)
+    report_time("library", "playlistinfo_cached", min(timings(client.playlistinfo, 5)))
+    find = 'find Artist "artist 42"'
+    report_time("library", "find_server", min(timings(lambda: client.find(find), 5)))
+    client.enable_library_index()
+    start = time.perf_counter()
+    client.sync_library()
+    report_time("library", "index_sync", time.perf_counter() - start)
+    report_time("library", "find_index", min(timings(lambda: client.find(find), 5)))
+    report_time("library", "search_index", min(timings(lambda: client.search(None, "track 4242"), 5)))
+    # mpd's database changes: the index is synced again in the background, and until then find
+    # is answered by the server
+    client.send_cmd("update")
+    client.wait_for_change(["database"])
+    start = time.perf_counter()
+    server_start, own_start = process_cpu(process.pid), time.process_time()
+    client.find(find)
+    report_time("library", "find_during_resync", time.perf_counter() - start)
+    # where that time goes: the fake server builds the whole listallinfo response while it's
+    # answering the find (as mpd does, on its one main thread), so most of it is the server's
+    if server_start != None:
+        report_time("library", "find_during_resync_server_cpu", process_cpu(process.pid) - server_start)
+        report_time("library", "find_during_resync_own_cpu", time.process_time() - own_start)
+    client.wait_for_library()
+    report_time("library", "index_resync", time.perf_counter() - start)
+    client.quit()
+    process.terminate()
+
+# starts playing on the fake servers, with an http_client feeding a fifo_reader.
+# returns (process, client, streamer, reader)
+def start_streaming(use_splice, **options):
+    process, mpd_port, http_port = fake_server.spawn(http=True, queue=10, **options)
+    client = connect_client(mpd_port)
+    reader = fifo_reader()
+    streamer = engine.blocking(http_client.http_client("127.0.0.1", http_port, reader.path, http_client.MIN_BUFFER_MS, use_splice))
+    return process, client, streamer, reader
+
+def stop_streaming(process, client, streamer, reader):
+    client.stop()
+    streamer.quit()
+    client.quit()
+    reader.close()
+    process.terminate()
+
+# how fast the streamer can move audio from an http server that sends it as fast as it can
+def bench_throughput():
+    modes = [("copy", False)]
+    if http_client.splice_available():
+        modes.append(("splice", True))
+    for name, use_splice in modes:
+        process, client, streamer, reader = start_streaming(use_splice, bitrate=None)
+        client.play()
+        streamer.play()
+        reader.first_data.wait()
+        start_bytes = reader.received
+        start = time.perf_counter()
+        time.sleep(THROUGHPUT_SECONDS)
+        rate = (reader.received - start_bytes) / (time.perf_counter() - start)
+        record("throughput", name + "_mb_per_s", rate / (1 << 20))
+        say("throughput %-8s %8.1f MB/s" % (name, rate / (1 << 20)))
+        stop_streaming(process, client, streamer, reader)
+
+# from "play" to the player getting its first audio (what you hear), when mpd takes
+# TTFA_PLAY_DELAY to start playing, from a cold start with the streamer's starting prebuffer. the
+# same sequence as mpdrs.play. also the time to the first bytes arriving from mpd
+# (time_to_first_audio), which is before the prebuffer's filled
+def bench_ttfa():
+    process, client, streamer, reader = start_streaming(False, play_delay=TTFA_PLAY_DELAY)
+    first_audio = []
+    audible = []
+    for i in range(TTFA_COUNT):
+        reader.first_data.clear()
+        start = time.perf_counter()
+        streamer.start_play()
+        client.play()
+        streamer.wait_ready()
+        reader.first_data.wait()
+        audible.append(time.perf_counter() - start)
+        first_audio.append(streamer.time_to_first_audio)
+        client.stop()
+        streamer.stop()
+    report_timings("ttfa", "audible", audible)
+    report_timings("ttfa", "first_bytes", first_audio)
+    stop_streaming(process, client, streamer, reader)
+
+# from typing "next" at mpdrs's prompt to the info display showing the new song, and from
+# another client's "next" to mpdrs's watcher redrawing it, both through the real REPL loop and
+# watcher (see display_rig)
+def bench_display():
+    rig = display_rig(queue=DISPLAY_COUNT * 2 + 2)
+    rig.wait_drawn(rig.command("play"))
+    other = other_client(rig.app.remote.port)
+    own = []
+    others = []
+    for i in range(DISPLAY_COUNT):
+        start = rig.command("next")
+        own.append(rig.wait_drawn(start)[0] - start)
+        start = time.perf_counter()
+        other.command("next")
+        others.append(rig.wait_drawn(start)[0] - start)
+    other.close()
+    rig.close()
+    report_timings("display", "own_command", own)
+    report_timings("display", "other_client", others)
+    worst = max(own + others)
+    record("display", "within_bound", worst <= DISPLAY_LATENCY_BOUND)
+    say("display %-28s %s (worst %.3f ms, bound %.0f ms)" % ("within_bound", worst <= DISPLAY_LATENCY_BOUND, worst * 1000, DISPLAY_LATENCY_BOUND * 1000))
+
+# in a child process: `count` listeners reading from the relay as fast as they can, plus one
+# that never reads at all. sends "ready" once they're all connected, then the bytes each of the
+# readers received in the next `seconds`
+def relay_listeners(port, count, seconds, pipe):
+    selector = selectors.DefaultSelector()
+    socks = []
+    for i in range(count):
+        sock = socket.create_connection(("127.0.0.1", port))
+        sock.sendall(b"GET / HTTP/1.1\r\n\r\n")
+        sock.setblocking(False)
+        selector.register(sock, selectors.EVENT_READ, i)
+        socks.append(sock)
+    stalled = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    stalled.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4096)
+    stalled.connect(("127.0.0.1", port))
+    stalled.sendall(b"GET / HTTP/1.1\r\n\r\n")
+    pipe.send("ready")
+    received = [0] * count
+    scratch = bytearray(1 << 16)
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        for key, events in selector.select(max(0, deadline - time.monotonic())):
+            received[key.data] += key.fileobj.recv_into(scratch)
+    pipe.send(received)
+
+# one connection to the (fake) http server, relayed to more and more listeners: the cpu the
+# streamer and relay use between them, and the slowest listener's rate compared to the stream's
+def bench_relay():
+    for count in RELAY_LISTENERS:
+        process, client, streamer, reader = start_streaming(False, bitrate=RELAY_BITRATE)
+        server = engine.blocking(relay.relay(streamer, 0, "127.0.0.1"))
+        client.play()
+        streamer.play()
+        dropped = server.dropped_total.value
+        listeners = None
+        if count:
+            parent, child = multiprocessing.Pipe()
+            listeners = multiprocessing.Process(target=relay_listeners, args=(server.port, count, RELAY_SECONDS, child), daemon=True)
+            listeners.start()
+            parent.recv()
+        start = time.perf_counter()
+        cpu = time.process_time()
+        if count:
+            received = parent.recv()
+        else:
+            time.sleep(RELAY_SECONDS)
+            received = []
+        cpu = time.process_time() - cpu
+        elapsed = time.perf_counter() - start
+        slowest = min(received) / elapsed / (RELAY_BITRATE * 125) if received else 1
+        record("relay", "%d_cpu_ms_per_s" % count, cpu * 1000 / elapsed)
+        record("relay", "%d_slowest_fraction_of_stream" % count, slowest)
+        record("relay", "%d_dropped_bytes" % count, server.dropped_total.value - dropped)
+        say("relay %4d listeners  %7.2f ms cpu/s  slowest gets %5.1f%% of the stream  %8d bytes dropped (for the stalled one)"
+              % (count, cpu * 1000 / elapsed, slowest * 100, server.dropped_total.value - dropped))
+        if listeners:
+            listeners.terminate()
+        stop_streaming(process, client, streamer, reader)
+        server.close()
+
+# a script of BATCH_COMMANDS commands (queueing songs and checking the status) over STATUS_RTT:
+# one round trip per command, the way the interactive prompt runs them, against batch.py's
+# command lists
+def bench_batch():
+    process, mpd_port, http_port = fake_server.spawn(library=BATCH_COMMANDS, rtt=STATUS_RTT)
+    client = connect_client(mpd_port)
+    lines = []
+    for i in range(BATCH_COMMANDS // 2):
+        lines.append('add "%s"' % fake_server.make_song(i)["file"])
+        lines.append("status")
+    start = time.perf_counter()
+    for line in lines:
+        code, response = client.send_cmd(batch.translate(line))
+        assert code == "OK"
+    report_time("batch", "one_at_a_time", time.perf_counter() - start)
+    runner = batch.batch(client, out=io.StringIO())
+    start = time.perf_counter()
+    assert runner.run(lines) == batch.EXIT_OK
+    elapsed = time.perf_counter() - start
+    report_time("batch", "pipelined", elapsed)
+    record("batch", "pipelined_commands_per_s", BATCH_COMMANDS / elapsed)
+    say("batch %-30s %8.0f" % ("pipelined commands per second", BATCH_COMMANDS / elapsed))
+    client.quit()
+    process.terminate()
+
+# applying a status response in which only the elapsed time has moved (what most refreshes
+# look like while playing): rebuilding the status from scratch, as mpd_client used to, against
+# mpd_status's diff. rebuilding can't tell what changed, so every refresh meant redrawing the
+# info display; the diff also counts how many refreshes change something it shows
+def bench_refresh():
+    pairs = [("volume", "100"), ("repeat", "0"), ("random", "0"), ("single", "0"), ("consume", "0"),
+             ("playlist", "12"), ("playlistlength", "10"), ("mixrampdb", "0.000000"), ("state", "play"),
+             ("song", "3"), ("songid", "4"), ("time", "1:215"), ("elapsed", "1.500"), ("duration", "215.000"),
+             ("bitrate", "128"), ("audio", "44100:24:2"), ("nextsong", "4"), ("nextsongid", "5")]
+    song = fake_server.make_song(3)
+    class plain_status():
+        pass
+    def rebuild():
+        status = plain_status()
+        for name in mpd_status.mpd_status.__slots__:
+            setattr(status, name, None)
+        for key, value in pairs:
+            setattr(status, key, value)
+        status.song_title, status.song_artist, status.song_album = song["Title"], song["Artist"], song["Album"]
+    status = mpd_status.mpd_status()
+    redraws = 0
+    def diff():
+        nonlocal redraws
+        if status.update(pairs) & {"state", "playlistlength", "songid"}:
+            redraws += 1
+    for name, apply in [("rebuild", rebuild), ("diff", diff)]:
+        start = time.perf_counter()
+        for i in range(REFRESH_COUNT):
+            pairs[12] = ("elapsed", str(i / 10))
+            apply()
+        us = (time.perf_counter() - start) * 1e6 / REFRESH_COUNT
+        record("refresh", name + "_us", us)
+        say("refresh %-8s %8.2f us per status response" % (name, us))
+    record("refresh", "diff_redraws", redraws)
+    say("refresh %-8s %8d redraws in %d refreshes (rebuilding: all of them)" % ("diff", redraws, REFRESH_COUNT))
+
+# fetching a fake_server.ART_BYTES cover over a lan, for each binary chunk size: a chunk per
+# round trip (what a client that doesn't pipeline does), against mpd_client.fetch_art, which
+# requests the chunks after the first in command lists. then the same cover from the cache
+def bench_art():
+    process, mpd_port, http_port = fake_server.spawn(library=1, rtt=STATUS_RTT)
+    client = connect_client(mpd_port)
+    uri = fake_server.make_song(0)["file"]
+    def one_at_a_time(chunk_bytes):
+        client.negotiate_binary_limit(chunk_bytes)
+        data = b''
+        while True:
+            code, response = client.send_cmd("albumart %s %d" % (mpd_client.quote(uri), len(data)))
+            response = dict(response)
+            data += response["binary"]
+            if len(data) >= int(response["size"]):
+                return data
+    for chunk_bytes in ART_CHUNK_SIZES:
+        for name, fetch in [("one_at_a_time", one_at_a_time), ("pipelined", lambda n: client.fetch_art(uri, n))]:
+            assert len(fetch(chunk_bytes)) == fake_server.ART_BYTES
+            elapsed = min(timings(lambda: fetch(chunk_bytes), ART_COUNT))
+            metric = "%s_%dk" % (name, chunk_bytes // 1024)
+            report_time("art", metric, elapsed)
+            record("art", metric + "_mb_per_s", fake_server.ART_BYTES / elapsed / 1e6)
+    with tempfile.TemporaryDirectory() as path:
+        client.enable_art_cache(path, 1 << 20)
+        client.album_art(uri, "2016-05-01T12:00:00Z")
+        report_time("art", "cached", min(timings(lambda: client.album_art(uri, "2016-05-01T12:00:00Z"), ART_COUNT)))
+    client.quit()
+    process.terminate()
+
+# loading an ENQUEUE_TRACKS-song playlist (with 1% of it missing from the library) into the
+# queue over a wan: an add per round trip, like typing them at the prompt (timed for the first
+# ENQUEUE_SAMPLE songs and scaled up), against enqueue.py's command lists
+def bench_enqueue():
+    process, mpd_port, http_port = fake_server.spawn(library=ENQUEUE_TRACKS, rtt=ENQUEUE_RTT)
+    client = connect_client(mpd_port)
+    lines = [fake_server.make_song(i)["file"] if i % 100 != 99 else "missing/%d.ogg" % i for i in range(ENQUEUE_TRACKS)]
+    cmds = enqueue.commands_for(lines)
+    start = time.perf_counter()
+    for lineno, line, cmd in cmds[:ENQUEUE_SAMPLE]:
+        client.send_cmd(cmd)
+    report_time("enqueue", "one_at_a_time", (time.perf_counter() - start) * ENQUEUE_TRACKS / ENQUEUE_SAMPLE)
+    client.clear()
+    start = time.perf_counter()
+    added, failures = enqueue.load(client, cmds)
+    report_time("enqueue", "bulk", time.perf_counter() - start)
+    assert added == ENQUEUE_TRACKS * 99 // 100 and all(line.startswith("missing/") for lineno, line, error in failures)
+    record("enqueue", "bulk_failures", len(failures))
+    say("enqueue %-28s %10d" % ("bulk failures reported", len(failures)))
+    client.quit()
+    process.terminate()
+
+# the fake servers go away for RECONNECT_OUTAGE seconds while playing, then come back playing
+# (like an mpd restored from its state file). how long the clients take to notice, how long a
+# command takes meanwhile (it should fail straight away, not hold up the prompt), and how long
+# after the servers are back the connection to mpd, and then the audio, are back too
+def bench_reconnect():
+    process, client, streamer, reader = start_streaming(False)
+    engine.get().call(client.health.on_recovered, streamer.target.retry) # like mpdrs does
+    mpd_port, http_port = client.port, streamer.port
+    client.play()
+    streamer.play()
+    reader.first_data.wait()
+    start = time.perf_counter()
+    process.terminate()
+    process.join()
+    while client.health.up() or streamer.health.up():
+        time.sleep(0.001)
+    report_time("reconnect", "noticed", time.perf_counter() - start)
+    report_timings("reconnect", "command_during_outage", timings(lambda: client.send_cmd("ping"), 100))
+    time.sleep(max(0, start + RECONNECT_OUTAGE - time.perf_counter()))
+    process, mpd_port, http_port = fake_server.spawn(http=True, queue=10, mpd_port=mpd_port, http_port=http_port)
+    restarted = time.perf_counter()
+    other = other_client(mpd_port)
+    other.command("play")
+    received = reader.received
+    assert engine.blocking(client.health).wait_up(60)
+    report_time("reconnect", "mpd_back", time.perf_counter() - restarted)
+    assert engine.blocking(streamer.health).wait_up(60)
+    while reader.received == received:
+        time.sleep(0.001)
+    report_time("reconnect", "audio_back", time.perf_counter() - restarted)
+    for name, health in [("mpd", client.health), ("stream", streamer.health)]:
+        record("reconnect", name + "_attempts", health.attempts_total.value)
+        say("reconnect %-28s %10d" % (name + " reconnect attempts", health.attempts_total.value))
+    other.close()
+    stop_streaming(process, client, streamer, reader)
+
+# LOOP_CLIENTS mpd clients at once, all on the one event loop: the threads they add (each used to
+# bring an idler thread of its own), and the round trip of a ping while every one of them is
+# pinging at the same time
+def bench_loop():
+    process, mpd_port, http_port = fake_server.spawn()
+    loop = engine.get()
+    for count in LOOP_CLIENTS:
+        threads = threading.active_count()
+        clients = [mpd_client.mpd_client("127.0.0.1", mpd_port) for i in range(count)]
+        for client in clients:
+            loop.call(client.connect_to_server)
+        added = threading.active_count() - threads
+        async def pings(client):
+            times = []
+            for i in range(LOOP_PINGS):
+                start = time.perf_counter()
+                code, response = await client.send_cmd("ping")
+                assert code == "OK"
+                times.append(time.perf_counter() - start)
+            return times
+        async def everyone():
+            return await asyncio.gather(*[pings(client) for client in clients])
+        times = sum(loop.call(everyone), [])
+        record("loop", "%d_clients_threads_added" % count, added)
+        say("loop %4d clients  %4d threads added" % (count, added))
+        report_timings("loop", "%d_clients_ping" % count, times)
+        for client in clients:
+            loop.call(client.quit)
+    process.terminate()
+
+def bench_logging():
+    # a debug call that's turned off, with a chunk of stream data in the message, the way the
+    # streamer used to log: the old print_debug built the string whether or not it was printed
+    data = b"OggS" + bytes(2044)
+    debuglevel = 1
+    def print_debug(msg, level):
+        if level <= debuglevel:
+            print(msg)
+    debug = log.logger("bench", debuglevel)
+    calls = [("eager", lambda: print_debug("http_client: received " + str(len(data)) + " bytes: " + str(data), 4)),
+             ("lazy", lambda: debug(4, "http_client: received %d bytes: %s", len(data), data)),
+             # (guarded with enabled(), as for anything expensive to work out)
+             ("guarded", lambda: debug.enabled(4) and debug(4, "%s", data))]
+    for name, call in calls:
+        start = time.perf_counter()
+        for i in range(LOG_CALLS):
+            call()
+        ns = (time.perf_counter() - start) * 1e9 / LOG_CALLS
+        record("logging", name + "_ns_per_disabled_call", ns)
+        say("logging %-8s %8.1f ns per disabled call" % (name, ns))
+
+BENCHMARKS = {
+    "stream": bench_stream,
+    "playlist": bench_playlist,
+    "jitter": bench_jitter,
+    "pause": bench_pause,
+    "rtt": bench_rtt,
+    "status": bench_status,
+    "library": bench_library,
+    "throughput": bench_throughput,
+    "ttfa": bench_ttfa,
+    "display": bench_display,
+    "logging": bench_logging,
+    "relay": bench_relay,
+    "batch": bench_batch,
+    "refresh": bench_refresh,
+    "art": bench_art,
+    "enqueue": bench_enqueue,
+    "reconnect": bench_reconnect,
+    "loop": bench_loop,
+}
+
+def main():
+    global json_output
+    args = sys.argv[1:]
+    if "--json" in args:
+        json_output = True
+        args.remove("--json")
+    log.set_all(-1) # the clients' own output would get mixed up with the results
+    trace_files = [arg for arg in args if arg.endswith(".csv")]
+    names = [arg for arg in args if not arg.endswith(".csv")] or list(BENCHMARKS)
+    for name in names:
+        if name not in BENCHMARKS:
+            say("bench: unknown benchmark " + name + "; available: " + ", ".join(BENCHMARKS))
+            sys.exit(1)
+        if name == "jitter":
+            bench_jitter(trace_files)
+        else:
+            BENCHMARKS[name]()
+    if json_output:
+        json.dump({"python": platform.python_version(), "platform": platform.platform(),
+                   "time": time.strftime("%Y-%m-%dT%H:%M:%S"), "results": results}, sys.stdout, indent=1)
+        print()
+
+if __name__ == "__main__":
+    main()
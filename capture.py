@@ -0,0 +1,147 @@
+# mpd-remote-streamer
+# Dylan Forbes
+# Computer Networks
+
+# keeps the last few minutes of the stream in a fixed-size file, memory-mapped and written as a
+# ring, so it can be played again ("rewind 30") straight from disk. it's an http_client tap (like
+# relay.py): it sees everything the streamer receives. the pages in it are indexed by when they
+# arrived, and the codec headers of each track are kept, so playback can start again at any
+# page. memory use doesn't grow with how long it runs: the file is a fixed size, and the index
+# only covers what's in it
+
+
+import os, mmap, time, collections
+import demux, metrics, log
+
+# index at most one page (or mp3 frame) per this many seconds, besides the first of each track
+INDEX_SECONDS = 0.1
+
+debug = log.get("streamer")
+
+class capture():
+    def __init__(self, path, size):
+        self.path = path
+        self.size = size
+        self.file = open(path, "w+b")
+        self.file.truncate(size)
+        self.map = mmap.mmap(self.file.fileno(), size)
+        self.view = memoryview(self.map)
+        self.total = 0 # bytes ever written; the file holds the last `size` of them
+        self.demux = None
+        self.index = collections.deque() # (offset, arrival time) of pages we can start playing from
+        self.tracks = collections.deque() # [offset, header pages] for each track start in the file
+        self.in_headers = False # if we're still reading the current track's codec headers
+        self.header_pages = collections.deque() # (offset, length) of header pages not yet complete
+        metrics.function("gauge", "capture_seconds", "seconds of the stream that can be played again", self.seconds)
+
+    # tap methods, called by the streamer
+
+    def started(self, content_type):
+        self.demux = demux.for_content_type(content_type, self.total)
+        if self.demux != None:
+            self.demux.on_frame = self.frame_found
+        self.in_headers = False
+        self.header_pages.clear()
+
+    def received(self, data):
+        n = len(data)
+        # (of a chunk bigger than the file, only the last `size` bytes would be left anyway)
+        kept = data[n - self.size:] if n > self.size else data
+        pos = (self.total + n - len(kept)) % self.size
+        if pos + len(kept) <= self.size:
+            self.view[pos:pos + len(kept)] = kept
+        else:
+            first = self.size - pos
+            self.view[pos:] = kept[:first]
+            self.view[:len(kept) - first] = kept[first:]
+        self.total += n
+        if self.demux != None:
+            self.demux.feed(data)
+        while self.header_pages and sum(self.header_pages[0]) <= self.total:
+            offset, length = self.header_pages.popleft()
+            if self.tracks:
+                self.tracks[-1][1].append(self.copy(offset, length))
+        self.prune()
+
+    def ended(self):
+        self.demux = None
+
+    def frame_found(self, offset, length, track_start, codec_header):
+        now = time.monotonic()
+        if track_start:
+            self.tracks.append([offset, []])
+            self.in_headers = True
+        elif self.in_headers and not codec_header:
+            self.in_headers = False
+        if self.in_headers:
+            self.header_pages.append((offset, length))
+        elif not self.index or self.index[-1][0] < self.tracks_start() or now - self.index[-1][1] >= INDEX_SECONDS:
+            # (the first page after the headers is always indexed, so every track can be started from)
+            self.index.append((offset, now))
+
+    # offset of the current track's first page (0 for streams without tracks)
+    def tracks_start(self):
+        return self.tracks[-1][0] if self.tracks else 0
+
+    # forget whatever's been overwritten
+    def prune(self):
+        oldest = self.total - self.size
+        while self.index and self.index[0][0] < oldest:
+            self.index.popleft()
+        # keep the headers of the track the oldest page we can play is in
+        first = self.index[0][0] if self.index else self.total
+        while len(self.tracks) > 1 and self.tracks[1][0] <= first:
+            self.tracks.popleft()
+
+    def copy(self, offset, length):
+        pos = offset % self.size
+        if pos + length <= self.size:
+            return bytes(self.view[pos:pos + length])
+        return bytes(self.view[pos:]) + bytes(self.view[:length - (self.size - pos)])
+
+    # up to `length` bytes of the stream starting at `offset`, without copying (possibly less,
+    # where the file wraps around). returns None if they've been overwritten
+    def read(self, offset, length):
+        if offset < self.total - self.size:
+            return None
+        pos = offset % self.size
+        return self.view[pos:pos + min(length, self.total - offset, self.size - pos)]
+
+    # where to start playing to go back to what arrived at time `when` (from time.monotonic()):
+    # returns (offset, the codec headers to send first), or None if there's nothing to play
+    def seek(self, when):
+        if not self.index:
+            return None
+        offset = self.index[0][0]
+        for page, arrived in reversed(self.index):
+            if arrived <= when:
+                offset = page
+                break
+        return offset, self.headers_for(offset)
+
+    def headers_for(self, offset):
+        for start, pages in reversed(self.tracks):
+            if start <= offset:
+                return b''.join(pages)
+        return b''
+
+    # when the page at (or before) `offset` arrived
+    def time_at(self, offset):
+        for page, arrived in reversed(self.index):
+            if page <= offset:
+                return arrived
+        return time.monotonic()
+
+    def seconds(self):
+        if not self.index:
+            return 0
+        return time.monotonic() - self.index[0][1]
+
+    def close(self):
+        self.view.release()
+        self.map.close()
+        self.file.close()
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
@@ -0,0 +1,212 @@
+# mpd-remote-streamer
+# Dylan Forbes
+# Computer Networks
+
+
+import collections
+
+# how many page/frame starts to remember. more than enough to cover everything in the streamer's
+# ring buffer, which is all we ever need to look up
+MAX_BOUNDARIES = 8192
+
+# finds the places in the audio stream where it can be cut without corrupting it: the starts
+# of ogg pages or mp3 frames. it's fed every chunk as it's received, and only ever looks at
+# headers (bodies are skipped by their length), so it costs next to nothing per chunk.
+# offsets are absolute positions in the stream (i.e. counting every byte ever received), like
+# ring_buffer.write_total. subclasses say how to find and parse a header
+class frame_demux():
+    SEARCH, HEADER, BODY = range(3)
+
+    def __init__(self, offset=0):
+        self.boundaries = collections.deque(maxlen=MAX_BOUNDARIES) # (offset, starts a new track)
+        # if set, called with (offset, length, starts a new track, could be a codec header) for
+        # every page/frame, as soon as its header has been read
+        self.on_frame = None
+        self.resync(offset)
+
+    # start looking for a header from scratch, at stream offset `offset` (e.g. because some of
+    # the stream went by without being fed to us)
+    def resync(self, offset):
+        self.offset = offset # offset of the next byte we'll be fed
+        self.state = self.SEARCH
+        self.tail = b'' # the end of what we've searched so far, in case a sync pattern straddles chunks
+        self.header = bytearray()
+        self.header_start = None
+        self.remaining = 0
+
+    def feed(self, data):
+        self.scan(data, self.offset)
+        self.offset += len(data)
+
+    # `offset` is the stream offset of data[0]
+    def scan(self, data, offset):
+        pos = 0
+        n = len(data)
+        while pos < n:
+            if self.state == self.BODY:
+                skip = min(self.remaining, n - pos)
+                self.remaining -= skip
+                pos += skip
+                if self.remaining == 0:
+                    self.start_header(offset + pos)
+            elif self.state == self.HEADER:
+                take = min(self.header_length(self.header) - len(self.header), n - pos)
+                self.header += data[pos:pos + take]
+                pos += take
+                if len(self.header) == self.header_length(self.header):
+                    self.end_header()
+            else:
+                buf = self.tail + bytes(data[pos:])
+                buf_start = offset + pos - len(self.tail)
+                i = self.find_sync(buf)
+                if i == -1:
+                    self.tail = buf[max(0, len(buf) - self.SYNC_LENGTH + 1):]
+                    pos = n
+                    continue
+                self.start_header(buf_start + i)
+                if i < len(self.tail):
+                    # the sync pattern started in the last chunk (the tail is too short to hold a whole header)
+                    self.header += self.tail[i:]
+                else:
+                    pos += i - len(self.tail)
+                self.tail = b''
+
+    def start_header(self, offset):
+        self.state = self.HEADER
+        self.header = bytearray()
+        self.header_start = offset
+
+    def end_header(self):
+        parsed = self.parse_header(self.header)
+        if parsed == None:
+            # not a real header after all; search again from the byte after where it seemed to start
+            self.state = self.SEARCH
+            self.tail = b''
+            self.scan(bytes(self.header[1:]), self.header_start + 1)
+            return
+        body_length, track_start = parsed
+        self.boundaries.append((self.header_start, track_start))
+        if self.on_frame:
+            self.on_frame(self.header_start, len(self.header) + body_length, track_start, self.codec_header(self.header))
+        self.state = self.BODY
+        self.remaining = body_length
+        if body_length == 0:
+            self.start_header(self.header_start + len(self.header))
+
+    # earliest offset that might still be part of a header we haven't finished reading. data
+    # before it can be thrown away without losing the start of a page/frame
+    def safe_offset(self):
+        if self.state == self.HEADER:
+            return self.header_start
+        if self.state == self.SEARCH:
+            return self.offset - len(self.tail)
+        return self.offset
+
+    # first boundary at or after `start` (only ones that start a track, if track is set)
+    def next_boundary(self, start, track=False):
+        for offset, track_start in self.boundaries:
+            if offset >= start and (track_start or not track):
+                return offset
+        return None
+
+    # last boundary at or after `start` (only ones that start a track, if track is set)
+    def latest_boundary(self, start, track=False):
+        for offset, track_start in reversed(self.boundaries):
+            if offset < start:
+                break
+            if track_start or not track:
+                return offset
+        return None
+
+    # whether the page/frame with this header might hold the codec's setup headers, which a
+    # decoder needs before anything else (see relay.py)
+    def codec_header(self, header):
+        return False
+
+    # forget boundaries before `offset`
+    def prune(self, offset):
+        while self.boundaries and self.boundaries[0][0] < offset:
+            self.boundaries.popleft()
+
+# ogg pages: "OggS", version, flags, granule position (8), serial (4), sequence number (4),
+# crc (4), number of segments, then the segment table, whose entries add up to the body length.
+# a page with the beginning-of-stream flag starts a new logical stream, which is what mpd's
+# httpd output does at every track change
+class ogg_demux(frame_demux):
+    SYNC_LENGTH = 4
+    HAS_TRACKS = True
+
+    def find_sync(self, buf):
+        return buf.find(b'OggS')
+
+    def header_length(self, header):
+        if len(header) < 27:
+            return 27
+        return 27 + header[26]
+
+    def parse_header(self, header):
+        if header[:4] != b'OggS' or header[4] != 0:
+            return None
+        return sum(header[27:]), bool(header[5] & 0x02)
+
+    # the codec headers (e.g. vorbis's identification, comment and setup headers) come right
+    # after the beginning-of-stream page, on pages with no audio, so a granule position of 0
+    # (or -1, for a page where no packet ends)
+    def codec_header(self, header):
+        return header[6:14] in (bytes(8), b'\xff' * 8)
+
+# mp3 frames: an 11-bit sync word, then the version, layer, bitrate, sample rate and padding,
+# from which the frame length follows. mp3 has no track boundaries
+MP3_BITRATES = {
+    (1, 1): [0, 32, 64, 96, 128, 160, 192, 224, 256, 288, 320, 352, 384, 416, 448],
+    (1, 2): [0, 32, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320, 384],
+    (1, 3): [0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320],
+    (2, 1): [0, 32, 48, 56, 64, 80, 96, 112, 128, 144, 160, 176, 192, 224, 256],
+    (2, 2): [0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160],
+    (2, 3): [0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160],
+}
+MP3_SAMPLE_RATES = {1: [44100, 48000, 32000], 2: [22050, 24000, 16000], 2.5: [11025, 12000, 8000]}
+
+class mp3_demux(frame_demux):
+    SYNC_LENGTH = 2
+    HAS_TRACKS = False
+
+    def find_sync(self, buf):
+        i = buf.find(b'\xff')
+        while i != -1 and i + 1 < len(buf):
+            if buf[i + 1] & 0xe0 == 0xe0:
+                return i
+            i = buf.find(b'\xff', i + 1)
+        return -1
+
+    def header_length(self, header):
+        return 4
+
+    def parse_header(self, header):
+        if header[0] != 0xff or header[1] & 0xe0 != 0xe0:
+            return None
+        version = {3: 1, 2: 2, 0: 2.5}.get((header[1] >> 3) & 3)
+        layer = {3: 1, 2: 2, 1: 3}.get((header[1] >> 1) & 3)
+        bitrate_index = header[2] >> 4
+        rate_index = (header[2] >> 2) & 3
+        if version == None or layer == None or bitrate_index in (0, 15) or rate_index == 3:
+            return None
+        bitrate = MP3_BITRATES[(min(version, 2), layer)][bitrate_index] * 1000
+        sample_rate = MP3_SAMPLE_RATES[version][rate_index]
+        padding = (header[2] >> 1) & 1
+        if layer == 1:
+            length = (12 * bitrate // sample_rate + padding) * 4
+        elif layer == 3 and version != 1:
+            length = 72 * bitrate // sample_rate + padding
+        else:
+            length = 144 * bitrate // sample_rate + padding
+        return length - 4, False
+
+# picks the demuxer for a stream from its content type, or None if we can't split it (e.g.
+# flac or wave from mpd's other encoders)
+def for_content_type(content_type, offset=0):
+    if content_type in ("audio/mpeg", "audio/mp3"):
+        return mp3_demux(offset)
+    if content_type in (None, "audio/ogg", "application/ogg", "application/x-ogg"):
+        return ogg_demux(offset)
+    return None
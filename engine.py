@@ -0,0 +1,153 @@
+# mpd-remote-streamer
+# Dylan Forbes
+# Computer Networks
+
+# the one event loop everything that talks to the network runs on: both mpd connections and
+# the idler (mpd_client), the stream (http_client), the relay's listeners and mpv's ipc socket
+# (player), and the reconnect attempts (supervisor). every socket is non-blocking and
+# registered with the loop, waiting is done by timers rather than sleeping threads, and
+# stopping something is cancelling its task, so any number of connections share one thread.
+# the loop runs on a thread of its own; the REPL, batch.py and bench.py stay plain blocking
+# code, through blocking() front ends that run each call on the loop and wait for the result
+
+
+import asyncio, threading, inspect, time
+
+class engine():
+    def __init__(self):
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.run, name="engine", daemon=True)
+        self.thread.start()
+
+    def run(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+
+    def in_loop(self):
+        return threading.current_thread() is self.thread
+
+    # run fn(*args) on the loop, and wait for what it returns (if that's a coroutine, for what
+    # that returns). exceptions are raised here, in the caller. calling this from the loop
+    # itself would wait forever, so that's an error
+    def call(self, fn, *args, **kwargs):
+        if self.in_loop():
+            raise RuntimeError("engine.call from the event loop")
+        return asyncio.run_coroutine_threadsafe(invoke(fn, args, kwargs), self.loop).result()
+
+    # start a coroutine on the loop, from any thread, without waiting for it. returns its
+    # concurrent.futures.Future
+    def spawn(self, coro):
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    # call fn(*args) on the loop soon, from any thread
+    def call_soon(self, fn, *args):
+        self.loop.call_soon_threadsafe(fn, *args)
+
+    # a plain generator over an async generator that runs on the loop, for code on another
+    # thread (e.g. the library index's sync, which runs in an executor). every item is a round
+    # trip to the loop, so it's meant for generators of batches, like mpd_client.iter_cmd's
+    def iterate(self, agen):
+        try:
+            while True:
+                try:
+                    item = self.call(agen.__anext__)
+                except StopAsyncIteration:
+                    return
+                yield item
+        finally:
+            self.call(agen.aclose)
+
+async def invoke(fn, args, kwargs):
+    result = fn(*args, **kwargs)
+    if inspect.isawaitable(result):
+        result = await result
+    return result
+
+# a blocking front end for an object that lives on the loop: calling any of its methods runs
+# it on the loop and waits for it, whether it's a coroutine or not. anything else (e.g.
+# client.status) is read straight off the object, which is fine for looking at but not for
+# changing. the object itself is `target`
+class blocking():
+    def __init__(self, target, engine=None):
+        self.__dict__["target"] = target
+        self.__dict__["engine"] = engine or get()
+
+    def __getattr__(self, name):
+        attr = getattr(self.target, name)
+        if not callable(attr) or inspect.isclass(attr):
+            return attr
+        def call(*args, **kwargs):
+            return self.engine.call(attr, *args, **kwargs)
+        return call
+
+    def __setattr__(self, name, value):
+        setattr(self.target, name, value)
+
+# waits for `aw`, for at most `seconds`. raises TimeoutError if it takes longer: the builtin
+# one, which is an OSError, so it's handled like any other network error. (asyncio.wait_for
+# raises asyncio.TimeoutError, which before python 3.11 isn't)
+async def within(aw, seconds, message="timed out"):
+    try:
+        return await asyncio.wait_for(aw, seconds)
+    except asyncio.TimeoutError:
+        raise TimeoutError(message) from None
+
+# an asyncio lock that the task holding it can take again, like threading.RLock: the
+# command connection's lock is taken by commands that are also run as part of others
+class task_lock():
+    def __init__(self):
+        self.lock = asyncio.Lock()
+        self.owner = None
+        self.depth = 0
+
+    async def __aenter__(self):
+        task = asyncio.current_task()
+        if self.owner is task:
+            self.depth += 1
+            return
+        await self.lock.acquire()
+        self.owner = task
+        self.depth = 1
+
+    async def __aexit__(self, *exc):
+        self.depth -= 1
+        if self.depth == 0:
+            self.owner = None
+            self.lock.release()
+
+    def locked(self):
+        return self.lock.locked()
+
+# like threading.Condition, for the loop: notify_all() wakes every task waiting in wait_for().
+# there's no lock to hold, since everything that changes what they're waiting for runs on the loop too
+class condition():
+    def __init__(self):
+        self.event = asyncio.Event()
+
+    def notify_all(self):
+        self.event.set()
+        self.event = asyncio.Event()
+
+    # waits until predicate() is true. returns False if `timeout` (in seconds) runs out first
+    async def wait_for(self, predicate, timeout=None):
+        deadline = None if timeout == None else time.monotonic() + timeout
+        while not predicate():
+            remaining = None if deadline == None else deadline - time.monotonic()
+            if remaining != None and remaining <= 0:
+                return False
+            try:
+                await asyncio.wait_for(self.event.wait(), remaining)
+            except asyncio.TimeoutError: # (only the same as TimeoutError from python 3.11)
+                pass
+        return True
+
+shared = None
+shared_lock = threading.Lock()
+
+# the engine everything shares, started the first time it's asked for
+def get():
+    global shared
+    with shared_lock:
+        if shared == None:
+            shared = engine()
+        return shared
@@ -0,0 +1,42 @@
+# mpd-remote-streamer
+# Dylan Forbes
+# Computer Networks
+
+# bulk queue loading, for the "enqueue" command. takes an m3u playlist, or a plain list of
+# songs, one uri (relative to mpd's music directory, or a url) per line. lines can also be
+# findadd or searchadd queries, e.g. findadd artist "Some Band", which are sent as they are.
+# everything is sent with mpd_client.send_bulk, so thousands of songs cost a handful of round
+# trips rather than one each, and the songs mpd doesn't have are reported by line
+
+
+import mpd_client
+
+# lines that are sent to mpd as they are, rather than being taken as a song to add
+QUERY_COMMANDS = ("findadd ", "searchadd ")
+
+# the commands for the lines of a list: (line number, line, command) for each one that adds something
+def commands_for(lines):
+    cmds = []
+    for lineno, line in enumerate(lines, 1):
+        line = line.strip()
+        if lineno == 1:
+            line = line.lstrip("\ufeff")
+        # blank lines, comments and m3u's #EXTM3U/#EXTINF lines
+        if not line or line.startswith("#"):
+            continue
+        if line.startswith(QUERY_COMMANDS):
+            cmds.append((lineno, line, line))
+        else:
+            cmds.append((lineno, line, "add " + mpd_client.quote(line)))
+    return cmds
+
+# raises OSError if the file can't be read
+def read_list(path):
+    with open(path, encoding="UTF-8", errors="replace") as f:
+        return commands_for(f)
+
+# add everything in `cmds` (from commands_for) to the queue. returns (how many lines worked,
+# a list of (line number, line, error message) for the ones that didn't)
+def load(client, cmds):
+    failures = client.send_bulk([cmd for lineno, line, cmd in cmds])
+    return len(cmds) - len(failures), [(cmds[i][0], cmds[i][1], error) for i, error in failures]
@@ -0,0 +1,560 @@
+# mpd-remote-streamer
+# Dylan Forbes
+# Computer Networks
+
+# stand-ins for an mpd server and its http output, for measuring mpd_client and http_client
+# without a real mpd (see bench.py). they speak enough of the protocols for everything
+# mpdrs does, with a made-up library. run on their own with:
+#     python3 fake_server.py [--mpd-port N] [--http-port N] [--library N] [--queue N]
+#                            [--rtt MS] [--jitter MS] [--bitrate KBPS] [--play-delay MS]
+# and point mpdrs.py at them
+
+
+import sys, socket, threading, time, random, shlex, struct, multiprocessing
+
+# the protocol version we claim to speak
+PROTOCOL_VERSION = "0.23.5"
+SUBSYSTEMS = ["database", "update", "stored_playlist", "playlist", "player", "mixer", "output", "options"]
+# every fake song is this long, and the stream's pages carry this many bytes of audio
+SONG_SECONDS = 215
+PAGE_BODY = 4080
+# every fake song has album art this big (a typical cover), both as a file and embedded in it
+ART_BYTES = 200000
+# mpd's smallest binarylimit, and what it uses until asked for another
+MIN_BINARY_LIMIT = 64
+DEFAULT_BINARY_LIMIT = 8192
+
+def make_song(n):
+    return {
+        "file": "music/artist %d/album %d/%02d track %d.ogg" % (n // 100, n // 10, n % 10, n),
+        "Last-Modified": "2016-05-01T12:00:00Z",
+        "Time": str(SONG_SECONDS),
+        "duration": "%d.000" % SONG_SECONDS,
+        "Artist": "artist %d" % (n // 100),
+        "Album": "album %d" % (n // 10),
+        "Title": "track %d" % n,
+        "Track": str(n % 10),
+        # every fifth song has two genres (mpd sends a line for each)
+        "Genre": [["rock", "jazz", "folk", "pop"][n % 4]] + (["live"] if n % 5 == 0 else []),
+        "Date": str(1960 + n % 60),
+    }
+
+def format_song(song):
+    return "".join("%s: %s\n" % (key, value) for key, values in song.items()
+                   for value in (values if isinstance(values, list) else [values]))
+
+class ack(Exception):
+    def __init__(self, code, msg):
+        self.code = code
+        self.msg = msg
+
+# one client of the fake mpd server
+class mpd_conn():
+    def __init__(self, server, sock):
+        self.server = server
+        self.sock = sock
+        self.send_lock = threading.Lock()
+        self.pending = set() # subsystems that changed since this client's last idle
+        self.idling = None # the subsystems it's idling on, while it is
+        self.binary_limit = DEFAULT_BINARY_LIMIT
+
+    def send(self, data):
+        if isinstance(data, str):
+            data = data.encode("UTF-8")
+        with self.send_lock:
+            self.sock.sendall(data)
+
+    def lines(self):
+        buf = b''
+        while True:
+            try:
+                data = self.sock.recv(65536)
+            except OSError:
+                return
+            if not data:
+                return
+            buf += data
+            while b'\n' in buf:
+                line, buf = buf.split(b'\n', 1)
+                yield line.decode("UTF-8")
+
+    def serve(self):
+        self.send("OK MPD " + PROTOCOL_VERSION + "\n")
+        cmd_list = None
+        for line in self.lines():
+            if line in ("command_list_begin", "command_list_ok_begin"):
+                cmd_list = [line]
+            elif line == "command_list_end" and cmd_list != None:
+                self.respond(self.server.run_list(self, cmd_list))
+                cmd_list = None
+            elif cmd_list != None:
+                cmd_list.append(line)
+            elif line.startswith("idle"):
+                self.server.idle(self, line.split()[1:])
+            elif line == "noidle":
+                self.server.noidle(self)
+            elif line == "close":
+                break
+            else:
+                self.respond(self.server.run_list(self, [None, line]))
+        self.server.disconnected(self)
+        self.sock.close()
+
+    def respond(self, response):
+        self.server.delay()
+        try:
+            self.send(response)
+        except OSError:
+            pass
+
+# the fake mpd server: a library of `library_size` made-up songs, the first `queue_length` of
+# which are in the queue. every response is held back by `rtt` seconds plus up to `jitter`
+# more. if given a fake_httpd, it starts and stops its stream like mpd's http output does,
+# `play_delay` seconds after being told to play
+class fake_mpd():
+    def __init__(self, library_size=0, queue_length=0, rtt=0, jitter=0, httpd=None, play_delay=0, port=0, seed=0):
+        self.rtt = rtt
+        self.jitter = jitter
+        self.rng = random.Random(seed)
+        self.httpd = httpd
+        self.play_delay = play_delay
+        self.lock = threading.RLock()
+        self.clients = []
+        self.library = [make_song(n) for n in range(max(library_size, queue_length))]
+        self.by_file = {song["file"]: song for song in self.library}
+        self.queue = [] # songs in the queue, each with the playlist version it last changed in
+        self.version = 1
+        self.next_id = 1
+        self.state = "stop"
+        self.current = None # position in the queue
+        self.started = None # when the current song started, adjusted for pauses
+        self.paused_at = None
+        self.conn = None # the client whose command is running (commands run with the lock held)
+        self.art = {} # file -> its album art, made up the first time it's asked for
+        self.add_songs(self.library[:queue_length])
+        self.listener = socket.create_server(("127.0.0.1", port))
+        self.port = self.listener.getsockname()[1]
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+
+    def serve_forever(self):
+        while True:
+            try:
+                sock, _ = self.listener.accept()
+            except OSError:
+                return
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            conn = mpd_conn(self, sock)
+            with self.lock:
+                self.clients.append(conn)
+            threading.Thread(target=conn.serve, daemon=True).start()
+
+    def close(self):
+        self.listener.close()
+        with self.lock:
+            for conn in self.clients:
+                try:
+                    conn.sock.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+
+    def delay(self):
+        if self.rtt or self.jitter:
+            time.sleep(self.rtt + self.rng.uniform(0, self.jitter))
+
+    def disconnected(self, conn):
+        with self.lock:
+            self.clients.remove(conn)
+
+    # idle notifications
+    def changed(self, *subsystems):
+        with self.lock:
+            for conn in self.clients:
+                conn.pending.update(subsystems)
+                if conn.idling != None:
+                    self.wake(conn)
+
+    def idle(self, conn, subsystems):
+        with self.lock:
+            conn.idling = set(subsystems or SUBSYSTEMS)
+            self.wake(conn)
+
+    def noidle(self, conn):
+        with self.lock:
+            if conn.idling != None:
+                self.wake(conn, force=True)
+
+    def wake(self, conn, force=False):
+        changed = conn.pending & conn.idling
+        if not changed and not force:
+            return
+        conn.pending -= changed
+        conn.idling = None
+        try:
+            conn.send("".join("changed: %s\n" % subsystem for subsystem in sorted(changed)) + "OK\n")
+        except OSError:
+            pass
+
+    # runs a command list (or a single command: [None, command]), returns the whole response.
+    # commands return their part of it as text, or as bytes if it has binary data in it
+    def run_list(self, conn, cmd_list):
+        out = []
+        with self.lock:
+            self.conn = conn
+            for i, line in enumerate(cmd_list[1:]):
+                try:
+                    args = shlex.split(line)
+                except ValueError:
+                    args = line.split()
+                name = args[0] if args else ""
+                try:
+                    result = self.run(name, args[1:])
+                except ack as e:
+                    out.append(("ACK [%d@%d] {%s} %s\n" % (e.code, i, name, e.msg)).encode("UTF-8"))
+                    return b''.join(out)
+                out.append(result if isinstance(result, bytes) else result.encode("UTF-8"))
+                if cmd_list[0] == "command_list_ok_begin":
+                    out.append(b'list_OK\n')
+        out.append(b'OK\n')
+        return b''.join(out)
+
+    def run(self, name, args):
+        command = getattr(self, "cmd_" + name, None)
+        if command == None:
+            raise ack(5, 'unknown command "%s"' % name)
+        try:
+            return command(*args) or ""
+        except (TypeError, ValueError, IndexError):
+            raise ack(2, "bad arguments")
+
+    # the queue
+    def add_songs(self, songs):
+        for song in songs:
+            entry = dict(song)
+            entry["Id"] = str(self.next_id)
+            self.next_id += 1
+            self.queue.append([entry, None])
+        self.queue_changed(len(self.queue) - len(songs))
+
+    # everything from position `start` on moved or changed
+    def queue_changed(self, start):
+        self.version += 1
+        for pos in range(start, len(self.queue)):
+            self.queue[pos][0]["Pos"] = str(pos)
+            self.queue[pos][1] = self.version
+        self.changed("playlist")
+
+    def elapsed(self):
+        if self.started == None:
+            return 0
+        return (self.paused_at or time.monotonic()) - self.started
+
+    def start_song(self, pos):
+        self.current = pos
+        self.started = time.monotonic()
+        self.paused_at = None if self.state == "play" else self.started
+        if self.httpd != None:
+            self.httpd.new_track()
+
+    def set_state(self, state):
+        was = self.state
+        self.state = state
+        if state == "play" and was != "play":
+            if self.paused_at != None:
+                self.started += time.monotonic() - self.paused_at
+            self.paused_at = None
+            if self.httpd != None:
+                threading.Timer(self.play_delay, self.httpd.play).start()
+        elif state == "pause" and was == "play":
+            self.paused_at = time.monotonic()
+        elif state == "stop":
+            self.current = None if not self.queue else self.current
+            self.started = None
+            self.paused_at = None
+            if self.httpd != None:
+                self.httpd.stop()
+        self.changed("player")
+
+    def cmd_ping(self):
+        pass
+
+    def cmd_binarylimit(self, size):
+        if int(size) < MIN_BINARY_LIMIT:
+            raise ack(2, "Value too small")
+        self.conn.binary_limit = int(size)
+
+    # one chunk of a song's album art, at most the client's binarylimit long
+    def send_art(self, uri, offset, extra=b''):
+        if uri not in self.by_file:
+            raise ack(50, "No such file")
+        if uri not in self.art:
+            self.art[uri] = random.Random(uri).randbytes(ART_BYTES)
+        data = self.art[uri]
+        offset = int(offset)
+        if offset > len(data):
+            raise ack(2, "Bad file offset")
+        chunk = data[offset:offset + self.conn.binary_limit]
+        return b'size: %d\n%sbinary: %d\n%s\n' % (len(data), extra, len(chunk), chunk)
+
+    def cmd_albumart(self, uri, offset):
+        return self.send_art(uri, offset)
+
+    def cmd_readpicture(self, uri, offset):
+        return self.send_art(uri, offset, b'type: image/jpeg\n')
+
+    def cmd_status(self):
+        status = [("volume", "100"), ("repeat", "0"), ("random", "0"), ("single", "0"), ("consume", "0"),
+                  ("playlist", str(self.version)), ("playlistlength", str(len(self.queue))),
+                  ("mixrampdb", "0.000000"), ("state", self.state)]
+        if self.current != None and self.current < len(self.queue):
+            elapsed = self.elapsed()
+            status += [("song", str(self.current)), ("songid", self.queue[self.current][0]["Id"]),
+                       ("time", "%d:%d" % (elapsed, SONG_SECONDS)), ("elapsed", "%.3f" % elapsed),
+                       ("duration", "%d.000" % SONG_SECONDS)]
+            if self.state != "stop":
+                status += [("bitrate", str(self.httpd.bitrate if self.httpd else 128)), ("audio", "44100:24:2")]
+            if self.current + 1 < len(self.queue):
+                status += [("nextsong", str(self.current + 1)), ("nextsongid", self.queue[self.current + 1][0]["Id"])]
+        return "".join("%s: %s\n" % item for item in status)
+
+    def cmd_currentsong(self):
+        if self.current == None or self.current >= len(self.queue):
+            return ""
+        return format_song(self.queue[self.current][0])
+
+    def cmd_playlistinfo(self, pos=None):
+        if pos != None:
+            return format_song(self.queue[int(pos)][0])
+        return "".join(format_song(entry) for entry, version in self.queue)
+
+    def cmd_playlistid(self, songid=None):
+        if songid == None:
+            return self.cmd_playlistinfo()
+        for entry, version in self.queue:
+            if entry["Id"] == songid:
+                return format_song(entry)
+        raise ack(50, "No such song")
+
+    def cmd_plchanges(self, version):
+        return "".join(format_song(entry) for entry, changed in self.queue if changed > int(version))
+
+    def cmd_plchangesposid(self, version):
+        return "".join("cpos: %s\nId: %s\n" % (entry["Pos"], entry["Id"])
+                       for entry, changed in self.queue if changed > int(version))
+
+    def cmd_play(self, pos=None):
+        if not self.queue:
+            return
+        if pos != None:
+            self.start_song(int(pos))
+        elif self.current == None:
+            self.start_song(0)
+        self.set_state("play")
+
+    def cmd_pause(self, pause=None):
+        if self.state == "stop":
+            return
+        if pause == None:
+            pause = "1" if self.state == "play" else "0"
+        self.set_state("pause" if pause == "1" else "play")
+
+    def cmd_stop(self):
+        self.set_state("stop")
+
+    def cmd_next(self):
+        if self.state == "stop" or self.current == None:
+            return
+        if self.current + 1 >= len(self.queue):
+            self.set_state("stop")
+            return
+        self.start_song(self.current + 1)
+        self.changed("player")
+
+    def cmd_previous(self):
+        if self.state == "stop" or self.current == None:
+            return
+        self.start_song(max(0, self.current - 1))
+        self.changed("player")
+
+    def cmd_clear(self):
+        self.queue = []
+        self.current = None
+        self.queue_changed(0)
+        self.set_state("stop")
+
+    def cmd_delete(self, pos):
+        del self.queue[int(pos)]
+        if self.current != None and self.current >= int(pos):
+            self.current = max(0, self.current - 1) if self.current > int(pos) else None
+        self.queue_changed(int(pos))
+
+    def cmd_add(self, uri):
+        if uri not in self.by_file:
+            raise ack(50, "No such directory")
+        self.add_songs([self.by_file[uri]])
+
+    def cmd_addid(self, uri):
+        self.cmd_add(uri)
+        return "Id: %s\n" % self.queue[-1][0]["Id"]
+
+    def matches(self, args, exact):
+        pairs = list(zip(args[::2], args[1::2]))
+        if not pairs or len(args) % 2:
+            raise ack(2, "incorrect arguments")
+        for song in self.library:
+            for tag, value in pairs:
+                values = []
+                for k, v in song.items():
+                    if tag == "any" or k.lower() == tag.lower():
+                        values += v if isinstance(v, list) else [v]
+                if exact and value not in values:
+                    break
+                if not exact and not any(value.lower() in v.lower() for v in values):
+                    break
+            else:
+                yield song
+
+    def cmd_find(self, *args):
+        return "".join(format_song(song) for song in self.matches(args, True))
+
+    def cmd_search(self, *args):
+        return "".join(format_song(song) for song in self.matches(args, False))
+
+    def cmd_findadd(self, *args):
+        self.add_songs(list(self.matches(args, True)))
+
+    def cmd_searchadd(self, *args):
+        self.add_songs(list(self.matches(args, False)))
+
+    def cmd_listallinfo(self, uri=None):
+        return "".join(format_song(song) for song in self.library)
+
+    def cmd_update(self, uri=None):
+        self.changed("update", "database")
+        return "updating_db: 1\n"
+
+# the fake http output: an endless synthetic ogg stream (a page of zeros every so often, at
+# `bitrate` kbps, or as fast as the client will take it if bitrate is None). each track is a
+# new logical stream, starting with a beginning-of-stream page. like mpd's, it only sends
+# audio while playing: connections made before then are closed straight away
+class fake_httpd():
+    def __init__(self, bitrate=128, port=0):
+        self.bitrate = bitrate
+        self.playing = threading.Event()
+        self.serial = 1
+        self.lock = threading.Lock()
+        self.clients = []
+        self.listener = socket.create_server(("127.0.0.1", port))
+        self.port = self.listener.getsockname()[1]
+        self.body = bytes(PAGE_BODY)
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+
+    def serve_forever(self):
+        while True:
+            try:
+                sock, _ = self.listener.accept()
+            except OSError:
+                return
+            if not self.playing.is_set():
+                sock.close()
+                continue
+            with self.lock:
+                self.clients.append(sock)
+            threading.Thread(target=self.stream, args=(sock,), daemon=True).start()
+
+    def close(self):
+        self.listener.close()
+        self.stop()
+
+    def play(self):
+        self.playing.set()
+
+    def stop(self):
+        self.playing.clear()
+        with self.lock:
+            for sock in self.clients:
+                try:
+                    sock.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+            self.clients = []
+
+    def new_track(self):
+        self.serial += 1
+
+    def page(self, serial, seq):
+        segments = [255] * (PAGE_BODY // 255) + [PAGE_BODY % 255]
+        header = struct.pack("<4sBBqIIIB", b'OggS', 0, 2 if seq == 0 else 0, seq * 1024, serial, seq, 0, len(segments))
+        return header + bytes(segments) + self.body
+
+    def stream(self, sock):
+        try:
+            sock.recv(4096)
+            sock.sendall(b'HTTP/1.1 200 OK\r\nContent-Type: audio/ogg\r\nConnection: close\r\n\r\n')
+            serial = None
+            sent = 0
+            start = time.monotonic()
+            while True:
+                if serial != self.serial:
+                    serial = self.serial
+                    seq = 0
+                page = self.page(serial, seq)
+                if self.bitrate == None:
+                    # as fast as we can: send a batch of pages per call
+                    page = page + b''.join(self.page(serial, seq + i) for i in range(1, 16))
+                    seq += 15
+                sock.sendall(page)
+                seq += 1
+                sent += len(page)
+                if self.bitrate != None:
+                    time.sleep(max(0, start + sent / (self.bitrate * 125) - time.monotonic()))
+        except OSError:
+            pass
+        finally:
+            sock.close()
+
+# run a fake_mpd (and a fake_httpd, if http is set) and block forever
+def run(options, pipe=None):
+    httpd = None
+    if options.get("http"):
+        httpd = fake_httpd(options.get("bitrate", 128), options.get("http_port", 0))
+    mpd = fake_mpd(options.get("library", 0), options.get("queue", 0), options.get("rtt", 0),
+                   options.get("jitter", 0), httpd, options.get("play_delay", 0), options.get("mpd_port", 0))
+    ports = (mpd.port, httpd.port if httpd else None)
+    if pipe != None:
+        pipe.send(ports)
+    else:
+        print("fake_server: mpd on port %d, http on port %s" % ports)
+    threading.Event().wait()
+
+# run the fake servers in a child process (so they don't compete with what's being measured
+# for the gil). returns (process, mpd port, http port)
+def spawn(**options):
+    parent, child = multiprocessing.Pipe()
+    process = multiprocessing.Process(target=run, args=(options, child), daemon=True)
+    process.start()
+    mpd_port, http_port = parent.recv()
+    return process, mpd_port, http_port
+
+def main():
+    options = {"http": True, "mpd_port": 6600, "http_port": 8000, "library": 1000, "queue": 20}
+    args = sys.argv[1:]
+    try:
+        while args:
+            flag, value = args.pop(0), args.pop(0)
+            name = flag.lstrip("-").replace("-", "_")
+            if name in ("rtt", "jitter", "play_delay"):
+                options[name] = float(value) / 1000
+            elif name in ("mpd_port", "http_port", "library", "queue", "bitrate"):
+                options[name] = int(value)
+            else:
+                raise ValueError(flag)
+    except (IndexError, ValueError):
+        print("Usage: python3 fake_server.py [--mpd-port N] [--http-port N] [--library N] [--queue N] [--rtt MS] [--jitter MS] [--bitrate KBPS] [--play-delay MS]")
+        sys.exit(1)
+    try:
+        run(options)
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == "__main__":
+    main()
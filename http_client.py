@@ -2,200 +2,781 @@
 # Dylan Forbes
 # Computer Networks
 
+# receives the stream from mpd's http server and feeds it to the player through a fifo. it all
+# happens on the event loop (see engine.py): the http socket and the fifo are non-blocking and
+# registered with the loop, which calls on_readable() when audio arrives and on_writable() when
+# a full fifo has room again. starting the stream (and getting it back after losing it) is a
+# task, and every wait between attempts is a timer
 
-import sys, socket, os, multiprocessing, threading
+
+import sys, socket, os, errno, threading, time, asyncio
+from ring_buffer import ring_buffer
+from jitter_buffer import jitter_buffer
+import demux, metrics, log, supervisor, engine
+
+SPLICE_CHUNK_SIZE = 65536
+# bounds for the adaptive prebuffer, in milliseconds of audio
+MIN_BUFFER_MS = 200
+MAX_BUFFER_MS = 10000
+# 320 kbps, the highest bitrate we expect a stream to have
+MAX_BYTE_RATE = 40000
+# mpd's http server only accepts connections (and sends audio) once mpd is actually playing,
+# which takes a moment after the play command. so when starting the stream, we keep retrying,
+# starting with a short delay and doubling it each time, for up to START_TIMEOUT seconds
+START_RETRY_DELAY = 0.01
+START_MAX_RETRY_DELAY = 0.2
+START_TIMEOUT = 5
+# after a skip, we drop everything until the first page of the new track arrives. if it hasn't
+# after this many seconds, we give up waiting and just cut at the latest page
+SKIP_TIMEOUT = 3
+# while paused, mpd's http server keeps sending us (encoded) silence. if reconnecting costs less
+# than this fraction of the prebuffering we do on resume anyway, we disconnect when paused and
+# reconnect on resume; otherwise we keep the connection and throw away what arrives on it
+PAUSE_RECONNECT_FRACTION = 0.5
+# while paused on a connection we keep, don't wake up until this much has arrived (on linux,
+# epoll honours SO_RCVLOWAT; elsewhere we just wake up more often)
+PAUSE_DRAIN_LOWAT = 32768
+# the fifo can't be opened (without blocking) until the player has opened the other end, so
+# until then we try again this often
+FIFO_RETRY_SECONDS = 0.01
+
+debug = log.get("streamer")
+
+# os.splice only exists on linux (python 3.10+)
+def splice_available():
+    return hasattr(os, "splice")
 
 class http_client():
-    def __init__(self, ip, port, streamer_fifo_path, buffer_size, debuglevel):
-        self.debuglevel = debuglevel
+    def __init__(self, ip, port, streamer_fifo_path, buffer_ms, use_splice=False, trace_path=None):
         self.ip = ip
         self.port = port
         self.requestpath = "/mpd.ogg"
         self.http_sock = None
         self.streamer_fifo_path = streamer_fifo_path
-        self.buffer_size = buffer_size
-        self.amount_buffered = 0
-        self.fifo_opened = False
+        # decides how much to prebuffer, adapting to the bitrate and to underruns
+        self.jitter = jitter_buffer(buffer_ms, MIN_BUFFER_MS, MAX_BUFFER_MS)
+        if trace_path != None:
+            self.jitter.record_trace(trace_path)
+        self.time_to_first_audio = None # seconds from "play" to the first audio bytes, last time we started
+        self.starved_at = None # while writing: when we ran out of data to write, if we have
+        self.drained = 0 # bytes thrown away while paused, since the last pause
+        # the ring has to hold at least the biggest prebuffer, plus some room to keep receiving
+        # while the fifo is blocked
+        self.ring = ring_buffer(max(self.jitter.max_bytes(MAX_BYTE_RATE) * 2, 65536))
+        # keeps track of where the ogg pages (or mp3 frames) in the ring start, so stale audio
+        # can be thrown away without cutting a page in half
+        self.demux = None
+        self.ring.on_receive = self.demux_chunk
+        # objects that get a copy of the stream as it's received (see relay.py), with methods
+        # started(content type), received(data) and ended()
+        self.taps = []
+        self.tapping = False # if the taps have been told a stream started (and not that it ended)
+        self.capture = None # if set, a capture.capture (which is also a tap) we can rewind into
+        self.replay_offset = None # while playing from the capture: the offset in it to write next
+        self.preamble = b'' # codec headers to write before anything else, after jumping around the stream
+        self.rewound = None # how far behind the live stream the last rewind went, in seconds
+        self.received = metrics.counter("streamer_received_bytes_total", "audio bytes received from the http server")
+        self.written = metrics.counter("streamer_written_bytes_total", "audio bytes written to the fifo")
+        self.drained_total = metrics.counter("streamer_drained_bytes_total", "bytes thrown away while paused")
+        self.connect_attempts = metrics.counter("streamer_connect_attempts_total", "attempts to connect to the http server")
+        self.connections_lost = metrics.counter("streamer_connections_lost_total", "times the http server closed the connection")
+        self.ttfa = metrics.histogram("streamer_time_to_first_audio_seconds", "time from play to the first audio bytes")
+        metrics.function("gauge", "streamer_buffer_bytes", "audio bytes waiting in the ring buffer", lambda: len(self.ring))
+        metrics.function("gauge", "streamer_buffer_high_water_bytes", "the most bytes the ring buffer has held", lambda: self.ring.high_water)
+        metrics.function("gauge", "streamer_buffer_target_ms", "the prebuffer target, in milliseconds of audio", lambda: self.jitter.target_ms)
+        metrics.function("gauge", "streamer_byte_rate", "the stream's bytes per second, as measured (or estimated)", self.jitter.byte_rate)
+        metrics.function("counter", "streamer_underruns_total", "times the player ran out of audio", lambda: self.jitter.underruns)
+        self.skip_deadline = None # while skipping: when to stop waiting for the new track
+        # everything here runs on the event loop; the ui reaches it through engine.blocking()
+        self.engine = engine.get()
+        self.loop = self.engine.loop
+        # if the connection drops while we're playing, we keep trying to get the stream back
+        # (on a timer), waiting longer after each failure
+        self.health = supervisor.supervisor("streamer")
+        self.retry_handle = None # the timer for the next attempt, while we're trying
+        self.starting = None # the task connecting and waiting for the first audio, while there is one
+        self.ready = None # a future that's done once the last play() has started writing (or failed to)
+        self.held = False # if we've been told not to start writing until the next "play"
+        self.fifo = None # the fifo, once the player has opened the other end
+        self.fifo_retry = None # the timer for trying to open it again, while it hasn't
+        self.fifo_blocked = False # if the fifo was full last time we wrote to it
+        self.watching_fifo = False # if the loop is waiting for the fifo to have room
         self.connected = False # if we have a connection to the server
+        self.reading = False # if the loop is waiting for the http socket to be readable
         self.streaming = False # if the server is currently sending us data
         self.buffering = False # if we're saving up data before writing to the fifo
-        self.writing = False # if we're writing to the fifo 
+        self.writing = False # if we're writing to the fifo
+        # once we're done buffering, let the kernel move the data from the socket to the fifo
+        self.use_splice = use_splice and splice_available()
         self.quitting = threading.Event()
 
-        # first create pipe to communicate with the thread
-        self.to_child, self.from_parent = multiprocessing.Pipe()
-        # then create separate thread for it to run in, so it can write to audio pipe while we do other stuff here
-        self.streamer_thread = threading.Thread(target=self.stream)
-        # then run it
-        self.streamer_thread.start()
-        self.print_debug("streamer: started child thread", 3)
-
-    def print_debug(self, msg, level):
-        if level <= self.debuglevel:
-            print(msg)
-    
-    def wait_for_child(self):
-        # wait until the child thread tells us it's ready 
-        self.print_debug("streamer: waiting for ok from child...", 3)
-        if self.to_child.recv() == "OK":
-            self.print_debug("streamer: child says ok", 3)
-            return
+    # waits until the last play() has started writing to the fifo (or failed to start the stream)
+    async def wait_ready(self):
+        if self.ready != None:
+            debug(3, "streamer: waiting until we're writing...")
+            await asyncio.shield(self.ready)
+
+    def set_ready(self):
+        if self.ready != None and not self.ready.done():
+            self.ready.set_result(None)
+
+    # bitrate of the stream in kbps, as a first guess before we've measured it
+    def set_bitrate(self, kbps):
+        self.jitter.set_bitrate(kbps)
+
+    # the player ran out of data (e.g. mpv's paused-for-cache); buffer more next time
+    def report_underrun(self):
+        debug(1, "streamer: underrun!")
+        self.jitter.underrun(time.monotonic())
 
     def quit(self):
-        if self.http_sock: 
-            self.print_debug("streamer: closing connection", 1)
-            self.http_sock.close()
-        self.to_child.send("quit")
-        if self.streamer_thread.is_alive():
-            self.streamer_thread.join()
-            self.print_debug("streamer: streamer_thread joined", 3)
+        self.stop_retrying()
+        self.jitter.reset_arrivals() # (which writes out the rest of the trace, if there is one)
+        self.writing = False
+        self.buffering = False
+        self.streaming = False
+        self.disconnect()
+        self.close_fifo()
+        self.quitting.set()
+        self.set_ready()
 
-    def play(self):
-        self.to_child.send("play")
-        self.wait_for_child()
+    async def play(self):
+        self.start_play()
+        await self.wait_ready()
+
+    # like play(), but doesn't wait for the stream to start, so the caller can get on with
+    # other things (like telling mpd to play) in the meantime. follow with wait_ready()
+    def start_play(self):
+        debug(2, "streamer: play")
+        self.set_ready() # (nobody's waiting for the last one any more)
+        self.ready = self.loop.create_future()
+        # (if we were trying to get the stream back, the caller's waiting for it now)
+        self.cancel_retry()
+        if self.streaming and not self.writing and not self.buffering:
+            self.drain_pending() # (this might find that the server closed the connection)
+        if not self.streaming: # self.streaming is only true after we've requested the audio and we haven't told mpd to stop
+            if self.starting == None: # (otherwise, it's already on its way)
+                self.disconnect()
+                self.drain_fifo() # (if we disconnected for a pause)
+                self.starting = self.loop.create_task(self.begin_stream())
+        elif self.replay_offset != None and not self.writing:
+            # after a rewind, there's nothing to buffer: it's all in the capture already
+            self.held = False
+            self.start_writing()
+        elif not self.writing:
+            if not self.buffering: # resuming after a pause: what's buffered is stale, so buffer up again before writing
+                debug(3, "streamer: drained %d bytes while paused", self.drained)
+                self.set_lowat(1)
+                self.ring.clear()
+                self.drain_fifo()
+                self.buffering = True
+                debug(2, "streamer: started buffering...")
+            self.held = False # (after a skip we're already buffering, and just waiting for this)
+        self.pump()
 
     def pause(self):
-        self.to_child.send("pause")
-        self.wait_for_child()
+        self.stop_retrying()
+        debug(2, "streamer: stopped writing to fifo")
+        self.jitter.reset_arrivals()
+        self.writing = False
+        self.buffering = False
+        self.held = False
+        self.skip_deadline = None
+        self.stop_replay()
+        if self.streaming:
+            self.ring.clear()
+            self.drained = 0
+            if self.reconnect_is_cheap():
+                debug(2, "streamer: disconnecting until resumed")
+                self.streaming = False
+                self.disconnect()
+            else:
+                debug(2, "streamer: keeping the connection while paused")
+                self.set_lowat(PAUSE_DRAIN_LOWAT)
+        self.set_ready()
+        self.watch()
 
     def stop(self):
-        self.to_child.send("stop")
-        self.wait_for_child()
+        self.stop_retrying()
+        debug(2, "streamer: stopped writing to fifo")
+        self.jitter.reset_arrivals()
+        self.writing = False
+        self.buffering = False
+        self.streaming = False
+        self.held = False
+        self.skip_deadline = None
+        self.stop_replay()
+        self.disconnect()
+        self.close_fifo()
+        self.set_ready()
 
+    # mpd moved to another track: throw away the old one's audio. nothing more is written to the
+    # fifo until play() (so the player can drop its own buffers in the meantime)
+    def skip(self):
+        if self.streaming:
+            self.stop_replay()
+            self.drain_fifo()
+            self.writing = False
+            self.buffering = True
+            self.held = True
+            self.skip_deadline = time.monotonic() + SKIP_TIMEOUT
+            self.skip_stale()
+            self.watch()
+
+    # keep the last part of the stream in `capture` (a capture.capture), for rewind()
+    def set_capture(self, capture):
+        self.capture = capture
+        self.add_tap(capture)
+
+    # play again from `seconds` before what's playing now, out of the capture. like skip(), nothing
+    # is written until play(). returns how far behind the live stream that is, or None if there's
+    # nothing captured to play
+    def rewind(self, seconds):
+        self.rewound = None
+        if self.streaming and self.capture != None:
+            # what's playing now is about what we're writing, less what the fifo and player hold
+            now = self.capture.time_at(self.replay_offset) if self.replay_offset != None else time.monotonic()
+            target = self.capture.seek(now - seconds - self.jitter.target_ms / 1000)
+            if target != None:
+                self.replay_offset, self.preamble = target
+                self.rewound = time.monotonic() - self.capture.time_at(self.replay_offset)
+                debug(2, "streamer: rewinding to %.1f s behind the live stream", self.rewound)
+                self.drain_fifo()
+                self.ring.clear()
+                self.writing = False
+                self.buffering = False
+                self.held = True
+                self.skip_deadline = None
+                self.watch()
+        return self.rewound
+
+    # go back to the live stream after a rewind (again, nothing is written until play())
+    def live(self):
+        if self.replay_offset != None:
+            self.stop_replay()
+            self.preamble = self.capture.headers_for(self.capture.total)
+            self.drain_fifo()
+            self.ring.clear()
+            self.writing = False
+            self.buffering = True
+            self.held = True
+            self.watch()
+
+    def replaying(self):
+        return self.replay_offset != None
+
+    # if we're trying to get the stream back, try again now (e.g. mpd's just come back)
+    def retry(self):
+        if self.retry_handle != None:
+            self.cancel_retry()
+            self.retry_later(0)
+
+    # stop trying to get the stream back (e.g. mpd isn't playing any more)
+    def give_up(self):
+        if not self.health.up():
+            debug(2, "streamer: no longer trying to reconnect")
+            self.stop_retrying()
+
+    # open the fifo, if it isn't already. returns whether it's open: if the player hasn't opened
+    # the other end yet, we try again shortly
     def open_fifo(self):
-        if not self.fifo_opened:
-            self.print_debug("streamer: opening fifo", 3)
-            self.fifo = open(self.streamer_fifo_path, "wb")
-            self.fifo_opened = True
+        if self.fifo != None:
+            return True
+        if self.fifo_retry != None:
+            return False
+        try:
+            fd = os.open(self.streamer_fifo_path, os.O_WRONLY | os.O_NONBLOCK)
+        except OSError as e:
+            if e.errno != errno.ENXIO:
+                raise
+            self.fifo_retry = self.loop.call_later(FIFO_RETRY_SECONDS, self.fifo_ready)
+            return False
+        debug(3, "streamer: opened fifo")
+        # unbuffered, so writes from the ring buffer go straight to the fifo
+        self.fifo = open(fd, "wb", buffering=0)
+        return True
+
+    def fifo_ready(self):
+        self.fifo_retry = None
+        self.pump()
 
     def close_fifo(self):
-        if self.fifo_opened:
-            self.print_debug("streamer: closing fifo", 3)
+        if self.fifo_retry != None:
+            self.fifo_retry.cancel()
+            self.fifo_retry = None
+        if self.fifo != None:
+            debug(3, "streamer: closing fifo")
+            self.watch_fifo(False)
             try:
                 self.fifo.close()
-            except:
+            except OSError:
                 # for some reason you can't close a fifo that's already closed on the other end?
                 pass
-            self.fifo_opened = False
-
-    def connect_to_server(self): 
-        # connect to to server
-        self.print_debug("streamer: connecting to http server...", 1)
-        self.http_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.http_sock.connect((self.ip, self.port))
-        self.print_debug("streamer: connected to http server at %s:%s" % (self.ip, self.port), 1) 
-        self.connected = True
+            self.fifo = None
+            self.fifo_blocked = False
 
-    def receive(self):
-        self.print_debug("streamer: receiving from http server...", 4)
-        return self.http_sock.recv(2048)
+    # whatever is still sitting in the fifo is stale too. we can empty it from this end by
+    # opening it for reading as well (only for a moment: while we have it open, the fifo
+    # wouldn't notice the player going away)
+    def drain_fifo(self):
+        if self.fifo == None:
+            return
+        try:
+            fd = os.open(self.streamer_fifo_path, os.O_RDONLY | os.O_NONBLOCK)
+        except OSError:
+            return
+        drained = 0
+        try:
+            while True:
+                data = os.read(fd, 65536)
+                if not data:
+                    break
+                drained += len(data)
+        except BlockingIOError:
+            pass
+        finally:
+            os.close(fd)
+        debug(3, "streamer: drained %d stale bytes from the fifo", drained)
 
-    def request_audio(self):
-        self.print_debug("streamer: requesting audio", 3)
-        # request audio data from server
-        self.amount_buffered = 0
-        msg = "GET " + self.requestpath + " HTTP/1.1\r\nAccept: */*\r\n\r\n"
-        self.print_debug("streamer: sending http request", 2) 
-        self.http_sock.sendall(msg.encode("UTF-8"))
+    # write as much of `data` as the fifo will take. returns how much that was, or None if it's
+    # full (we carry on once it has room) or the player has gone away (we open it again)
+    def write_fifo(self, data):
+        try:
+            n = self.fifo.write(data)
+        except BrokenPipeError:
+            debug(1, "streamer: the player closed the fifo")
+            self.close_fifo()
+            return None
+        if n == None:
+            self.fifo_blocked = True
+        return n
 
-        # filter out the HTTP header of the response
-        firstblock = ''
-        self.print_debug("streamer: waiting for response from HTTP server...", 2)
-        firstblock = self.receive()
-        self.print_debug("streamer: received response from HTTP server", 2)
-        offset = firstblock.find(b'\r\n\r\n') + 4 # len(b'\r\n\r\n') == 4
-        # (sometimes it sends the data in the same packet as the response header, sometimes it doesn't)
-        initialdata = b''
-        if offset < len(firstblock):
-            # remember this block of data for later!
-            initialdata = firstblock[offset:]
-        # receive first block of actual data
-        self.print_debug("streamer: done requesting audio", 3)
-        return initialdata
-
-    def check_for_messages(self):
+    def add_tap(self, tap):
+        self.taps.append(tap)
+
+    def start_taps(self, content_type):
+        for tap in self.taps:
+            tap.started(content_type)
+        self.tapping = bool(self.taps)
+
+    def end_taps(self):
+        if self.tapping:
+            self.tapping = False
+            for tap in self.taps:
+                tap.ended()
+
+    def disconnect(self):
+        self.end_taps()
+        if self.http_sock:
+            debug(1, "streamer: closing connection")
+            self.watch_socket(False)
+            self.http_sock.close()
+            self.http_sock = None
+        self.connected = False
+
+    # move data directly from the socket to the fifo, without it ever entering python. it keeps
+    # going until there's nothing more to move, so a fast stream costs one wakeup per batch
+    # rather than one per chunk
+    def splice_in(self):
+        first = True
+        while self.connected and self.fifo != None:
+            try:
+                n = os.splice(self.http_sock.fileno(), self.fifo.fileno(), SPLICE_CHUNK_SIZE, flags=os.SPLICE_F_NONBLOCK)
+            except BlockingIOError:
+                # the first time, the socket was readable, so it's the fifo that's full. after
+                # that, it's most likely that we've emptied the socket (if it's the fifo after
+                # all, the next wakeup finds out)
+                self.fifo_blocked = first
+                return
+            except BrokenPipeError:
+                debug(1, "streamer: the player closed the fifo")
+                self.close_fifo()
+                return
+            except OSError as e:
+                if e.errno not in (errno.EINVAL, errno.ENOSYS, errno.EOPNOTSUPP):
+                    raise
+                debug(1, "streamer: splice not supported, falling back to copying")
+                self.use_splice = False
+                return
+            if n == 0:
+                self.connection_lost()
+                return
+            now = time.monotonic()
+            self.received.inc(n)
+            self.written.inc(n)
+            self.jitter.record_arrival(n, now, self.waiting_time(now))
+            self.starved_at = now
+            if first and self.demux != None:
+                # the demux doesn't see spliced data, so whatever page it was in the middle of
+                # is long gone by the time data goes through the ring again (after a skip(),
+                # say): it has to look for the next page from scratch
+                self.demux.resync(self.ring.write_total)
+            first = False
+
+    # whether what arrives can go straight to the fifo: the ring is drained, so from here on the
+    # kernel can do the copying (unless the taps need to see the data)
+    def splicing(self):
+        return (self.writing and self.use_splice and not self.tapping and self.fifo != None
+                and self.replay_offset == None and not self.ring)
+
+    # whether to drop the connection while paused, rather than keep draining it: only if
+    # reconnecting (measured last time we started streaming) is cheap
+    def reconnect_is_cheap(self):
+        if self.taps:
+            return False # whoever's listening through the taps would lose the stream
+        if self.time_to_first_audio == None:
+            return False
+        return self.time_to_first_audio * 1000 <= self.jitter.target_ms * PAUSE_RECONNECT_FRACTION
+
+    # throw away whatever the server has sent while we're paused, in one go, straight into the
+    # (empty) ring's storage
+    def drain(self, flags=0):
+        n = self.http_sock.recv_into(self.ring.view, 0, flags)
+        if n == 0:
+            self.connection_lost()
+            return
+        self.drained += n
+        self.drained_total.inc(n)
+        if self.tapping:
+            view = self.ring.view[:n]
+            for tap in self.taps:
+                tap.received(view)
+
+    # on resume, throw away what's still waiting in the socket (less than PAUSE_DRAIN_LOWAT)
+    def drain_pending(self):
         try:
-            # if we're playing, just poll; otherwise block on recv (to reduce cpu usage)
-            if (self.connected and self.from_parent.poll()) or not self.connected:
-                message = self.from_parent.recv()
-                self.print_debug("streamer: received message from parent: " + message, 2)
-
-                # perform necessary actions
-                if message == "play":
-                    if not self.connected:
-                        self.connect_to_server()
-                    if self.connected: # if we actually succeeded in connecting
-                        if not self.streaming: # self.streaming is only true after we've requested the audio and we haven't told mpd to stop
-                            self.data = self.request_audio()
-                            self.streaming = True
-                            self.buffering = True # start buffering
-                            self.print_debug("streamer: started buffering...", 2)
-                        else: # if we were already streaming, there's nothing to do here
-                            self.from_parent.send("OK")
-                    else:
-                        self.print_debug("streamer: Error! Failed to connect to server!", 0)
-                        # tell parent we're ready (as ready as we're gonna get)
-                        self.from_parent.send("OK")
-
-                elif message == "pause":
-                    self.print_debug("streamer: stopped writing to fifo", 2)
-                    self.writing = False
-                    self.buffering = False
-                    # tell parent we're ready
-                    self.from_parent.send("OK") 
-                    
-                elif message == "stop":
-                    self.print_debug("streamer: stopped writing to fifo", 2)
-                    self.writing = False
-                    self.buffering = False
-                    self.connected = False
-                    self.streaming = False
-                    self.close_fifo()
-                    # tell parent we're ready
-                    self.from_parent.send("OK") 
-
-                elif message == "quit":
-                    self.writing = False
+            while self.connected:
+                self.drain(socket.MSG_DONTWAIT)
+        except BlockingIOError:
+            pass
+
+    def set_lowat(self, nbytes):
+        try:
+            self.http_sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVLOWAT, nbytes)
+        except (AttributeError, OSError):
+            pass
+
+    # called by the ring with every chunk of data it receives
+    def demux_chunk(self, data):
+        if self.tapping:
+            for tap in self.taps:
+                tap.received(data)
+        if self.demux != None:
+            self.demux.feed(data)
+
+    # throw away the old track's audio in the ring: everything before the first page of the new
+    # one. returns whether it's arrived yet (if it hasn't, keep calling this as data comes in)
+    def skip_stale(self):
+        ring = self.ring
+        if self.demux == None:
+            # no idea where the pages are; the best we can do is start from scratch
+            ring.clear()
+            self.skip_deadline = None
+            return True
+        self.demux.prune(ring.read_total)
+        boundary = None
+        if self.demux.HAS_TRACKS:
+            boundary = self.demux.latest_boundary(ring.read_total, track=True)
+        if boundary == None and (time.monotonic() > self.skip_deadline or not self.demux.HAS_TRACKS):
+            # the new track's first page never came (or it never will, for mp3): cut at the latest page
+            boundary = self.demux.latest_boundary(ring.read_total)
+            if boundary == None:
+                boundary = ring.read_total
+        if boundary == None:
+            ring.drop_to(self.demux.safe_offset())
+            return False
+        debug(3, "streamer: dropped %d bytes of stale audio", boundary - ring.read_total)
+        ring.drop_to(boundary)
+        self.skip_deadline = None
+        return True
+
+    # make sure the first thing we write to the fifo is the start of a page
+    def align_to_page(self):
+        if self.demux != None:
+            boundary = self.demux.next_boundary(self.ring.read_total)
+            if boundary != None:
+                self.ring.drop_to(boundary)
+
+    # (the fifo is opened, and the preamble written, by write_out())
+    def start_writing(self):
+        self.writing = True
+        self.starved_at = None
+
+    def stop_replay(self):
+        self.replay_offset = None
+        self.preamble = b''
+
+    # write whatever we have to the fifo, until it's full or we run out
+    def write_out(self):
+        if not self.open_fifo():
+            return
+        self.set_ready() # (whoever said play is waiting for this)
+        while self.preamble:
+            n = self.write_fifo(self.preamble)
+            if n == None:
+                return
+            self.preamble = self.preamble[n:]
+        if self.replay_offset != None:
+            self.write_replay()
+            return
+        while self.ring:
+            n = self.write_fifo(self.ring.data_region())
+            if n == None:
+                return
+            self.ring.consume(n)
+            self.written.inc(n)
+        if self.starved_at == None:
+            self.starved_at = time.monotonic()
+
+    # write the capture to the fifo, from where we're replaying it up to the live stream
+    def write_replay(self):
+        while True:
+            view = self.capture.read(self.replay_offset, SPLICE_CHUNK_SIZE)
+            if view == None:
+                # we fell so far behind that it's been overwritten; carry on from the oldest page left
+                debug(1, "streamer: replay overtaken by the live stream")
+                target = self.capture.seek(0)
+                if target == None:
+                    # nothing's left to play again at all, so go back to the live stream, and
+                    # carry on as soon as it's buffered (nobody's going to say play)
+                    self.live()
+                    self.held = False
+                    self.watch()
+                    return
+                self.replay_offset, self.preamble = target
+                self.write_out()
+                return
+            if not view:
+                return # (more arrives through the capture, as a tap)
+            n = self.write_fifo(view)
+            if n == None:
+                return
+            self.replay_offset += n
+            self.written.inc(n)
+
+    # how long we've been waiting for data while the player was being fed: that's what can starve it
+    def waiting_time(self, now):
+        if not self.writing or self.starved_at == None:
+            return 0
+        return now - self.starved_at
+
+    def recv_into_ring(self):
+        n = self.ring.recv_into(self.http_sock)
+        if n == None:
+            return 0 # the ring's full; we'll read again once it's been written out
+        if n == 0:
+            self.connection_lost()
+            return 0
+        now = time.monotonic()
+        self.received.inc(n)
+        self.jitter.record_arrival(n, now, self.waiting_time(now))
+        self.starved_at = None
+        return n
+
+    # the loop calls this when the http socket is readable
+    def on_readable(self):
+        try:
+            if not self.streaming or (not self.writing and not self.buffering and self.replay_offset == None):
+                self.drain() # paused
+            elif self.replay_offset != None:
+                # what arrives now is kept by the capture (it's a tap); we don't need it
+                if self.recv_into_ring():
+                    self.ring.clear()
+            elif self.splicing():
+                self.splice_in()
+            else:
+                self.recv_into_ring()
+        except BlockingIOError:
+            pass
+        except OSError as e:
+            debug(1, "streamer: error receiving from http server: %s", e)
+            self.connection_lost()
+        self.pump()
+
+    # the loop calls this when the fifo has room again
+    def on_writable(self):
+        self.fifo_blocked = False
+        self.pump()
+
+    # move things along after anything's happened: stop buffering once there's enough, write
+    # what we can, and have the loop wait for whatever we're waiting for
+    def pump(self):
+        if self.streaming and self.buffering:
+            if self.skip_deadline == None or self.skip_stale():
+                if not self.held and len(self.ring) >= min(self.jitter.target_bytes(), self.ring.capacity // 2):
+                    debug(2, "streamer: buffer size reached, started writing to fifo")
+                    self.align_to_page()
                     self.buffering = False
-                    self.streaming = False
-                    self.close_fifo()
-                    self.quitting.set()
-                    # tell parent we're ready
-                    self.from_parent.send("OK") 
+                    self.start_writing()
+        if self.writing and not self.fifo_blocked:
+            self.write_out()
+        self.watch()
 
-        except KeyboardInterrupt:
-            self.quit()
+    # while the ring is full, the socket would be readable all the time, so stop waiting for
+    # it until there's room again (what's waiting stays in the kernel's buffer meanwhile). the
+    # same goes for a full fifo, if we're splicing
+    def watch(self):
+        self.watch_socket(self.connected and self.ring.free() > 0 and not (self.fifo_blocked and self.splicing()))
+        self.watch_fifo(self.fifo != None and self.fifo_blocked)
+
+    def watch_socket(self, wanted):
+        if wanted == self.reading:
+            return
+        if wanted:
+            self.loop.add_reader(self.http_sock, self.on_readable)
+        else:
+            self.loop.remove_reader(self.http_sock)
+        self.reading = wanted
 
-    def stream(self):
+    def watch_fifo(self, wanted):
+        if wanted == self.watching_fifo:
+            return
+        if wanted:
+            self.loop.add_writer(self.fifo, self.on_writable)
+        else:
+            self.loop.remove_writer(self.fifo)
+        self.watching_fifo = wanted
+
+    # the server closed the connection (e.g. mpd stopped)
+    def connection_lost(self):
+        debug(1, "streamer: http server closed the connection")
+        self.connections_lost.inc()
+        playing = self.writing or (self.buffering and not self.held)
+        self.disconnect()
+        self.streaming = False
+        self.writing = False
+        self.jitter.reset_arrivals()
+        self.skip_deadline = None
+        self.stop_replay()
+        self.buffering = False
+        self.held = False
+        self.set_ready() # (in case someone's waiting for us to finish buffering)
+        if playing:
+            # it might just be mpd stopping (then we're told to give_up()), but if it's the
+            # network, get the stream back without being asked
+            self.health.lost()
+            self.retry_later(self.health.backoff())
+
+    # try to get the stream back after `delay` seconds
+    def retry_later(self, delay):
+        debug(1, "streamer: trying to reconnect in %.1f s", delay)
+        self.retry_handle = self.loop.call_later(delay, self.resume_stream)
+
+    def resume_stream(self):
+        self.retry_handle = None
+        if self.starting == None:
+            debug(1, "streamer: reconnecting to http server...")
+            self.starting = self.loop.create_task(self.begin_stream())
+
+    def cancel_retry(self):
+        if self.retry_handle != None:
+            self.retry_handle.cancel()
+            self.retry_handle = None
+
+    def stop_retrying(self):
+        self.cancel_retry()
+        self.cancel_start()
+        self.health.cancel()
+
+    # stop starting the stream (e.g. we've been told to pause meanwhile)
+    def cancel_start(self):
+        if self.starting != None:
+            self.starting.cancel()
+            self.starting = None
+            self.set_ready()
+
+    # the task that starts the stream, for play() or to get it back after losing it
+    async def begin_stream(self):
+        try:
+            ok = await self.start_stream()
+        finally:
+            if self.starting is asyncio.current_task():
+                self.starting = None
+        if ok:
+            self.streaming = True
+            self.buffering = True # start buffering
+            if not self.health.up():
+                self.health.attempted(True)
+            debug(2, "streamer: started buffering...")
+            self.pump()
+        else:
+            debug(0, "streamer: Error! Failed to connect to server!")
+            if not self.health.up():
+                # we're trying to get the stream back; keep at it
+                self.retry_later(self.health.attempted(False))
+            # whoever said play is as ready as they're gonna get
+            self.set_ready()
+
+    # connect, request the audio, and wait for the first bytes of it, retrying with backoff
+    # until they arrive. returns False if they never did
+    async def start_stream(self):
+        start = time.monotonic()
+        deadline = start + START_TIMEOUT
+        delay = START_RETRY_DELAY
+        attempts = 0
         while True:
-            #print("buffering: " + str(self.buffering))
-            ##print("writing: " + str(self.writing))
-            # check for messages from main
-            self.check_for_messages()
-            if self.quitting.is_set():
+            attempts += 1
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            sock.setblocking(False)
+            try:
+                initialdata, content_type = await self.request_audio(sock, deadline)
                 break
-            if self.streaming:
-                # buffer up to the buffer amount
-                if self.buffering:
-                    # receive data
-                    self.data += self.receive()
-                    if len(self.data) > self.buffer_size:
-                        self.print_debug("streamer: buffer size reached, started writing to fifo", 2)
-                        self.buffering = False
-                        self.writing = True
-                        self.open_fifo()
-                        # tell parent we're ready
-                        self.from_parent.send("OK") 
-                else:
-                    # write to fifo
-                    if self.writing and self.data:
-                        # write the OGG data to the pipe
-                        try:
-                            self.fifo.write(self.data)
-                        except KeyboardInterrupt:
-                            self.quit() 
-                    # receive more data
-                    self.data = self.receive()
-            else:
-                if self.connected:
-                    self.receive() # eat up the silence that the server sends us when paused 
+            except OSError as e:
+                sock.close()
+                debug(3, "streamer: no audio yet (%s), retrying...", e)
+                if time.monotonic() + delay > deadline:
+                    return False
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, START_MAX_RETRY_DELAY)
+            except BaseException:
+                sock.close() # (cancelled)
+                raise
+        # only now that it's worked do we touch the stream: a cancelled start leaves it alone
+        self.http_sock = sock
+        self.connected = True
+        self.ring.clear()
+        self.demux = demux.for_content_type(content_type, self.ring.write_total)
+        self.start_taps(content_type)
+        self.ring.feed(initialdata)
+        self.received.inc(len(self.ring))
+        self.time_to_first_audio = time.monotonic() - start
+        self.ttfa.observe(self.time_to_first_audio)
+        debug(2, "streamer: time to first audio: %d ms (%d attempts)", self.time_to_first_audio * 1000, attempts)
+        return True
+
+    # connects `sock` to the server, requests the audio, and waits for the first of it. returns
+    # (the audio that came with the header, content type); raises OSError if it doesn't arrive
+    async def request_audio(self, sock, deadline):
+        debug(1, "streamer: connecting to http server...")
+        self.connect_attempts.inc()
+        await engine.within(self.loop.sock_connect(sock, (self.ip, self.port)), supervisor.CONNECT_TIMEOUT)
+        debug(1, "streamer: connected to http server at %s:%s", self.ip, self.port)
+        debug(3, "streamer: requesting audio")
+        # request audio data from server
+        msg = "GET " + self.requestpath + " HTTP/1.1\r\nAccept: */*\r\n\r\n"
+        debug(2, "streamer: sending http request")
+        await self.loop.sock_sendall(sock, msg.encode("UTF-8"))
+
+        # filter out the HTTP header of the response
+        debug(2, "streamer: waiting for response from HTTP server...")
+        firstblock = await self.receive(sock, deadline)
+        debug(2, "streamer: received response from HTTP server")
+        offset = firstblock.find(b'\r\n\r\n') + 4 # len(b'\r\n\r\n') == 4
+        content_type = None
+        for line in firstblock[:offset].split(b'\r\n'):
+            name, _, value = line.partition(b':')
+            if name.strip().lower() == b'content-type':
+                content_type = value.split(b';')[0].strip().lower().decode("ascii", "replace")
+        # (sometimes it sends the data in the same packet as the response header, sometimes it doesn't)
+        initialdata = firstblock[offset:]
+        while not initialdata:
+            initialdata = await self.receive(sock, deadline)
+        debug(3, "streamer: done requesting audio")
+        return initialdata, content_type
+
+    async def receive(self, sock, deadline):
+        debug(4, "streamer: receiving from http server...")
+        data = await engine.within(self.loop.sock_recv(sock, 2048), max(0, deadline - time.monotonic()), "no audio")
+        if not data:
+            raise ConnectionError("connection closed")
+        return data
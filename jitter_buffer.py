@@ -0,0 +1,122 @@
+# mpd-remote-streamer
+# Dylan Forbes
+# Computer Networks
+
+
+# used until we know better: 128 kbps, the bitrate in the example mpd.conf
+DEFAULT_BYTE_RATE = 16000
+# how much arrival time to average over before trusting the measured rate
+RATE_WINDOW = 0.5
+# weight of the newest window in the moving average of the arrival rate
+RATE_SMOOTHING = 0.2
+# after an underrun, the target grows by GROW_FACTOR, or to GAP_FACTOR times the gap in the data
+# that caused it, if that's more. the data held up by a stall all turns up at once when it ends,
+# so most of a target that size is already there to refill from, and the next gap that long is
+# covered rather than being another underrun
+GROW_FACTOR = 1.5
+GAP_FACTOR = 1.25
+# and after this many seconds without one, it shrinks by this factor (down to the minimum)
+SHRINK_AFTER = 60
+SHRINK_FACTOR = 0.9
+# arrivals to hold before appending them to the trace file (see record_trace())
+TRACE_FLUSH = 1000
+
+# decides how much audio the streamer saves up before it starts writing to the fifo. the
+# target is in milliseconds of audio rather than bytes, since the same number of bytes is a
+# very different amount of audio depending on the encoder's bitrate. the byte rate is measured
+# from the data as it arrives (the bitrate in mpd's status is just a first guess: it's the
+# bitrate of the file being played, not of the stream). every underrun makes the target
+# bigger (enough to have covered the gap that caused it), and a long time without one makes it
+# smaller again
+class jitter_buffer():
+    def __init__(self, target_ms, min_ms, max_ms):
+        self.target_ms = target_ms
+        self.min_ms = min_ms
+        self.max_ms = max_ms
+        self.estimated_rate = None # bytes per second, from mpd's status
+        self.measured_rate = None # bytes per second, from the data we've received
+        self.window_start = None
+        self.window_bytes = 0
+        self.last_change = None # when the target last grew or shrank
+        self.underruns = 0
+        self.trace_path = None # if set, every arrival is logged to it as "time,bytes", for bench.py
+        self.trace = [] # lines not yet written to it
+
+    def record_trace(self, path):
+        self.trace_path = path
+
+    # append the arrivals recorded so far to the trace file. the file's only open while that's
+    # done, so nothing's left open (or unwritten) however the streamer ends
+    def flush_trace(self):
+        if self.trace:
+            with open(self.trace_path, "a") as f:
+                f.writelines(self.trace)
+            self.trace = []
+
+    # bitrate in kbps, e.g. status.bitrate
+    def set_bitrate(self, kbps):
+        try:
+            kbps = int(kbps)
+        except (TypeError, ValueError):
+            return
+        if kbps > 0:
+            self.estimated_rate = kbps * 1000 / 8
+
+    def byte_rate(self):
+        if self.measured_rate != None:
+            return self.measured_rate
+        if self.estimated_rate != None:
+            return self.estimated_rate
+        return DEFAULT_BYTE_RATE
+
+    def target_bytes(self):
+        return int(self.byte_rate() * self.target_ms / 1000)
+
+    # the most we'll ever want to buffer, for sizing the buffer that holds it
+    def max_bytes(self, max_byte_rate):
+        return int(max_byte_rate * self.max_ms / 1000)
+
+    # called with every chunk we receive. `waited` is how many seconds we sat waiting for it
+    # while the player was being fed: if that's longer than the target, the player must
+    # have run dry
+    def record_arrival(self, nbytes, now, waited=0):
+        if self.trace_path != None:
+            self.trace.append("%f,%d\n" % (now, nbytes))
+            if len(self.trace) >= TRACE_FLUSH:
+                self.flush_trace()
+        if waited * 1000 > self.target_ms:
+            self.underrun(now, waited)
+        if self.window_start == None:
+            self.window_start = now
+            return
+        self.window_bytes += nbytes
+        elapsed = now - self.window_start
+        if elapsed >= RATE_WINDOW:
+            rate = self.window_bytes / elapsed
+            if self.measured_rate == None:
+                self.measured_rate = rate
+            else:
+                self.measured_rate += RATE_SMOOTHING * (rate - self.measured_rate)
+            self.window_start = now
+            self.window_bytes = 0
+        self.maybe_shrink(now)
+
+    # the stream stopped or paused, so start measuring the rate afresh
+    def reset_arrivals(self):
+        self.window_start = None
+        self.window_bytes = 0
+        if self.trace_path != None:
+            self.flush_trace()
+
+    # `gap` is how many seconds went by without data, if we know
+    def underrun(self, now, gap=0):
+        self.underruns += 1
+        self.target_ms = min(self.max_ms, max(self.target_ms * GROW_FACTOR, gap * 1000 * GAP_FACTOR))
+        self.last_change = now
+
+    def maybe_shrink(self, now):
+        if self.last_change == None:
+            self.last_change = now
+        elif now - self.last_change > SHRINK_AFTER and self.target_ms > self.min_ms:
+            self.target_ms = max(self.min_ms, self.target_ms * SHRINK_FACTOR)
+            self.last_change = now
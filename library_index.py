@@ -0,0 +1,174 @@
+# mpd-remote-streamer
+# Dylan Forbes
+# Computer Networks
+
+
+import sqlite3, re, threading
+import mpd_parser
+
+# the tags we keep for each song, and can search by
+TAGS = ["Artist", "Album", "AlbumArtist", "Title", "Genre", "Date", "Composer"]
+COLUMNS = [tag.lower() for tag in TAGS]
+# songs can have more than one of a tag (e.g. two Artists). they're all indexed, and shown
+# joined with this
+SEPARATOR = ", "
+# bumped whenever the schema changes: an index file from before that is rebuilt from scratch
+SCHEMA_VERSION = 2
+
+SCHEMA = """
+create table if not exists songs (
+    id integer primary key,
+    file text unique not null,
+    last_modified text,
+    %s
+);
+create table if not exists tokens (
+    token text not null,
+    tag text not null,
+    song integer not null references songs(id) on delete cascade
+);
+create table if not exists tag_values (
+    tag text not null,
+    value text not null,
+    song integer not null references songs(id) on delete cascade
+);
+""" % ",\n    ".join(column + " text" for column in COLUMNS)
+
+# the token index covers searches of one tag as well as all of them
+INDEXES = """
+create index if not exists tokens_by_token on tokens(token, tag);
+create index if not exists tokens_by_song on tokens(song);
+create index if not exists tag_values_by_value on tag_values(tag, value);
+create index if not exists tag_values_by_song on tag_values(song);
+"""
+
+def tokenize(value):
+    return set(re.findall(r"\w+", value.lower()))
+
+# local copy of the mpd database, built from listallinfo, so that searches don't have to go
+# to the server. every word of every tag is indexed, so we can do case-insensitive prefix
+# matching on any of them. when mpd's database changes, invalidate() marks the index stale
+# until it's been synced again: songs whose Last-Modified hasn't changed are left alone.
+# syncing a big library takes a while, so it's meant to be done on another thread; until
+# it's done, search() and find() return None, and the caller asks the server instead
+class library_index():
+    def __init__(self, path=":memory:"):
+        # used from whichever thread syncs it as well as the one searching it; self.lock
+        # keeps them apart
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("pragma foreign_keys = on")
+        if self.db.execute("pragma user_version").fetchone()[0] < SCHEMA_VERSION:
+            self.db.executescript("drop table if exists tokens; drop table if exists tag_values; drop table if exists songs;")
+            self.db.execute("pragma user_version = %d" % SCHEMA_VERSION)
+        self.db.executescript(SCHEMA)
+        self.db.executescript(INDEXES)
+        self.lock = threading.Lock()
+        self.stale = True
+        self.generation = 0 # bumped by every invalidate(), so a sync that's overtaken by one doesn't count
+
+    def invalidate(self):
+        self.generation += 1
+        self.stale = True
+
+    # sync with the (key, value) pairs of a listallinfo response. returns (added/changed, removed)
+    def sync(self, pairs):
+        generation = self.generation
+        with self.lock:
+            changed, removed = self.update(pairs)
+        # if mpd's database changed again while we were at it, we're still stale
+        self.stale = self.generation != generation
+        return changed, removed
+
+    def update(self, pairs):
+        known = dict(self.db.execute("select file, last_modified from songs"))
+        changed = 0
+        self.pending_tokens = []
+        self.pending_values = []
+        # building the indexes in one go at the end is much faster than updating them song by song
+        if not known:
+            for name in re.findall(r"create index if not exists (\w+)", INDEXES):
+                self.db.execute("drop index if exists " + name)
+        with self.db:
+            for record in mpd_parser.records(pairs, multiple=TAGS):
+                if "file" not in record:
+                    continue
+                last_modified = known.pop(record["file"], False)
+                if last_modified == record.get("Last-Modified"):
+                    continue
+                if last_modified != False:
+                    self.db.execute("delete from songs where file = ?", (record["file"],))
+                self.add_song(record)
+                changed += 1
+                if len(self.pending_tokens) > 10000:
+                    self.flush_tokens()
+            self.flush_tokens()
+            # whatever's left in `known` isn't in mpd's database anymore
+            self.db.executemany("delete from songs where file = ?", [(f,) for f in known])
+        self.db.executescript(INDEXES)
+        return changed, len(known)
+
+    # record is from mpd_parser.records(pairs, multiple=TAGS), so every tag is a list
+    def add_song(self, record):
+        values = [record.get(tag, []) for tag in TAGS]
+        song = self.db.execute("insert into songs (file, last_modified, %s) values (?, ?, %s)"
+                               % (", ".join(COLUMNS), ", ".join("?" * len(COLUMNS))),
+                               [record["file"], record.get("Last-Modified")]
+                               + [SEPARATOR.join(tag_values) or None for tag_values in values]).lastrowid
+        for column, tag_values in zip(COLUMNS, values):
+            tokens = set()
+            for value in tag_values:
+                self.pending_values.append((column, value, song))
+                tokens |= tokenize(value)
+            self.pending_tokens += [(token, column, song) for token in tokens]
+
+    # the tokens are inserted in batches, which is a lot faster than one song at a time
+    def flush_tokens(self):
+        self.db.executemany("insert into tokens (token, tag, song) values (?, ?, ?)", self.pending_tokens)
+        self.db.executemany("insert into tag_values (tag, value, song) values (?, ?, ?)", self.pending_values)
+        self.pending_tokens = []
+        self.pending_values = []
+
+    # case-insensitive search. every word in `query` has to be the beginning of some word
+    # in `tag` (any tag if tag is None). returns a list of dicts, like mpd_parser.records,
+    # or None if the index is stale (or being synced)
+    def search(self, tag, query):
+        where = []
+        args = []
+        for word in tokenize(query):
+            # prefix match on the token index: word <= token < word + the highest character
+            clause = "id in (select song from tokens where token >= ? and token < ?"
+            args += [word, word + "\U0010ffff"]
+            if tag != None:
+                clause += " and tag = ?"
+                args.append(tag.lower())
+            where.append(clause + ")")
+        if not where:
+            return []
+        return self.select(" and ".join(where), args)
+
+    # exact, case-sensitive match of any one of the song's values of `tag`, like mpd's find.
+    # returns None if we don't index `tag`, or the index is stale (or being synced)
+    def find(self, tag, value):
+        if tag.lower() not in COLUMNS:
+            return None
+        return self.select("id in (select song from tag_values where tag = ? and value = ?)", [tag.lower(), value])
+
+    def select(self, where, args):
+        if self.stale or not self.lock.acquire(blocking=False):
+            return None
+        try:
+            rows = self.db.execute("select file, %s from songs where %s order by file"
+                                   % (", ".join(COLUMNS), where), args).fetchall()
+        finally:
+            self.lock.release()
+        results = []
+        for row in rows:
+            record = {"file": row[0]}
+            for tag, value in zip(TAGS, row[1:]):
+                if value != None:
+                    record[tag] = value
+            results.append(record)
+        return results
+
+    def close(self):
+        self.db.close()
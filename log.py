@@ -0,0 +1,48 @@
+# mpd-remote-streamer
+# Dylan Forbes
+# Computer Networks
+
+
+# level 0 is errors (and the output of commands like find), 1 is what's going on, and 2-4 are
+# progressively noisier debugging. each subsystem ("main", "remote", "streamer", "player") has
+# its own level, set at startup (see mpdrs.py)
+DEFAULT_LEVEL = 1
+
+# debug output for one subsystem. call it with a level, a message, and the message's %-format
+# arguments: the message is only formatted if it's going to be printed, so a call at a level
+# that's turned off costs about as much as calling an empty function, even in the stream loop.
+# anything expensive to work out (e.g. decoding a chunk of data) should go in the arguments
+# as an object whose __str__/__repr__ does the work, or be guarded with enabled()
+class logger():
+    def __init__(self, name, level=None):
+        self.name = name
+        # (DEFAULT_LEVEL as it is now, not at import: set_all() changes it)
+        self.level = DEFAULT_LEVEL if level == None else level
+
+    def __call__(self, level, msg, *args):
+        if level <= self.level:
+            if args:
+                msg = msg % args
+            print(msg)
+
+    def enabled(self, level):
+        return level <= self.level
+
+loggers = {}
+
+def get(name):
+    if name not in loggers:
+        loggers[name] = logger(name)
+    return loggers[name]
+
+# e.g. set_levels({"remote": 2, "streamer": 1})
+def set_levels(levels):
+    for name, level in levels.items():
+        get(name).level = level
+
+# -1 turns everything off, even errors
+def set_all(level):
+    global DEFAULT_LEVEL
+    DEFAULT_LEVEL = level
+    for logger in loggers.values():
+        logger.level = level
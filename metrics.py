@@ -0,0 +1,189 @@
+# mpd-remote-streamer
+# Dylan Forbes
+# Computer Networks
+
+
+import threading, bisect, http.server
+
+# histogram buckets, in seconds: from well under a lan round trip up to a slow stream start
+LATENCY_BUCKETS = [0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10]
+# every metric's name starts with this, in the prometheus output
+PREFIX = "mpdrs_"
+
+# counters, gauges and histograms shared by the remote, the streamer and the player, for the
+# "stats" command and the prometheus endpoint. they're updated without locking, so updating one
+# costs about as much as incrementing an attribute. that's safe because every update happens on
+# the event loop (see engine.py), which is a single thread, so no two can race. the other
+# threads only read them: the REPL (for "stats") and the endpoint's server. a read that races an
+# update just sees the value from before it, or a histogram that's one observation out, which
+# is fine for statistics. (creating a metric does take the registry's lock, since that can
+# happen on any thread)
+
+class counter_metric():
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, n=1):
+        self.value += n
+
+class gauge_metric():
+    def __init__(self):
+        self.value = 0
+
+    def set(self, value):
+        self.value = value
+
+# a metric whose value is computed when it's read (e.g. how full a buffer is), so keeping it
+# up to date costs nothing
+class function_metric():
+    def __init__(self, fn):
+        self.fn = fn
+
+    @property
+    def value(self):
+        try:
+            return self.fn()
+        except Exception:
+            return 0
+
+class histogram_metric():
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.bounds = buckets
+        self.counts = [0] * (len(buckets) + 1) # the last one is everything above the biggest bound
+        self.count = 0
+        self.sum = 0
+        self.max = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.sum += value
+        if value > self.max:
+            self.max = value
+
+    # the upper bound of the bucket the given fraction of observations fall under
+    def quantile(self, q):
+        seen = 0
+        for bound, n in zip(self.bounds, self.counts):
+            seen += n
+            if seen >= q * self.count:
+                return bound
+        return self.max
+
+class registry():
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.families = {} # name -> [kind, help, {labels: metric}], kept in the order they were created
+
+    def get(self, kind, name, help, labels, make):
+        key = tuple(sorted(labels.items()))
+        family = self.families.get(name)
+        if family == None or key not in family[2]:
+            with self.lock:
+                family = self.families.setdefault(name, [kind, help, {}])
+                if key not in family[2]:
+                    family[2][key] = make()
+        return family[2][key]
+
+    def counter(self, name, help, **labels):
+        return self.get("counter", name, help, labels, counter_metric)
+
+    def gauge(self, name, help, **labels):
+        return self.get("gauge", name, help, labels, gauge_metric)
+
+    def histogram(self, name, help, buckets=LATENCY_BUCKETS, **labels):
+        return self.get("histogram", name, help, labels, lambda: histogram_metric(buckets))
+
+    # register (or replace) a metric computed by fn() whenever it's read
+    def function(self, kind, name, help, fn, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            self.families.setdefault(name, [kind, help, {}])[2][key] = function_metric(fn)
+
+    def items(self):
+        with self.lock:
+            return [(name, family[0], family[1], list(family[2].items())) for name, family in self.families.items()]
+
+    # human-readable, one line per metric, for the "stats" command
+    def report(self):
+        lines = []
+        for name, kind, help, metrics in self.items():
+            for labels, metric in metrics:
+                label = name + format_labels(labels)
+                if kind == "histogram":
+                    if metric.count == 0:
+                        continue
+                    lines.append("%-50s count %6d  mean %8.2f ms  p50 <= %g ms  p99 <= %g ms  max %8.2f ms"
+                                 % (label, metric.count, metric.sum / metric.count * 1000, metric.quantile(0.5) * 1000,
+                                    metric.quantile(0.99) * 1000, metric.max * 1000))
+                else:
+                    lines.append("%-50s %s" % (label, format_value(metric.value)))
+        return "\n".join(lines)
+
+    # the prometheus text exposition format
+    def prometheus(self):
+        lines = []
+        for name, kind, help, metrics in self.items():
+            name = PREFIX + name
+            lines.append("# HELP %s %s" % (name, help))
+            lines.append("# TYPE %s %s" % (name, kind))
+            for labels, metric in metrics:
+                if kind == "histogram":
+                    seen = 0
+                    for bound, n in zip(metric.bounds + ["+Inf"], metric.counts):
+                        seen += n
+                        lines.append("%s_bucket%s %d" % (name, format_labels(labels + (("le", str(bound)),)), seen))
+                    lines.append("%s_sum%s %s" % (name, format_labels(labels), format_value(metric.sum)))
+                    lines.append("%s_count%s %d" % (name, format_labels(labels), metric.count))
+                else:
+                    lines.append("%s%s %s" % (name, format_labels(labels), format_value(metric.value)))
+        return "\n".join(lines) + "\n"
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join('%s="%s"' % (k, str(v).replace("\\", "\\\\").replace('"', '\\"')) for k, v in labels) + "}"
+
+def format_value(value):
+    if isinstance(value, float):
+        return "%.6g" % value
+    return str(value)
+
+REGISTRY = registry()
+
+def counter(name, help, **labels):
+    return REGISTRY.counter(name, help, **labels)
+
+def gauge(name, help, **labels):
+    return REGISTRY.gauge(name, help, **labels)
+
+def histogram(name, help, buckets=LATENCY_BUCKETS, **labels):
+    return REGISTRY.histogram(name, help, buckets, **labels)
+
+def function(kind, name, help, fn, **labels):
+    REGISTRY.function(kind, name, help, fn, **labels)
+
+def report():
+    return REGISTRY.report()
+
+class metrics_handler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path != "/metrics":
+            self.send_error(404)
+            return
+        body = REGISTRY.prometheus().encode("UTF-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass # don't print every scrape over the prompt
+
+# serve the metrics at http://127.0.0.1:<port>/metrics, from a background thread
+def serve(port, address="127.0.0.1"):
+    server = http.server.ThreadingHTTPServer((address, port), metrics_handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
@@ -3,317 +3,800 @@
 # Computer Networks
 
 
-import sys, socket, os, multiprocessing, threading, time
+import sys, os, threading, time, shlex, re, asyncio, itertools
+import mpd_parser, mpd_status, metrics, log, supervisor, engine
+from playlist_cache import playlist_cache
+from library_index import library_index, tokenize
+from art_cache import art_cache
+
+# the subsystems we want to hear about on the idle connection
+IDLE_SUBSYSTEMS = ["player", "playlist", "mixer", "options", "database"]
+# the ones that mean we have to fetch the status again
+STATUS_SUBSYSTEMS = ["player", "playlist", "mixer", "options"]
+# album art comes in chunks of at most this many bytes (mpd's binarylimit; it sends 8192 unless
+# asked for more, and servers older than 0.22.4 can't be asked). the chunks after the first are
+# all requested in command lists, but no more than ART_WINDOW_BYTES of them at once: mpd drops
+# clients that leave more than max_output_buffer_size (8 MiB by default) of responses unread
+ART_CHUNK_BYTES = 262144
+ART_WINDOW_BYTES = 4194304
+DEFAULT_BINARY_LIMIT = 8192
+# where album art can come from: a cover file in the song's directory, or a picture embedded in it
+ART_COMMANDS = ["albumart", "readpicture"]
+# send_bulk's command lists are at most this long, and this many bytes: mpd refuses lists
+# bigger than its max_command_list_size (2 MiB by default)
+BULK_LIST_LENGTH = 1000
+BULK_LIST_BYTES = 1048576
+# where in a command list the command that failed was, and why: "ACK [50@3] {add} No such directory"
+ACK_PATTERN = re.compile(r"ACK \[\d+@(\d+)\] \{[^}]*\} ?(.*)")
+# the most we read from a connection at a time
+READ_BYTES = 65536
+
+debug = log.get("remote")
+
+# an argument for an mpd command, quoted so it can have spaces (and quotes) in it
+def quote(arg):
+    return '"%s"' % arg.replace("\\", "\\\\").replace('"', '\\"')
+
+# where the command list that starts at cmds[start] should end, so it's at most `length`
+# commands and BULK_LIST_BYTES bytes (but always at least one command)
+def list_end(cmds, start, length=BULK_LIST_LENGTH):
+    end = start
+    size = 0
+    while end < len(cmds) and end - start < length:
+        size += len(cmds[end].encode("UTF-8")) + 1
+        if size > BULK_LIST_BYTES and end > start:
+            break
+        end += 1
+    return end
+
+# one connection to the mpd server, on the event loop (see engine.py). mpd_client keeps two of
+# them: one that does nothing but sit in idle, and one for commands, so the two never get in
+# each other's way (and a third for syncing the library index)
+class mpd_connection():
+    def __init__(self, ip, port, name):
+        self.ip = ip
+        self.port = port
+        self.name = name
+        self.reader = None # asyncio streams, while we're connected
+        self.writer = None
+        self.parser = mpd_parser.response_parser()
+        self.protocol_version = None
+        self.binary_limit = None # the binarylimit we've asked for on this connection, if any
+
+    # raises ConnectionRefusedError (or some other OSError) if we can't connect
+    async def connect(self):
+        self.close()
+        debug(1, "remote: %s connection: connecting to mpd server...", self.name)
+        self.reader, self.writer = await engine.within(asyncio.open_connection(self.ip, self.port), supervisor.CONNECT_TIMEOUT)
+        self.parser.reset()
+        self.binary_limit = None
+        greeting = await self.readline()
+        if greeting == None or not greeting.startswith(b'OK MPD '):
+            self.close()
+            raise ConnectionError("unexpected greeting from mpd server: " + str(greeting))
+        self.protocol_version = tuple(int(n) for n in greeting[7:].decode("UTF-8").split("."))
+        debug(1, "remote: %s connection: connected to mpd server at %s:%s", self.name, self.ip, self.port)
+
+    async def reconnect(self):
+        debug(1, "remote: %s connection: connection to mpd server lost, reconnecting...", self.name)
+        metrics.counter("mpd_reconnects_total", "reconnections to mpd after losing the connection", connection=self.name).inc()
+        await self.connect()
+
+    # (anything waiting to read from the connection gets the end of it)
+    def close(self):
+        if self.writer:
+            self.writer.close()
+            self.reader = None
+            self.writer = None
+
+    # whether the connection still looks usable: mpd closes connections that sit around too long
+    # without being in idle (connection_timeout), and we'd only find out after sending a command.
+    # the loop notices the end of the connection as soon as it arrives, so that's all we check
+    def alive(self):
+        return self.writer != None and not self.writer.is_closing() and not self.reader.at_eof()
+
+    async def read(self):
+        try:
+            return await self.reader.read(READ_BYTES)
+        except (OSError, AttributeError): # AttributeError: the connection was closed under us
+            return b''
+
+    async def readline(self):
+        while True:
+            line = self.parser.readline()
+            if line != None:
+                return line
+            data = await self.read()
+            if not data:
+                return None
+            self.parser.feed(data)
+
+    async def send(self, msg):
+        if self.writer == None:
+            raise ConnectionError("not connected")
+        self.writer.write((msg + "\n").encode("UTF-8"))
+        await self.writer.drain()
+
+    # read one whole response. returns (response code ("OK" | "ACK ..." | None if the connection
+    # was lost), list of (key, value) pairs)
+    async def response(self):
+        self.parser.code = None
+        pairs = []
+        while True:
+            pair = self.parser.next_pair()
+            if pair is mpd_parser.END:
+                return (self.parser.code, pairs)
+            if pair is None:
+                data = await self.read()
+                if not data:
+                    return (None, pairs)
+                self.parser.feed(data)
+            else:
+                pairs.append(pair)
+
+    # generator over the (key, value) pairs of one response, in batches (lists): whatever's
+    # complete after each read. taking them a read's worth at a time keeps the cost of going
+    # through the loop down to one resumption per read, rather than one per pair. when it's
+    # exhausted, self.parser.code holds the line that terminated the response
+    async def batches(self):
+        self.parser.code = None
+        while True:
+            batch = []
+            while True:
+                pair = self.parser.next_pair()
+                if pair is None or pair is mpd_parser.END:
+                    break
+                batch.append(pair)
+            if batch:
+                yield batch
+            if pair is mpd_parser.END:
+                return
+            data = await self.read()
+            if not data:
+                return
+            self.parser.feed(data)
 
 class mpd_client():
 
-    def __init__(self, ip, port, debuglevel):
-        self.status = self.status()
+    def __init__(self, ip, port):
+        self.status = mpd_status.mpd_status()
+        self.song_key = None # (songid, queue cache version) the song tags in self.status are for
+        self.subscribers = [] # (callback, fields), see subscribe()
+        metrics.function("gauge", "mpd_elapsed_drift_seconds", "how far mpd's elapsed time was from the one worked out locally, at the last refresh",
+                         lambda: self.status.drift)
         self.ip = ip
         self.port = port
-        self.idler_receiver = threading.Thread(target=self.keep_idle_and_receive)
-        self.from_idler_receiver, self.from_remote = multiprocessing.Pipe()
+        self.cmd_conn = mpd_connection(ip, port, "command")
+        self.idle_conn = mpd_connection(ip, port, "idle")
+        self.parser = self.cmd_conn.parser
+        self.playlist = playlist_cache()
+        self.library = None # optional local library_index, see enable_library_index()
+        self.library_conn = mpd_connection(ip, port, "library") # what the library index is synced over
+        self.library_syncer = None # the task syncing it, while one is
+        self.art = None # optional art_cache, see enable_art_cache()
+        # everything here runs on the event loop; the ui reaches it through engine.blocking()
+        self.engine = engine.get()
+        self.idler = None # the task keeping the idle connection in idle
         self.quitting = threading.Event()
-        self.status_changed = threading.Event()
-        self.expecting_status_change = False
-        self.idle_lock = threading.Lock()
-        self.idle = False
-        self.waiting = False
-        self.debuglevel = debuglevel
-
-    def print_debug(self, msg, level):
-        if level <= self.debuglevel:
-            print(msg)
-    
-    class status():
-        def __init__(self):
-            self.volume = None
-            self.repeat = None
-            self.single = None
-            self.consume = None
-            self.playlist = None
-            self.playlistlength = None
-            self.mixrampdb = None
-            self.state = None
-            self.song = None
-            self.songid = None
-            self.time = None
-            self.elapsed = None
-            self.bitrate = None
-            self.audio = None
-            self.nextsong = None
-            self.nextsongid = None
-            # ones I'm adding
-            self.song_title = None
-            self.song_artist = None
-            self.song_album = None
-
-    def recv_all(self):
-        data_parsed = [b'']
-        done = False
-        while not done:
-            self.print_debug("remote: receiving from mpd server via pipe...", 3)
-            new_bytes = self.from_remote.recv_bytes()
-            self.print_debug(new_bytes, 4)
-            data_parsed_chunks = new_bytes.split(b'\n')
-            data_parsed[-1] += data_parsed_chunks.pop(0)
-            data_parsed += data_parsed_chunks
-            if len(new_bytes) == 0:
-                done = True
-                response_type = None
-                break
-            if data_parsed[-1] == b'':
-                response_type = data_parsed[-2][:3].strip()
-                if response_type in [b'OK', b'ACK']:
-                    done = True
-                    break
-        if response_type == None:
-            self.print_debug("remote: connection to mpd server lost!", 1)
-            self.quitting.set()
-            self.idler_receiver.join()
-            self.quitting.clear()
-            self.idler_receiver = threading.Thread(target=self.keep_idle_and_receive)
-            self.connect_to_server()
-            return None, None
-        response_list = b'\n'.join(data_parsed).decode("UTF-8").split('\n') # this is the dumbest stream of method calls I've ever written 
-        response_list.pop() # remove newline at end
-        return (response_list.pop(), response_list) # returns (response code ("OK ..." | "ACK ..."), response message)
-
-    # child thread, responsible for constantly receiving from the socket and feeding to the pipe
-    # which the parent thread reads from. it also has the job of checking if the status has changed while we're idle,
-    # and re-sending the idle (but only if the parent thread isn't currently in wait())
-    def keep_idle_and_receive(self):
+        # the idler adds to changed_subsystems and notifies whenever mpd reports a change
+        self.changes = engine.condition()
+        self.changed_subsystems = set()
+        # the command connection is shared by the ui's commands and anyone watching for changes
+        self.cmd_lock = engine.task_lock()
+        # when the command connection is lost and can't be got back straight away, this keeps
+        # trying in the background, and commands fail right away until it's back
+        self.health = supervisor.supervisor("mpd", self.reconnect_in_background)
+        self.health.on_recovered(self.resync)
+
+    # read one whole response from the command connection
+    async def recv_all(self):
+        debug(3, "remote: receiving from mpd server...")
+        return await self.cmd_conn.response() # (response code ("OK" | "ACK ..." | None if the connection was lost), list of (key, value) pairs)
+
+    # the idler task, which keeps the idle connection in idle and records (and notifies about)
+    # every subsystem mpd tells us changed. it never touches the command connection. quit()
+    # cancels it, wherever it's waiting
+    async def keep_idle(self):
         while not self.quitting.is_set():
             try:
-                try:
-                    self.print_debug("remote: idler-receiver: receiving data...", 3) 
-                    data = self.mpd_sock.recv(4096)
-                    self.idle = False
-                    self.print_debug("remote: idler-receiver: received data:\n" + data.decode("UTF-8"), 3) 
-                except:
-                    data = b''
-            except KeyboardInterrupt:
-                break
-            if not data:
-                self.print_debug("remote: idler-receiver: error receiving from mpd socket!", 0) 
-                self.print_debug("remote: idler-receiver: re-establishing connection...", 0) 
-                self.connect_to_server()
+                await self.idle_conn.send("idle " + " ".join(IDLE_SUBSYSTEMS))
+                code, response = await self.idle_conn.response()
+            except OSError:
+                code = None
+            if code == None:
+                debug(0, "remote: idler: error receiving from mpd socket!") 
+                # try once straight away (mpd might just have dropped the connection); if that
+                # fails, let the supervisor find out when mpd is back, rather than keep trying here
+                if not await self.reconnect_idle_conn():
+                    self.health.lost()
+                    if not await self.health.wait_up() or not await self.reconnect_idle_conn():
+                        continue
+                # we might have missed something while we were disconnected
+                self.notify_changed(IDLE_SUBSYSTEMS)
                 continue
-            
-            if data.find(b"changed: ") == 0:
-                self.print_debug("remote: idler-receiver: status changed after idle!", 4)
-                self.status_changed.set()
-                if not self.waiting:
-                    self.print_debug("remote: idler-receiver: we're not waiting, so go ahead and send idle", 4) 
-                    self.send_cmd_raw("idle")
-                    self.idle = True
-            else:
-                self.print_debug("remote: idler-receiver: sending data to parent thread...", 3) 
-                self.from_idler_receiver.send_bytes(data)
-        self.print_debug("remote: idler-receiver: quitting flag set, exiting thread!", 3) 
-
-    # called before displaying the command prompt
-    # checks to see if we need to fetch the status of the mpd server,
-    # which is indicated by the fact that we have received something after sending
-    # "idle"--this only happens when the server's status changed (e.g. the track changed)
-    # if we don't notice a change w/in 50ms then we just give up, we don't want to force
-    # the user to wait just because the server is slow. it might be that the last command called
-    # didn't actually change the status at all (e.g. calling "stop" when we're already stopped)
-    def wait(self, ms=50):
-        self.waiting = True
-        while self.expecting_status_change:
-            if self.status_changed.is_set():
-                while self.status_changed.is_set():
-                    self.print_debug("remote: wait: status changed after idle, retrieving status...", 3)
-                    self.retrieve_status()
-                    self.status_changed.clear()
-                    self.expecting_status_change = False
-            else:
-                if ms == 0:
-                    break
-                else:
-                    time.sleep(.001)
-                    ms -= 1
-        self.waiting = False
+            changed = [value for key, value in response if key == "changed"]
+            if changed:
+                debug(4, "remote: idler: changed: %s", ", ".join(changed))
+                metrics.counter("mpd_idle_wakeups_total", "times the idle connection reported changes").inc()
+                for subsystem in changed:
+                    metrics.counter("mpd_idle_changes_total", "changes reported by idle, by subsystem", subsystem=subsystem).inc()
+                self.notify_changed(changed)
 
-    def connect_to_server(self):
+    async def reconnect_idle_conn(self):
+        if self.quitting.is_set():
+            return False
         try:
-            self.mpd_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            self.print_debug("remote: connecting to mpd server...", 1)
-            self.mpd_sock.connect((self.ip, self.port))
-        except ConnectionRefusedError:
-            self.print_debug("remote: connection refused!", 0)
-            self.quit()
-            sys.exit(1)
-        response = self.mpd_sock.recv(1024)
-        self.print_debug(response, 3)
-        if response != b'':
-            self.print_debug("remote: connected to mpd server at %s:%s" % (self.ip, self.port), 1)
-            self.send_cmd_raw("idle")
-            self.idle = True
-            if not self.idler_receiver.is_alive():
-                self.idler_receiver.start()
-        else:
-            self.print_debug("remote: something went wrong!", 0)
-            self.print_debug(response.decode("UTF-8"), 0)
-            self.quit()
-            sys.exit(1)
+            await self.idle_conn.reconnect()
+            return True
+        except OSError:
+            debug(0, "remote: idler: failed to reconnect!")
+            self.idle_conn.close()
+            return False
+
+    def notify_changed(self, subsystems):
+        if self.library != None and "database" in subsystems:
+            self.library.invalidate()
+            self.sync_library_in_background()
+        self.changed_subsystems.update(subsystems)
+        self.changes.notify_all()
+
+    # waits until mpd reports a change to one of `subsystems` (any subsystem if None), and
+    # returns the ones that changed since the last call. returns an empty set if we're
+    # quitting or `timeout` (in seconds) runs out first; timeout=0 just checks
+    async def wait_for_change(self, subsystems=None, timeout=None):
+        def pending():
+            if subsystems == None:
+                return set(self.changed_subsystems)
+            return self.changed_subsystems.intersection(subsystems)
+        await self.changes.wait_for(lambda: pending() or self.quitting.is_set(), timeout)
+        changed = pending()
+        self.changed_subsystems -= changed
+        return changed
+
+    # called before displaying the command prompt. if the idle connection has told us the
+    # status changed since we last fetched it, fetch it again. this never blocks waiting
+    # for a change: commands that change the status already refresh it themselves
+    async def wait(self):
+        if await self.wait_for_change(STATUS_SUBSYSTEMS, timeout=0):
+            debug(3, "remote: wait: status changed after idle, retrieving status...")
+            await self.retrieve_status()
+
+    # returns whether we're connected. if we aren't, we keep trying in the background
+    async def connect_to_server(self):
+        try:
+            await self.cmd_conn.connect()
+            await self.idle_conn.connect()
+        except OSError as e:
+            if isinstance(e, ConnectionRefusedError):
+                debug(0, "remote: connection refused! retrying in the background...")
+            else:
+                debug(0, "remote: couldn't connect to mpd (%s)! retrying in the background...", e)
+            self.cmd_conn.close()
+            self.idle_conn.close()
+            self.health.lost()
+        if self.idler == None:
+            self.idler = self.engine.loop.create_task(self.keep_idle())
+        return self.health.up()
+
+    # just the command connection, for batch.py, which has no use for the idler. raises OSError
+    # if we can't connect
+    async def connect_cmd_conn(self):
+        await self.cmd_conn.connect()
+
+    # the supervisor's attempts to get the command connection back (the idler gets its own back)
+    async def reconnect_in_background(self):
+        async with self.cmd_lock:
+            await self.cmd_conn.connect()
+
+    # after an outage, mpd might have been restarted (and its queue versions started over), so
+    # don't trust anything we had: fetch the whole queue again, and have the status refreshed
+    def resync(self):
+        debug(1, "remote: reconnected to mpd server")
+        self.playlist.version = None
+        self.song_key = None
+        self.notify_changed(IDLE_SUBSYSTEMS)
     
-    def send_cmd_raw(self, cmd):
-        if cmd == "idle" or cmd == "noidle":
-            debuglevel = 3
-        else:
-            debuglevel = 1
-        self.print_debug("remote: sending message to mpd server: " + cmd, debuglevel)
-        self.mpd_sock.sendall((cmd + "\n").encode("UTF-8"))
-
-    # wrapper for send that makes sure we always end up in an idle state, so the server doesn't disconnect us
-    def send_cmd(self, cmd):
-        if self.idle:
-            self.send_cmd_raw("noidle")
-            self.idle = False
-            self.recv_all() # get the OK from the server
-        self.send_cmd_raw(cmd)
-        self.print_debug("remote: waiting for response from server...", 1) 
-        code, response = self.recv_all()
-        if not self.idle:
-            self.send_cmd_raw("idle")
-            self.idle = True
+    async def send_cmd_raw(self, cmd):
+        debug(1, "remote: sending message to mpd server: %s", cmd)
+        await self.cmd_conn.send(cmd)
+
+    # sends cmd on the command connection and reads the response. mpd drops connections that
+    # sit around without being in idle, so if the connection turns out to be gone before we
+    # send anything, we reconnect first (see send_safely)
+    async def send_cmd(self, cmd):
+        async with self.cmd_lock:
+            return await self.send_cmd_locked(cmd)
+
+    async def send_cmd_locked(self, cmd):
+        start = time.monotonic()
+        if not await self.send_safely(cmd):
+            return (None, None)
+        debug(1, "remote: waiting for response from server...") 
+        code, response = await self.recv_all()
+        if code == None:
+            await self.reply_lost()
+            return (None, None)
+        self.observe_command(cmd, "single", start)
         return (code, response)
 
-    def retrieve_status(self):
-        self.status.__init__() # clear status, so ones that aren't filled out by this process are known to have a null value
-        code, resp = self.send_cmd("status")
-        if code != "OK":
-            self.print_debug("remote: failed to fetch status!", 1)
-            self.print_debug(code, 1)
+    # send `msg` on the command connection, reconnecting first if mpd has closed it. it's only
+    # sent again if it can't have got to mpd (sending it failed), never once a reply has been
+    # waited for: by then mpd might have run it, and commands like next and add mustn't run
+    # twice. returns False if it couldn't be sent
+    async def send_safely(self, msg):
+        for attempt in range(2):
+            if not self.health.up():
+                return False
+            if self.cmd_conn.alive():
+                try:
+                    await self.send_cmd_raw(msg)
+                    return True
+                except OSError:
+                    pass
+            if not await self.reconnect_cmd_conn():
+                return False
+        return False
+
+    # the connection went away partway through a reply. whatever was sent isn't sent again
+    # (see send_safely); just get the connection back for the next command
+    async def reply_lost(self):
+        debug(0, "remote: lost the connection to mpd while waiting for a reply!")
+        await self.reconnect_cmd_conn()
+
+    # record how long a command took, from sending it to having read the whole response
+    def observe_command(self, cmd, kind, start):
+        metrics.histogram("mpd_command_seconds", "round trip time of commands to mpd (for a command list, by its first command)",
+                          command=cmd.split(" ", 1)[0], kind=kind).observe(time.monotonic() - start)
+
+    # try once to get the command connection back. if that doesn't work, the supervisor takes
+    # over, so this never holds up the ui for more than a connect timeout. returns whether it worked
+    async def reconnect_cmd_conn(self):
+        if not self.health.up():
+            return False
+        try:
+            await self.cmd_conn.reconnect()
+            return True
+        except OSError:
+            debug(0, "remote: failed to reconnect to mpd server! retrying in the background...")
+            self.cmd_conn.close()
+            self.health.lost()
+            return False
+
+    # like send_cmd, but yields the (key, value) pairs of the response as they arrive, in
+    # batches (see mpd_connection.batches), instead of collecting them. once it's exhausted,
+    # self.parser.code holds the response code. it has the command connection to itself until
+    # then, so it has to be run to the end (or closed)
+    async def iter_cmd(self, cmd):
+        async with self.cmd_lock:
+            if not self.health.up():
+                self.parser.code = None
+                return
+            start = time.monotonic()
+            if not await self.send_safely(cmd):
+                self.parser.code = None
+                return
+            debug(1, "remote: waiting for response from server...") 
+            batches = self.cmd_conn.batches()
+            try:
+                async for batch in batches:
+                    yield batch
+            finally:
+                # if the caller stopped early, skip the rest of the response
+                async for batch in batches:
+                    pass
+                if self.parser.code == None:
+                    await self.reply_lost()
+                else:
+                    self.observe_command(cmd, "stream", start)
+
+    # sends all of `cmds` as one command list in a single write, so the whole thing costs one
+    # round trip. returns a list with a (code, list of (key, value) pairs) tuple for each
+    # command that mpd ran. if one fails, mpd skips the rest, so the list ends with the ACK.
+    # returns None if the connection was lost
+    async def send_cmd_list(self, cmds):
+        async with self.cmd_lock:
+            return await self.send_cmd_list_locked(cmds)
+
+    async def send_cmd_list_locked(self, cmds):
+        msg = "command_list_ok_begin\n" + "\n".join(cmds) + "\ncommand_list_end"
+        start = time.monotonic()
+        if not await self.send_safely(msg):
+            return None
+        results = await self.recv_cmd_list(cmds)
+        if results == None:
+            await self.reply_lost()
+            return None
+        self.observe_command(cmds[0], "list", start)
+        return results
+
+    async def recv_cmd_list(self, cmds):
+        results = []
+        for cmd in cmds:
+            code, response = await self.recv_all()
+            if code == None:
+                return None
+            if code.startswith("ACK"):
+                results.append((code, response))
+                return results
+            results.append(("OK", response))
+        # the OK for the list as a whole
+        if (await self.recv_all())[0] == None:
+            return None
+        return results
+
+    # runs a lot of commands (e.g. adding a whole playlist's worth of songs) in as few command
+    # lists as it can, one list in flight at a time. mpd stops a list at the first command that
+    # fails, so the rest of it is sent again in the next one. returns a list of (index in cmds,
+    # error message) for the commands that failed. the commands aren't sent again if the
+    # connection is lost partway through a list (some of it might have run), so the rest of them
+    # fail with "lost the connection to mpd"
+    async def send_bulk(self, cmds):
+        async with self.cmd_lock:
+            return await self.send_bulk_locked(cmds)
+
+    async def send_bulk_locked(self, cmds):
+        failures = []
+        # a cheap command first, which reconnects if mpd has dropped the connection in the meantime
+        if (await self.send_cmd_locked("ping"))[0] == None:
+            return [(i, "lost the connection to mpd") for i in range(len(cmds))]
+        start = 0
+        while start < len(cmds):
+            end = list_end(cmds, start)
+            sent = time.monotonic()
+            try:
+                await self.send_cmd_raw("command_list_begin\n" + "\n".join(cmds[start:end]) + "\ncommand_list_end")
+                code = (await self.recv_all())[0]
+            except OSError:
+                code = None
+            if code == None:
+                failures += [(i, "lost the connection to mpd") for i in range(start, len(cmds))]
+                await self.reconnect_cmd_conn()
+                break
+            self.observe_command(cmds[start], "bulk", sent)
+            if code.startswith("ACK"):
+                match = ACK_PATTERN.match(code)
+                failed = start + int(match.group(1)) if match else start
+                failures.append((failed, match.group(2) if match else code))
+                start = failed + 1
+            else:
+                start = end
+        return failures
+
+    # call callback(status, changed) whenever a refresh changes any of `fields` (any field if
+    # None), with the set of fields that changed. it's called on the loop, with the command
+    # connection locked
+    def subscribe(self, callback, fields=None):
+        self.subscribers.append((callback, None if fields == None else set(fields)))
+
+    def notify(self, changed):
+        for callback, fields in self.subscribers:
+            if changed and (fields == None or changed & fields):
+                callback(self.status, changed)
+
+    # returns the set of status fields that changed
+    async def retrieve_status(self):
+        async with self.cmd_lock:
+            return await self.retrieve_status_locked()
+
+    async def retrieve_status_locked(self):
+        cmds = self.refresh_cmds()
+        results = await self.send_cmd_list(cmds)
+        if results == None or len(results) != len(cmds):
+            debug(1, "remote: failed to fetch status!")
+            if results:
+                debug(1, results[-1][0])
+            return set()
+        return await self.parse_status(*[response for code, response in results])
+
+    # the commands that fetch the status, plus whatever changed in the queue since we last looked
+    def refresh_cmds(self):
+        cmds = ["status"]
+        changes_cmd = self.playlist.changes_cmd()
+        if changes_cmd != None:
+            cmds.append(changes_cmd)
+        return cmds
+
+    # runs a command that changes the player/playlist, and fetches the new status in the same round trip
+    async def run_and_refresh(self, cmd):
+        async with self.cmd_lock:
+            return await self.run_and_refresh_locked(cmd)
+
+    async def run_and_refresh_locked(self, cmd):
+        cmds = [cmd] + self.refresh_cmds()
+        results = await self.send_cmd_list(cmds)
+        if results == None:
+            return False
+        if results[0][0] != "OK":
+            debug(1, "remote: error executing command!")
+            debug(1, "mpd: %s", results[0][0])
+            return False
+        if len(results) == len(cmds):
+            await self.parse_status(*[response for code, response in results[1:]])
+        return True
+
+    # apply a status response (and the queue changes fetched with it), and tell the subscribers
+    # what changed. returns the set of fields that changed
+    async def parse_status(self, resp, playlist_changes=None): 
+        changed = self.status.update(resp)
+        await self.sync_playlist(playlist_changes)
+        # the current song's tags only have to be looked up again if it's a different song, or the queue changed
+        song_key = (self.status.songid, self.playlist.version)
+        if song_key != self.song_key:
+            self.song_key = song_key
+            songid = self.status.songid
+            changed |= self.status.set_song(self.playlist.song(str(songid)) if songid != None else None)
+        self.notify(changed)
+        return changed
+
+    # bring the queue cache up to the version in self.status, using the response to
+    # self.playlist.changes_cmd() if we have one
+    async def sync_playlist(self, changes):
+        if self.status.playlist == None:
             return
-        self.parse_status(resp)
-    
-    def parse_status(self, resp): 
-        status = resp
-        # parse response, assign to attributes of self.status
-        for i in range(len(status)):
-            status[i] = status[i].split(": ")
-        for attr in status:
-            setattr(self.status, attr[0], attr[1])
-        # get info about current playing song
-        if self.status.song != None:
-            code, resp = self.send_cmd("playlistid " + self.status.songid)
-            if code != "OK":
-                self.print_debug("remote: failed to fetch info about current song!", 1)
-                self.print_debug("mpd: " + code)
-            cur_song_info = self.parse_song_info(resp)
-            if "Title" in cur_song_info:
-                self.status.song_title = cur_song_info["Title"]
-            if "Artist" in cur_song_info:
-                self.status.song_artist = cur_song_info["Artist"]
-            if "Album" in cur_song_info:
-                self.status.song_album = cur_song_info["Album"]
+        version = self.status.playlist
+        if self.playlist.version == version:
             return
+        missing = None
+        if changes != None:
+            missing = self.playlist.apply_changes(changes, version, self.status.playlistlength or 0)
+        if missing == None:
+            debug(2, "remote: fetching the whole playlist...")
+            songs = []
+            grouper = mpd_parser.record_grouper()
+            async for batch in self.iter_cmd("playlistinfo"):
+                songs += grouper.feed(batch)
+            songs += grouper.finish()
+            self.playlist.replace(songs, version)
+            if self.parser.code != "OK":
+                self.playlist.version = None # try again next time
+        elif missing:
+            debug(2, "remote: fetching %d new songs in the playlist...", len(missing))
+            results = await self.send_cmd_list(["playlistid " + songid for songid in missing])
+            if results == None or len(results) != len(missing) or results[-1][0] != "OK":
+                self.playlist.version = None # the playlist changed under us; start over next time
+            if results != None:
+                self.playlist.add_songs(dict(response) for code, response in results if code == "OK")
 
-    def parse_song_info(self, info_list):
-        info = {}
-        for item in info_list:
-            item_split = item.split(": ")
-            info[item_split[0]] = item_split[1]
-        return info
+    async def play(self):
+        await self.run_and_refresh("play")
 
-    def play(self):
-        self.send_cmd("play")
-        self.expecting_status_change = True
+    async def pause(self):
+        await self.run_and_refresh("pause 1")
 
-    def pause(self):
-        self.send_cmd("pause 1")
-        self.expecting_status_change = True
+    async def stop(self):
+        await self.run_and_refresh("stop")
 
-    def stop(self):
-        self.send_cmd("stop")
-        self.expecting_status_change = True
+    async def prev(self):
+        await self.run_and_refresh("previous")
 
-    def prev(self):
-        self.send_cmd("previous")
-        self.expecting_status_change = True
+    async def next_(self):
+        await self.run_and_refresh("next")
 
-    def next_(self):
-        self.send_cmd("next")
-        self.expecting_status_change = True
+    async def clear(self):
+        await self.run_and_refresh("clear")
 
-    def clear(self):
-        self.send_cmd("clear")
-        self.expecting_status_change = True
+    async def findadd(self, findcmd):
+        await self.run_and_refresh(findcmd)
 
-    def findadd(self, findcmd):
-        code, resp = self.send_cmd(findcmd)
-        if code != "OK":
-            self.print_debug("remote: error executing command!", 1)
-            self.print_debug("mpd: " + str(code), 1)
+    # keep a local copy of the library (at `path`, or in memory), so that find and search
+    # don't have to go to the server. it's synced in the background, on a connection of its own,
+    # when it's first needed and whenever mpd's database changes after that. find and search
+    # go to the server until it's done, so a big library never holds up the command connection
+    def enable_library_index(self, path=":memory:"):
+        self.library = library_index(path)
+
+    def sync_library_in_background(self):
+        if not self.library.stale or self.quitting.is_set():
             return
-        self.expecting_status_change = True
+        if self.library_syncer != None and not self.library_syncer.done():
+            return # it keeps going until the index isn't stale
+        self.library_syncer = self.engine.loop.create_task(self.sync_library())
+
+    # waits for the background sync, if there's one going
+    async def wait_for_library(self):
+        if self.library_syncer != None:
+            await asyncio.shield(self.library_syncer)
+
+    # bring the library index up to date with mpd's database (again, if it changes while we're at
+    # it). returns once it's done; see sync_library_in_background(). returns False if we couldn't.
+    # sqlite does the work on a thread of the loop's executor, taking the pairs from the
+    # connection (which stays on the loop) as it goes, so the loop carries on meanwhile
+    async def sync_library(self):
+        while self.library.stale and not self.quitting.is_set():
+            debug(1, "remote: syncing library index...")
+            start = time.monotonic()
+            try:
+                await self.library_conn.connect()
+                await self.library_conn.send("listallinfo")
+                pairs = itertools.chain.from_iterable(self.engine.iterate(self.library_pairs()))
+                changed, removed = await self.engine.loop.run_in_executor(None, self.library.sync, pairs)
+            except OSError:
+                debug(0, "remote: failed to sync library index!")
+                debug(1, "mpd: %s", self.library_conn.parser.code)
+                return False
+            finally:
+                self.library_conn.close()
+            debug(1, "remote: library index synced in %.1f s (%d songs added or changed, %d removed)",
+                  time.monotonic() - start, changed, removed)
+        return not self.library.stale
+
+    # the pairs of the listallinfo response on the library connection. raises OSError at the end
+    # if it didn't finish, so the index doesn't take the songs it didn't get to as deleted
+    async def library_pairs(self):
+        async for batch in self.library_conn.batches():
+            yield batch
+        if self.library_conn.parser.code != "OK":
+            raise ConnectionError("listallinfo failed")
 
-    def find(self, findcmd):
-        code, resp = self.send_cmd(findcmd)
+    # keep the album art we fetch in the directory at `path`, using up to `max_bytes`
+    def enable_art_cache(self, path, max_bytes):
+        self.art = art_cache(path, max_bytes)
+
+    # the album art for the song at `uri`, whose Last-Modified is `mtime`, from the cache if
+    # it's there. returns the file it's in, or None if there isn't any (or it can't be cached)
+    async def album_art(self, uri, mtime):
+        path = self.art.get(uri, mtime)
+        if path != None:
+            return path
+        data = await self.fetch_art(uri)
+        if data == None:
+            return None
+        return self.art.put(uri, mtime, data)
+
+    # fetch the album art for the song at `uri` from mpd. returns the image, or None if it hasn't got any
+    async def fetch_art(self, uri, chunk_bytes=ART_CHUNK_BYTES):
+        async with self.cmd_lock:
+            start = time.monotonic()
+            for command in ART_COMMANDS:
+                data = await self.fetch_binary(command, uri, chunk_bytes)
+                if data != None:
+                    metrics.counter("mpd_art_bytes_total", "bytes of album art fetched from mpd").inc(len(data))
+                    metrics.histogram("mpd_art_seconds", "time to fetch a piece of album art from mpd").observe(time.monotonic() - start)
+                    return data
+        return None
+
+    # the largest binary chunk mpd will send us on the command connection, asking for `wanted`
+    # if we haven't already. the limit lasts until the connection is closed
+    async def negotiate_binary_limit(self, wanted):
+        conn = self.cmd_conn
+        if conn.binary_limit == wanted:
+            return wanted
+        if conn.protocol_version != None and conn.protocol_version < (0, 22, 4):
+            return DEFAULT_BINARY_LIMIT
+        code, response = await self.send_cmd_locked("binarylimit %d" % wanted)
         if code != "OK":
-            self.print_debug("remote: error executing command!", 1)
-            self.print_debug("mpd: " + str(code), 1)
-            return
-        # get the results!
-        results = []
-        item = {}
-        for pair in resp:
-            temp = pair.split(": ")
-            key, value = temp[0], ": ".join(temp[1:])
-            if key in ["Title", "Artist", "Album"]:
-                item[key] = value
-            if item != {} and key == "file":
-                item = item["Artist"] + "\t\t" + (item["Album"] if "Album" in item else "[no album]") + "\t\t" + item["Title"]
-                results.append(item)
-                item = {}
-        item = item["Artist"] + "\t\t" + item["Album"] + "\t\t" + item["Title"]
-        results.append(item)
-        self.print_debug("\n".join(results), 0)
-
-    def playlistinfo(self):
-        code, resp = self.send_cmd("playlistinfo")
+            debug(1, "remote: mpd refused binarylimit %d: %s", wanted, code)
+            return DEFAULT_BINARY_LIMIT
+        conn.binary_limit = wanted
+        return wanted
+
+    # the whole of a binary response (albumart or readpicture) that mpd sends in chunks. the first
+    # one says how big the whole thing is; the rest are then requested a window at a time.
+    # returns None if mpd hasn't got it (or the connection was lost)
+    async def fetch_binary(self, command, uri, chunk_bytes):
+        limit = await self.negotiate_binary_limit(chunk_bytes)
+        cmd = command + " " + quote(uri) + " %d"
+        code, response = await self.send_cmd_locked(cmd % 0)
         if code != "OK":
-            self.print_debug("remote: error executing command!", 0)
-            self.print_debug("mpd: " + str(code), 1)
-        # parse response
-        playlist = []
-        item = {}
-        for pair in resp:
-            temp = pair.split(": ")
-            key, value = temp[0], ": ".join(temp[1:])
-            if key in ["Title", "Artist", "Album", "Track"]:
-                item[key] = value
-            if key == "Id":
-                item = item["Track"] + "\t" + item["Artist"] + "\t\t" + item["Album"] + "\t\t" + item["Title"]
-                playlist.append(item)
-                item = {}
-        if playlist:
-            self.print_debug("\n".join(playlist), 0)
-        else:
-            self.print_debug("[playlist empty]", 0)
+            debug(2, "remote: %s: %s", command, code)
+            return None
+        response = dict(response)
+        if "size" not in response:
+            return None # readpicture's answer when there's no picture
+        size = int(response["size"])
+        data = bytearray(response.get("binary", b''))
+        while len(data) < size:
+            offsets = range(len(data), size, limit)[:max(1, ART_WINDOW_BYTES // limit)]
+            results = await self.send_cmd_list_locked([cmd % offset for offset in offsets])
+            if results == None:
+                return None
+            for offset, (code, response) in zip(offsets, results):
+                if code != "OK":
+                    debug(1, "remote: %s: %s", command, code)
+                    return None
+                if offset != len(data):
+                    # a chunk came back short (e.g. we reconnected and lost the binarylimit):
+                    # the rest of this window is for the wrong offsets, so ask again from here
+                    break
+                chunk = dict(response).get("binary")
+                if not chunk:
+                    return None
+                data += chunk
+        return bytes(data[:size])
+
+    def print_song(self, item):
+        debug(0, "%s\t\t%s\t\t%s", item.get("Artist", "[no artist]"), item.get("Album", "[no album]"), item.get("Title", item["file"]))
+
+    # the index's queries run in the loop's executor, so a slow one doesn't hold up the stream
+    async def find(self, findcmd):
+        # simple one-tag finds can be answered by the library index, if we have one
+        if self.library != None:
+            try:
+                args = shlex.split(findcmd)
+            except ValueError:
+                args = []
+            if len(args) == 3:
+                # (None if the index is being synced: then the server answers)
+                results = await self.engine.loop.run_in_executor(None, self.library.find, args[1], args[2])
+                self.sync_library_in_background()
+                if results != None:
+                    for item in results:
+                        self.print_song(item)
+                    return
+        # print the results as they arrive, rather than waiting for the whole response
+        grouper = mpd_parser.record_grouper()
+        async for batch in self.iter_cmd(findcmd):
+            for item in grouper.feed(batch):
+                if "file" in item:
+                    self.print_song(item)
+        for item in grouper.finish():
+            if "file" in item:
+                self.print_song(item)
+        if self.parser.code != "OK":
+            debug(1, "remote: error executing command!")
+            debug(1, "mpd: %s", self.parser.code)
+
+    # case-insensitive prefix search of the library index. tag can be None to search every tag.
+    # until the index has been synced, mpd's own search answers instead, which matches the
+    # words anywhere in a tag rather than just at the start of a word
+    async def search(self, tag, query):
+        if self.library == None:
+            debug(0, "remote: the library index is disabled")
+            return
+        results = await self.engine.loop.run_in_executor(None, self.library.search, tag, query)
+        self.sync_library_in_background()
+        if results == None:
+            debug(1, "remote: the library index isn't synced yet; asking the server")
+            words = tokenize(query)
+            results = []
+            if words:
+                searchcmd = "search " + " ".join("%s %s" % (tag or "any", quote(word)) for word in sorted(words))
+                grouper = mpd_parser.record_grouper()
+                async for batch in self.iter_cmd(searchcmd):
+                    results += grouper.feed(batch)
+                results += grouper.finish()
+                results = [item for item in results if "file" in item]
+            if words and self.parser.code != "OK":
+                debug(1, "remote: error executing command!")
+                debug(1, "mpd: %s", self.parser.code)
+                return
+        for item in results:
+            self.print_song(item)
+        if not results:
+            debug(0, "[no results]")
+
+    async def playlistinfo(self):
+        # the cache is kept up to date every time we fetch the status
+        if self.playlist.version == None:
+            await self.retrieve_status()
+        for item in self.playlist.entries:
+            if item == None:
+                continue
+            debug(0, "%s\t%s\t\t%s\t\t%s", item.get("Track", ""), item.get("Artist", "[no artist]"), item.get("Album", "[no album]"), item.get("Title", item.get("file", "")))
+        if not self.playlist.entries:
+            debug(0, "[playlist empty]")
 
-    def update(self):
-        code, resp = self.send_cmd("update")
+    async def update(self):
+        code, resp = await self.send_cmd("update")
         if code != "OK":
-            self.print_debug("remote: error executing command!", 0)
-            self.print_debug("mpd: " + str(code), 1)
+            debug(0, "remote: error executing command!")
+            debug(1, "mpd: %s", code)
         else:
-            self.print_debug("remote: successfully updated mpd database", 1)
+            debug(1, "remote: successfully updated mpd database")
 
-    def quit(self):
+    async def quit(self):
         self.quitting.set()
-        try:
-            self.send_cmd_raw("clearerror") # so the idler-receiver thread has something to receive, so it can see we've set the quitting flag
-            socket_broken = False
-        except:
-            socket_broken = True # the socket might be broken (we might have called quit() after failing to reconnect to the server) 
-        if self.idler_receiver.is_alive():
-            self.idler_receiver.join()
-            self.print_debug("remote: idler-receiver thread joined", 3)
-        if not socket_broken:
-            self.print_debug("remote: closing connection...", 2)
-            self.mpd_sock.close()
-
+        self.health.close()
+        self.changes.notify_all() # wake up anyone still waiting for a change
+        if self.idler != None:
+            # wherever it's waiting (in idle, or for mpd to come back), that's the end of it
+            self.idler.cancel()
+            try:
+                await self.idler
+            except asyncio.CancelledError:
+                pass
+            debug(3, "remote: idler stopped")
+        debug(2, "remote: closing connection...")
+        self.cmd_conn.close()
+        self.idle_conn.close()
+        self.library_conn.close() # (in case it's syncing the library index)
@@ -0,0 +1,117 @@
+# mpd-remote-streamer
+# Dylan Forbes
+# Computer Networks
+
+
+# incremental parser for responses from the mpd server. it doesn't do any i/o itself: whoever
+# owns the connection feed()s it what arrives, and takes (key, value) pairs out with
+# next_pair() as they're complete, so it works the same for the event loop's connections and
+# for plain blocking sockets (see pairs()). it only ever holds on to what hasn't been parsed
+# yet, so even huge responses are parsed in constant memory
+class response_parser():
+    def __init__(self):
+        self.reset()
+
+    # forget any buffered data, e.g. after reconnecting
+    def reset(self):
+        self.buf = bytearray()
+        self.pos = 0
+        self.code = None # "OK", "list_OK" or "ACK ..." once a response is done, None if the connection was lost
+
+    def feed(self, data):
+        # throw away what we've already parsed before adding more
+        if self.pos:
+            del self.buf[:self.pos]
+            self.pos = 0
+        self.buf += data
+
+    # the next whole line (without its newline), or None if it hasn't all arrived yet
+    def readline(self):
+        end = self.buf.find(b'\n', self.pos)
+        if end == -1:
+            return None
+        line = bytes(self.buf[self.pos:end])
+        self.pos = end + 1
+        return line
+
+    # the next (key, value) pair of the response, None if more has to arrive first, or END once
+    # the response is over (then self.code holds the line that ended it). a binary payload is
+    # only taken once all of it has arrived, so nothing is consumed until a pair is complete
+    def next_pair(self):
+        end = self.buf.find(b'\n', self.pos)
+        if end == -1:
+            return None
+        line = bytes(self.buf[self.pos:end])
+        if line == b'OK' or line == b'list_OK' or line.startswith(b'ACK '):
+            self.pos = end + 1
+            self.code = line.decode("UTF-8")
+            return END
+        key, _, value = line.partition(b': ')
+        if key == b'binary':
+            # raw payload of the given length, followed by a newline
+            size = int(value)
+            if len(self.buf) < end + size + 2:
+                return None
+            data = bytes(self.buf[end + 1:end + 1 + size])
+            self.pos = end + size + 2
+            return "binary", data
+        self.pos = end + 1
+        return key.decode("UTF-8"), value.decode("UTF-8")
+
+# what next_pair() returns at the end of a response
+END = "end"
+
+# generator over the (key, value) pairs of one response, for blocking code: `read` is any
+# callable returning the next chunk, or b'' when the connection is gone, and it's only called
+# as fast as the pairs are taken. when it's exhausted, parser.code holds the line that
+# terminated the response (None if the connection was lost)
+def pairs(parser, read):
+    parser.code = None
+    while True:
+        pair = parser.next_pair()
+        if pair is END:
+            return
+        if pair is None:
+            chunk = read()
+            if not chunk:
+                return
+            parser.feed(chunk)
+        else:
+            yield pair
+
+# groups a stream of (key, value) pairs into one dict per song/directory/playlist entry.
+# mpd starts every entry with one of the `starts` keys, so an entry is only finished once
+# the next one begins (or the response ends). a song can have more than one of a tag (two
+# Artists, say): the keys in `multiple` map to a list of every value, others to the last one.
+# feed() takes the pairs as they come (e.g. a batch at a time, from mpd_client.iter_cmd) and
+# yields the entries they finish; finish() yields the last one, once the response is over
+class record_grouper():
+    def __init__(self, starts=("file", "directory", "playlist"), multiple=()):
+        self.starts = starts
+        self.multiple = multiple
+        self.record = None
+
+    def feed(self, pairs):
+        record = self.record
+        for key, value in pairs:
+            if key in self.starts:
+                if record is not None:
+                    yield record
+                record = {}
+                self.record = record
+            if record is not None:
+                if key in self.multiple:
+                    record.setdefault(key, []).append(value)
+                else:
+                    record[key] = value
+
+    def finish(self):
+        if self.record is not None:
+            yield self.record
+        self.record = None
+
+# the same, for pairs that are all there in one iterable
+def records(pairs, starts=("file", "directory", "playlist"), multiple=()):
+    grouper = record_grouper(starts, multiple)
+    yield from grouper.feed(pairs)
+    yield from grouper.finish()
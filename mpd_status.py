@@ -0,0 +1,121 @@
+# mpd-remote-streamer
+# Dylan Forbes
+# Computer Networks
+
+import time
+
+# how far mpd's elapsed time can be from the one we've worked out (see position()) before it
+# counts as a change: anything less is just the time the status took to reach us
+DRIFT_THRESHOLD = 0.5
+
+# mpd's player states
+STATES = ("play", "pause", "stop")
+
+def parse_int(value):
+    try:
+        return int(value)
+    except ValueError:
+        return None
+
+def parse_float(value):
+    try:
+        return float(value)
+    except ValueError:
+        return None
+
+def parse_flag(value):
+    return value == "1"
+
+def parse_state(value):
+    return value if value in STATES else None
+
+# the fields of mpd's status response we keep, and how to parse each one. anything else in the
+# response is ignored. single and consume can also be "oneshot", so they stay strings
+FIELDS = {
+    "volume": parse_int,
+    "repeat": parse_flag,
+    "random": parse_flag,
+    "single": str,
+    "consume": str,
+    "playlist": parse_int,
+    "playlistlength": parse_int,
+    "mixrampdb": parse_float,
+    "state": parse_state,
+    "song": parse_int,
+    "songid": parse_int,
+    "elapsed": parse_float,
+    "duration": parse_float,
+    "bitrate": parse_int,
+    "audio": str,
+    "nextsong": parse_int,
+    "nextsongid": parse_int,
+    "xfade": parse_int,
+    "updating_db": parse_int,
+    "error": str,
+}
+# the current song's tags, from the queue cache (see mpd_client.parse_status)
+SONG_FIELDS = {"song_title": "Title", "song_artist": "Artist", "song_album": "Album"}
+
+# the status of the mpd server, parsed. a field is None if mpd didn't send it (e.g. songid
+# while stopped with an empty queue). update() only parses and touches the fields that actually
+# changed, and says which ones they were, so whoever's showing the status only has to redo those.
+# while playing, the elapsed time moves on by itself: position() works it out from when the
+# status arrived, so it doesn't have to be fetched again to show it
+class mpd_status():
+    __slots__ = tuple(FIELDS) + tuple(SONG_FIELDS) + ("raw", "updated", "drift")
+
+    def __init__(self):
+        for name in FIELDS:
+            setattr(self, name, None)
+        for name in SONG_FIELDS:
+            setattr(self, name, None)
+        self.raw = {} # the last status response, unparsed
+        self.updated = None # when it arrived (time.monotonic())
+        self.drift = 0 # how far its elapsed time was from what position() expected, in seconds
+
+    # apply a status response (a list of (key, value) pairs). returns the set of fields that
+    # changed. the elapsed time only counts as changed if it's not where position() expected
+    def update(self, pairs):
+        now = time.monotonic()
+        expected = self.position(now) if self.state == "play" else None
+        raw = dict(pairs)
+        old = self.raw
+        self.raw = raw
+        self.updated = now
+        changed = set()
+        for name, parse in FIELDS.items():
+            value = raw.get(name)
+            if value != old.get(name):
+                value = None if value == None else parse(value)
+                if getattr(self, name) != value:
+                    setattr(self, name, value)
+                    changed.add(name)
+        if "elapsed" in changed and expected != None and self.elapsed != None and not changed & {"state", "songid"}:
+            self.drift = self.elapsed - expected
+            if abs(self.drift) <= DRIFT_THRESHOLD:
+                changed.discard("elapsed")
+        return changed
+
+    # how far into the song playback is now, in seconds (None if there's no song)
+    def position(self, now=None):
+        if self.elapsed == None:
+            return None
+        if self.state != "play" or self.updated == None:
+            return self.elapsed
+        position = self.elapsed + (now or time.monotonic()) - self.updated
+        if self.duration != None:
+            position = min(position, self.duration)
+        return position
+
+    # take the current song's tags from its queue entry (a dict, or None). returns the set of fields that changed
+    def set_song(self, entry):
+        entry = entry or {}
+        return self.set_fields({name: entry.get(tag) for name, tag in SONG_FIELDS.items()})
+
+    def set_fields(self, values):
+        changed = set()
+        for name, value in values.items():
+            if getattr(self, name) != value:
+                setattr(self, name, value)
+                changed.add(name)
+        return changed
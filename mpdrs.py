@@ -3,42 +3,108 @@
 # Computer Networks
 
 
-import sys, socket, os, time
-import player, http_client, mpd_client
-
-STREAMER_BUFFER_SIZE = 7000
+import sys, socket, os, threading, asyncio
+import player, http_client, mpd_client, metrics, log, relay, capture, batch, enqueue, engine
+
+# prebuffer to start with. starting at the least the streamer will go to keeps the first start
+# quick; it grows the target itself if the connection turns out to need more
+STREAMER_BUFFER_MS = http_client.MIN_BUFFER_MS
+STREAMER_TRACE_PATH = None # set to a file to record when stream data arrives, for bench.py jitter
+STREAMER_SPLICE = True # linux only; falls back to copying elsewhere
+# debug output, per subsystem: 0 is errors only, 1 is what's going on, 2-4 are for debugging
+# (-1 turns even errors off)
 MAIN_DEBUGLEVEL = 1
 REMOTE_DEBUGLEVEL = 1
 STREAMER_DEBUGLEVEL = 1
 PLAYER_DEBUGLEVEL = 1
-
-def print_debug(msg, level):
-    if level <= MAIN_DEBUGLEVEL:
-        print(msg)
+RELAY_DEBUGLEVEL = 1
+# set to a file (or ":memory:") to keep a local index of the library, which answers find and
+# search without going to the server. it's downloaded in the background the first time it's
+# used, and again whenever mpd's database changes; until then, the server answers
+LIBRARY_INDEX_PATH = None
+# changes to these (e.g. from another client) redraw the info display right away
+DISPLAY_SUBSYSTEMS = ["player", "playlist"]
+# the status fields the info display shows (elapsed only counts as changed when it jumps, e.g.
+# when someone seeks: see mpd_status.update)
+DISPLAY_FIELDS = {"state", "playlistlength", "songid", "song_title", "song_artist", "elapsed"}
+# while playing, the progress bar in the info display is redrawn this often (in seconds), from
+# the elapsed time mpd_status works out locally, so it costs nothing on the network. it needs a
+# terminal that understands ansi escapes; set to None to turn it off
+PROGRESS_INTERVAL = 1
+PROGRESS_WIDTH = 30
+# mpd doesn't say anything when its elapsed time drifts from ours (e.g. playback stalls), so
+# while playing, check it this often (in seconds) even if nothing else has changed
+POSITION_CHECK_SECONDS = 30
+# the commands that still work while mpd can't be reached (the others say so straight away,
+# rather than wait for it)
+OFFLINE_COMMANDS = ["quit", "help", "stats", "rewind", "live", "art", "search"]
+# set to a port to serve the metrics (see the "stats" command) at http://127.0.0.1:<port>/metrics,
+# in prometheus's text format
+METRICS_PORT = None
+# set to a port to re-serve the stream to other listeners on the lan (e.g. mpv http://<this host>:<port>/),
+# so they don't each need their own connection to mpd's http server. see relay.py
+RELAY_PORT = None
+# set to a file to keep the last CAPTURE_MB of the stream (about 17 minutes at 128 kbps) in it,
+# for the "rewind" command. see capture.py
+CAPTURE_PATH = None
+CAPTURE_MB = 16
+# set to a directory to keep the album art the "art" command fetches in, so showing it again
+# doesn't go to the server. the least recently used images are deleted past ART_CACHE_MB
+ART_CACHE_PATH = None
+ART_CACHE_MB = 64
+
+debug = log.get("main")
 
 class mpd_remote_streamer():
 
-    def __init__(self, mpv_path, streamer_fifo_path, mpv_cmds_fifo_path, server_ip, mpd_port, http_port):
+    def __init__(self, mpv_path, streamer_fifo_path, mpv_ipc_path, server_ip, mpd_port, http_port):
 
         self.streamer_fifo_path = streamer_fifo_path
-        self.mpv_cmds_fifo_path = mpv_cmds_fifo_path
+        self.mpv_ipc_path = mpv_ipc_path
+        if METRICS_PORT != None:
+            metrics.serve(METRICS_PORT)
 
         # the command that Popen will call in a new process (the media player, 
-        # controlled by writing commands to mpv_cmds_fifo_path, a handy feature
-        # of mpv) 
-        self.playercmd = [mpv_path, "--input-file=" + mpv_cmds_fifo_path, streamer_fifo_path]
+        # controlled through the json ipc socket it creates at mpv_ipc_path, a handy
+        # feature of mpv) 
+        self.playercmd = [mpv_path, "--input-ipc-server=" + mpv_ipc_path, streamer_fifo_path]
+
+        # the clients, the player and the relay all run on the event loop (see engine.py); this
+        # thread (the REPL) works them through blocking front ends
+        self.engine = engine.get()
 
         # create mpd client, connect it to the server
-        self.remote = mpd_client.mpd_client(server_ip, mpd_port, REMOTE_DEBUGLEVEL)
-        self.remote.connect_to_server()
+        self.remote = engine.blocking(mpd_client.mpd_client(server_ip, mpd_port))
+        if not self.remote.connect_to_server():
+            debug(0, "main: couldn't reach mpd; carrying on, and connecting when it's back")
+        if LIBRARY_INDEX_PATH != None:
+            self.remote.enable_library_index(LIBRARY_INDEX_PATH)
+        if ART_CACHE_PATH != None:
+            self.remote.enable_art_cache(ART_CACHE_PATH, ART_CACHE_MB << 20)
         # get the status of the server 
         self.remote.retrieve_status()
 
         # create player
-        self.player = player.player(self.playercmd, mpv_cmds_fifo_path, PLAYER_DEBUGLEVEL)
+        self.player = engine.blocking(player.player(self.playercmd, mpv_ipc_path))
 
         # create http client
-        self.streamer = http_client.http_client(server_ip, http_port, streamer_fifo_path, STREAMER_BUFFER_SIZE, STREAMER_DEBUGLEVEL)
+        self.streamer = engine.blocking(http_client.http_client(server_ip, http_port, streamer_fifo_path, STREAMER_BUFFER_MS, STREAMER_SPLICE, STREAMER_TRACE_PATH))
+
+        self.capture = None
+        if CAPTURE_PATH != None:
+            self.capture = capture.capture(CAPTURE_PATH, CAPTURE_MB << 20)
+            self.streamer.set_capture(self.capture)
+        self.relay = None
+        if RELAY_PORT != None:
+            self.relay = engine.blocking(relay.relay(self.streamer, RELAY_PORT))
+
+        # (the callbacks are called on the loop, so they use the objects themselves)
+        self.streamer.set_bitrate(self.remote.status.bitrate)
+        self.remote.subscribe(lambda status, changed: self.streamer.target.set_bitrate(status.bitrate), ["bitrate"])
+        # if mpd was unreachable, the stream probably was too: don't wait for its next attempt
+        self.engine.call(self.remote.health.on_recovered, self.streamer.target.retry)
+        # when mpv runs out of data, make the streamer buffer more
+        self.player.on_property_change("paused-for-cache", self.player_starved)
 
         # if the mpd server is playing, initialize the http client's connetion 
         state = self.remote.status.state
@@ -47,35 +113,90 @@ class mpd_remote_streamer():
             self.streamer.play()
             # check if the streamer successfully connected
             if not self.streamer.connected:
-                self.print_debug("Error: could not connect to HTTP server!", 1) 
+                debug(1, "Error: could not connect to HTTP server!") 
                 self.quit()
 
         self.message = None
+        self.prompting = False # if we're waiting at the prompt, right below the info display
+        self.progress_shown = False # if the info display (the last thing printed) has a progress bar
+        # for the REPL and the tasks that redraw the display. whoever holds it only prints (never
+        # waits for the loop), so the tasks can take it on the loop
+        self.output_lock = threading.Lock()
+
+        # redraw the info display as soon as the mpd server tells us something changed
+        self.watcher = self.engine.spawn(self.watch())
+        if PROGRESS_INTERVAL != None and sys.stdout.isatty():
+            self.engine.spawn(self.tick())
+
+    # the watcher task, on the loop
+    async def watch(self):
+        remote = self.remote.target
+        streamer = self.streamer.target
+        while not remote.quitting.is_set():
+            timeout = POSITION_CHECK_SECONDS if remote.status.state == "play" else None
+            if not await remote.wait_for_change(DISPLAY_SUBSYSTEMS, timeout) and remote.quitting.is_set():
+                break
+            changed = await remote.retrieve_status()
+            if "state" in changed:
+                # someone else started or stopped mpd: if we lost the stream when it stopped, stop
+                # trying to get it back (if it's playing again, try now)
+                if remote.status.state == "play":
+                    streamer.retry()
+                else:
+                    streamer.give_up()
+            # our own commands already refreshed the status (and the display), so anything that's
+            # changed since is someone else's doing
+            if changed & DISPLAY_FIELDS:
+                with self.output_lock:
+                    print()
+                    self.display_info()
+                    print(">> ", end="", flush=True)
+
+    # redraw the progress bar while we're sitting at the prompt: it's two lines up (then the
+    # bottom of the display), so save the cursor, go up and rewrite that line, and go back
+    async def tick(self):
+        while not self.remote.quitting.is_set():
+            await asyncio.sleep(PROGRESS_INTERVAL)
+            with self.output_lock:
+                if self.prompting and self.progress_shown and self.remote.status.state == "play":
+                    sys.stdout.write("\0337\033[2A\r" + self.state_line() + "\033[K\0338")
+                    sys.stdout.flush()
+
+    # (called on the loop)
+    def player_starved(self, paused_for_cache):
+        if paused_for_cache:
+            self.streamer.target.report_underrun()
 
     def quit(self):
         # the order in which these things are called is important!
         self.remote.quit()
         self.streamer.quit()
+        if self.relay:
+            self.relay.close()
+        if self.capture:
+            self.capture.close()
         self.player.quit()
         os.remove(self.streamer_fifo_path)
-        os.remove(self.mpv_cmds_fifo_path)
+        if os.path.exists(self.mpv_ipc_path):
+            os.remove(self.mpv_ipc_path)
         print("bye!")
         sys.exit(0)
 
     def play(self):
-        if self.remote.status.playlistlength == "0":
+        if self.remote.status.playlistlength == 0:
             self.message = " (nothing to play!)" 
             return
+        # mpd's http server only starts sending audio once mpd is playing, so start connecting to
+        # it (the streamer retries until audio arrives) at the same time as we tell mpd to play
+        resuming = self.remote.status.state == "pause"
+        self.streamer.start_play()
         if self.remote.status.state != "play":
-            self.remote.play()
-            # if the http server doesn't know the mpd server is playing, the http connection won't stay open
-            # but there seems to be a bit of a delay
-            # this solution is super hacky but i don't know if there's a better way
-            if not self.streamer.connected:
-                time.sleep(1) 
-            
+            self.remote.play() # (which updates the streamer's bitrate, through the subscription)
+        if resuming:
+            # what mpv buffered before the pause is stale (the streamer throws away its own)
+            self.player.drop_buffers()
         self.player.play()
-        self.streamer.play()
+        self.streamer.wait_ready()
 
     def pause(self):
         self.player.pause()
@@ -90,20 +211,56 @@ class mpd_remote_streamer():
     def prev(self):
         if self.remote.status.state != "stop":
             self.remote.prev()
-            self.player.play() # mpd plays when the current track is changed 
-            self.streamer.play()
+            self.skip_stale_audio()
         else:
             print(" (playback stopped; can't do that)")
 
     def next_(self):
         if self.remote.status.state != "stop":
             self.remote.next_()
-            self.player.play() # mpd plays when the current track is changed 
-            self.streamer.play()
+            self.skip_stale_audio()
             print("streamer done")
         else:
             self.message = " (playback stopped; can't do that)"
 
+    # after changing tracks, throw away the rest of the old one, which is still buffered in the
+    # streamer, the fifo, and mpv, so the new one starts playing right away
+    def skip_stale_audio(self):
+        self.streamer.skip() # (the streamer doesn't write anything until play())
+        self.player.drop_buffers()
+        self.player.play() # mpd plays when the current track is changed 
+        self.streamer.play()
+
+    # play the last `seconds` again, from the capture
+    def rewind(self, cmd):
+        if self.capture == None:
+            self.message = " (rewinding needs CAPTURE_PATH)"
+            return
+        if self.remote.status.state != "play":
+            self.message = " (not playing; can't do that)"
+            return
+        arg = cmd[7:].strip().rstrip("s") or "30"
+        try:
+            seconds = float(arg)
+        except ValueError:
+            self.message = " (usage: rewind [seconds])"
+            return
+        behind = self.streamer.rewind(seconds)
+        if behind == None:
+            self.message = " (nothing captured yet)"
+            return
+        self.player.drop_buffers()
+        self.streamer.play()
+        self.message = " (%d s behind; type 'live' to catch up)" % behind
+
+    def live(self):
+        if not self.streamer.replaying():
+            self.message = " (already live)"
+            return
+        self.streamer.live()
+        self.player.drop_buffers()
+        self.streamer.play()
+
     def clear(self):
         self.streamer.stop()
         self.player.quit()
@@ -115,9 +272,52 @@ class mpd_remote_streamer():
     def find(self, cmd):
         self.remote.find(cmd)
 
+    # add every song in a playlist file (see enqueue.py) to the queue
+    def enqueue(self, cmd):
+        path = cmd[8:].strip()
+        try:
+            cmds = enqueue.read_list(path)
+        except OSError as e:
+            self.message = " (couldn't read %s: %s)" % (path, e.strerror)
+            return
+        added, failures = enqueue.load(self.remote, cmds)
+        with self.output_lock: # (so the watcher can't redraw the display in the middle of them)
+            for lineno, line, error in failures:
+                print("%s:%d: %s: %s" % (path, lineno, line, error))
+        self.remote.retrieve_status()
+        self.message = " (added %d of %d)" % (added, len(cmds))
+
+    def search(self, cmd):
+        args = cmd.split(" ", 2)
+        if len(args) < 3:
+            self.message = " (usage: search <tag|any> <words>)"
+            return
+        tag = None if args[1] == "any" else args[1]
+        self.remote.search(tag, args[2])
+
     def playlistinfo(self):
         self.remote.playlistinfo()
 
+    # fetch the current song's album art (or find it in the cache), and say which file it's in
+    def art(self):
+        if self.remote.art == None:
+            self.message = " (album art needs ART_CACHE_PATH)"
+            return
+        songid = self.remote.status.songid
+        entry = self.remote.playlist.song(str(songid)) if songid != None else None
+        # (an entry can be just a placeholder, without the song's tags, if fetching it failed)
+        if entry == None or entry.get("file") == None:
+            self.message = " (no current song)"
+            return
+        path = self.remote.album_art(entry["file"], entry.get("Last-Modified"))
+        if path == None:
+            self.message = " (no album art for this song)"
+        else:
+            self.message = " Album art: " + path
+
+    def stats(self):
+        self.message = metrics.report() or " (nothing to report yet)"
+
     def display_help(self):
         self.message = """Commands:
  quit                  quit mpd-remote-streamer
@@ -129,13 +329,23 @@ class mpd_remote_streamer():
  next                  tell mpd to play the next track in the playlist, resume streaming if stopped
  clear                 tell mpd to clear the playlist; stop streaming; quit mpv
  findadd <tag> <val>   tell mpd to add all files in its database whose <tag> has value <val> to the playlist (case-sentitive, quotes needed for multi-word arguments)
+ enqueue <file>        add every song in an m3u playlist or list of uris (one per line, or findadd/searchadd queries) to the playlist
  find <tag> <val>      list all files in mpd's database whose <tag> has value <val> to the playlist (case-sentitive, quotes needed for multi-word arguments)
- playlistinfo          display the current mpd playlist"""
+ search <tag> <words>  list all files in the local library index with a <tag> (or any tag, if <tag> is "any") containing words starting with each of <words> (case-insensitive; needs LIBRARY_INDEX_PATH)
+ playlistinfo          display the current mpd playlist
+ rewind [seconds]      play the last [seconds] (30 by default) again, from what's been captured (needs CAPTURE_PATH)
+ live                  go back to the live stream after rewinding
+ art                   fetch the current song's album art and say which file it's in (needs ART_CACHE_PATH)
+ stats                 display timings and counters for the mpd connection, the streamer and mpv"""
 
     def display_info(self):
         print("~~~~~~~~~~~~~~~~~~~~")
-        if self.remote.status.playlistlength:
-            print(" Playlist length: " + self.remote.status.playlistlength)
+        if not self.remote.health.up():
+            print(" [mpd: %s]" % self.remote.health.state)
+        if not self.streamer.health.up():
+            print(" [stream: %s]" % self.streamer.health.state)
+        if self.remote.status.playlistlength != None:
+            print(" Playlist length: %d" % self.remote.status.playlistlength)
         if self.remote.status.song_title != None:
             message = " Current song: "
             if self.remote.status.song_artist:
@@ -143,22 +353,29 @@ class mpd_remote_streamer():
             if self.remote.status.song_title:
                 message += self.remote.status.song_title
             print(message)
-            state = self.remote.status.state
-            if state == "play":
-                state = "playing"
-            elif state == "pause":
-                state = "paused"
-            elif state == "stop":
-                state = "stopped"
-            print(" [" + state + "]")
+            print(self.state_line())
+            self.progress_shown = True
         else:
             print(" [stopped]")
+            self.progress_shown = False
         print("~~~~~~~~~~~~~~~~~~~~")
 
+    # e.g. " [playing] 1:23 [######------------------------] 5:12"
+    def state_line(self):
+        status = self.remote.status
+        state = {"play": "playing", "pause": "paused", "stop": "stopped"}.get(status.state, status.state)
+        line = " [" + str(state) + "]"
+        position = status.position()
+        if position != None and status.duration:
+            filled = int(PROGRESS_WIDTH * min(position / status.duration, 1))
+            line += " %s [%s%s] %s" % (format_time(position), "#" * filled, "-" * (PROGRESS_WIDTH - filled), format_time(status.duration))
+        return line
+
     def display_message(self):
         if self.message: 
             print(self.message)
             self.message = None
+            self.progress_shown = False
             return True
         else:
             self.message = None
@@ -171,11 +388,17 @@ class mpd_remote_streamer():
         while True:
             try:
                 self.remote.wait()
-                if not self.display_message():
-                    self.display_info()
+                with self.output_lock:
+                    if not self.display_message():
+                        self.display_info()
+                    self.prompting = True
                 cmd = input(">> ")
+                self.prompting = False
                 if cmd == "":
                     continue
+                if not self.remote.health.up() and cmd.split(" ")[0] not in OFFLINE_COMMANDS:
+                    self.message = " (mpd can't be reached right now; still trying)"
+                    continue
                 if cmd == "quit":
                     self.quit()
                     continue
@@ -203,29 +426,81 @@ class mpd_remote_streamer():
                 if cmd[:8] == "findadd ":
                     self.findadd(cmd)
                     continue
+                if cmd[:8] == "enqueue ":
+                    self.enqueue(cmd)
+                    continue
                 if cmd[:5] == "find ":
                     self.find(cmd)
                     continue
+                if cmd[:7] == "search ":
+                    self.search(cmd)
+                    continue
                 if cmd == "playlistinfo":
                     self.playlistinfo()
                     continue
                 if cmd == "update":
                     self.update()
                     continue
+                if cmd == "rewind" or cmd[:7] == "rewind ":
+                    self.rewind(cmd)
+                    continue
+                if cmd == "live":
+                    self.live()
+                    continue
+                if cmd == "art":
+                    self.art()
+                    continue
+                if cmd == "stats":
+                    self.stats()
+                    continue
                 else:
                     print("main: unrecognized command; type 'help' for available commands")
 
             except KeyboardInterrupt:
                 self.quit()
 
+def format_time(seconds):
+    return "%d:%02d" % (seconds // 60, seconds % 60)
+
 def usage():
     print("Usage: python mpdrs.py <mpd/http server ip> <mpd server port> <http server port>")
-    sys.exit()
+    print("       python mpdrs.py <mpd server ip> <mpd server port> [--json] [-c <command>]... [-f <file>|-]")
+    sys.exit(batch.EXIT_USAGE)
 
 def main():
-    if len(sys.argv) != 4:
+    # with -c or -f (-f - for commands piped in), run them and exit (see batch.py). --json on
+    # its own reads them from stdin
+    args = []
+    commands = []
+    path = None
+    json_output = False
+    argv = sys.argv[1:]
+    try:
+        while argv:
+            arg = argv.pop(0)
+            if arg == "-c":
+                commands.append(argv.pop(0))
+            elif arg == "-f":
+                path = argv.pop(0)
+            elif arg == "--json":
+                json_output = True
+            else:
+                args.append(arg)
+    except IndexError:
+        usage()
+    if commands or path != None or json_output:
+        if len(args) not in (2, 3) or not args[1].isdigit():
+            usage()
+        if path == None and not commands:
+            path = "-"
+        sys.exit(batch.main(args[0], int(args[1]), commands, path, json_output))
+
+    if len(args) != 3:
         usage() 
 
+    log.set_levels({"main": MAIN_DEBUGLEVEL, "remote": REMOTE_DEBUGLEVEL,
+                    "streamer": STREAMER_DEBUGLEVEL, "player": PLAYER_DEBUGLEVEL, "relay": RELAY_DEBUGLEVEL})
+
     # check that the user has mpv installed
     from subprocess import check_output, CalledProcessError, DEVNULL
     try:
@@ -235,34 +510,28 @@ def main():
         return
 
     # check that the given ip:port point to a running http server
-    print_debug("mpdrs: testing connection to http server...", 3)
+    debug(3, "mpdrs: testing connection to http server...")
     http_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     try:
-        http_sock.connect((sys.argv[1], int(sys.argv[3])))
-        print_debug("mpdrs: connected to http server", 3) 
+        http_sock.connect((args[0], int(args[2])))
+        debug(3, "mpdrs: connected to http server") 
     except ConnectionRefusedError:
-        print_debug("Error: Connection refused!\nMake sure the HTTP server is running, and that you've entered the correct IP/port numbers.\nAborting.", 1)
+        debug(1, "Error: Connection refused!\nMake sure the HTTP server is running, and that you've entered the correct IP/port numbers.\nAborting.")
         return
 
-    # make the fifo files
-    mpv_cmds_fifo_path = "/tmp/mpdrs-mpv-cmds.fifo"
-    if not os.path.exists(mpv_cmds_fifo_path):
-        try:
-            os.mkfifo(mpv_cmds_fifo_path)
-        except Exception:
-            self.print_debug("Error: Failed to create fifo " + mpv_cmds_fifo_path, 1)
-            return
+    # make the fifo file (mpv creates its own ipc socket)
+    mpv_ipc_path = "/tmp/mpdrs-mpv.sock"
     streamer_fifo_path = "/tmp/mpdrs-streamer.fifo"
     if not os.path.exists(streamer_fifo_path):
         try:
             os.mkfifo(streamer_fifo_path)
         except Exception:
-            self.print_debug("Error: Failed to create fifo " + streamer_fifo_path, 1)
+            debug(1, "Error: Failed to create fifo %s", streamer_fifo_path)
             return
 
     # ok we're good!
-    remote_streamer = mpd_remote_streamer(mpv_path, streamer_fifo_path, mpv_cmds_fifo_path, sys.argv[1], int(sys.argv[2]), int(sys.argv[3]))
+    remote_streamer = mpd_remote_streamer(mpv_path, streamer_fifo_path, mpv_ipc_path, args[0], int(args[1]), int(args[2]))
     remote_streamer.listen()
 
-main()
-
+if __name__ == "__main__":
+    main()
@@ -2,55 +2,159 @@
 # Dylan Forbes
 # Computer Networks
 
+# drives mpv through its json ipc socket, on the event loop (see engine.py): a task reads its
+# replies and events, and whoever sent a command can wait for the reply without holding anyone up
 
-import sys, os, subprocess
+
+import sys, os, subprocess, json, time, itertools, asyncio
+import metrics, log
+
+# properties of mpv we keep track of, for telemetry about its playback buffer
+OBSERVED_PROPERTIES = ["demuxer-cache-duration", "time-pos", "paused-for-cache"]
+# how long to wait for mpv to create its ipc socket after launching it
+IPC_CONNECT_TIMEOUT = 5
+# how long to wait for mpv to acknowledge commands we need to have taken effect before going on
+COMMAND_TIMEOUT = 1
+
+debug = log.get("player")
 
 class player():
-    def __init__(self, player_command, mpv_cmds_fifo_path, debuglevel):
+    def __init__(self, player_command, mpv_ipc_path):
         self.player_command = player_command
-        self.mpv_cmds_fifo_path = mpv_cmds_fifo_path 
-        self.debuglevel = debuglevel
+        self.mpv_ipc_path = mpv_ipc_path
         self.mpv_running = False
         self.playing = False
+        self.ipc_writer = None # the ipc socket's asyncio streams, while we're connected
+        self.ipc_reader = None
+        self.reader = None # the task reading from it
+        self.request_ids = itertools.count(1)
+        self.pending = {} # request_id -> [future for the reply, when it was sent, command name]
+        self.properties = {} # latest values of OBSERVED_PROPERTIES
+        self.property_callbacks = {} # property name -> list of functions to call with the new value
 
-    def print_debug(self, msg, level):
-        if level <= self.debuglevel:
-            print(msg)
-
-    def launch(self):
+    async def launch(self):
+        if os.path.exists(self.mpv_ipc_path):
+            os.remove(self.mpv_ipc_path) # left over from an mpv that's gone
         subprocess.Popen(self.player_command, shell=False, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
-        self.print_debug("player: launched mpv", 2) 
+        debug(2, "player: launched mpv")
         self.mpv_running = True
+        await self.connect_ipc()
+        for i, name in enumerate(OBSERVED_PROPERTIES):
+            await self.send_cmd(["observe_property", i + 1, name])
+
+    # mpv creates the socket shortly after starting up, so keep trying for a bit
+    async def connect_ipc(self):
+        self.close_ipc() # (from an mpv that exited on its own)
+        deadline = time.monotonic() + IPC_CONNECT_TIMEOUT
+        while True:
+            try:
+                self.ipc_reader, self.ipc_writer = await asyncio.open_unix_connection(self.mpv_ipc_path)
+                break
+            except OSError:
+                if time.monotonic() > deadline:
+                    debug(0, "player: Error! Couldn't connect to mpv's ipc socket!")
+                    return
+                await asyncio.sleep(.01)
+        debug(2, "player: connected to mpv ipc socket")
+        self.reader = asyncio.get_running_loop().create_task(self.read_replies(self.ipc_reader))
+
+    def close_ipc(self):
+        if self.ipc_writer != None:
+            self.ipc_writer.close()
+            self.ipc_writer = None
+            self.ipc_reader = None
 
-    def send_cmd(self, cmd):
-        if self.mpv_running:
-            # mpv only reads commands when a writer closes the file, it doesn't stream the contents continuously
-            fifo = open(self.mpv_cmds_fifo_path, "w")
-            fifo.write(cmd + "\n")
-            fifo.close()
+    # the reader task: reads replies and events from mpv until it goes away
+    async def read_replies(self, reader):
+        while True:
+            try:
+                line = await reader.readline()
+            except (OSError, ValueError): # ValueError: a line longer than the stream's limit
+                break
+            if not line:
+                break
+            try:
+                msg = json.loads(line)
+            except ValueError:
+                continue
+            if "request_id" in msg and msg["request_id"] in self.pending:
+                reply, sent, name = self.pending.pop(msg["request_id"])
+                if not reply.done():
+                    reply.set_result(msg)
+                metrics.histogram("mpv_command_seconds", "time from sending mpv a command to its reply",
+                                  command=name).observe(time.monotonic() - sent)
+            elif msg.get("event") == "property-change":
+                self.properties[msg["name"]] = msg.get("data")
+                for callback in self.property_callbacks.get(msg["name"], []):
+                    callback(msg.get("data"))
+        debug(2, "player: mpv closed the ipc connection")
+        self.mpv_running = False
+        self.playing = False
+
+    # call callback(value) on the loop whenever the given property changes
+    def on_property_change(self, name, callback):
+        self.property_callbacks.setdefault(name, []).append(callback)
 
-    def pause(self):
+    # sends a command (a list, e.g. ["set_property", "pause", True]) to mpv. doesn't wait for the
+    # reply unless `wait` is given, in which case it returns mpv's reply (a dict), or None if
+    # there wasn't one within `wait` seconds
+    async def send_cmd(self, cmd, wait=None):
+        if not self.mpv_running or self.ipc_writer == None:
+            return None
+        request_id = next(self.request_ids)
+        # every command gets a reply, which we wait for (if asked to) and time
+        reply = asyncio.get_running_loop().create_future()
+        self.pending[request_id] = [reply, time.monotonic(), str(cmd[0])]
+        msg = json.dumps({"command": cmd, "request_id": request_id}) + "\n"
+        try:
+            self.ipc_writer.write(msg.encode("UTF-8"))
+            await self.ipc_writer.drain()
+        except OSError:
+            self.pending.pop(request_id, None)
+            return None
+        debug(3, "player: sent command to mpv: %s", cmd)
+        if wait != None:
+            try:
+                return await asyncio.wait_for(asyncio.shield(reply), wait)
+            except asyncio.TimeoutError:
+                self.pending.pop(request_id, None)
+        return None
+
+    async def pause(self):
         if self.playing:
-            self.send_cmd("cycle pause")
-            self.print_debug("player: sent message 'cycle pause' to mpv", 2)
+            await self.send_cmd(["set_property", "pause", True])
+            debug(2, "player: paused mpv")
             self.playing = False
 
-    def stop(self):
+    async def stop(self):
         if self.playing:
-            self.send_cmd("cycle pause")
-            self.print_debug("player: sent message 'cycle pause' to mpv", 2)
+            await self.send_cmd(["set_property", "pause", True])
+            debug(2, "player: paused mpv")
         self.playing = False
 
-    def play(self):
+    async def play(self):
         if not self.mpv_running:
-            self.launch()
+            await self.launch()
         else:
             if not self.playing:
-                self.send_cmd("cycle pause")
-                self.print_debug("player: sent message 'cycle pause' to mpv", 2)
+                await self.send_cmd(["set_property", "pause", False])
+                debug(2, "player: unpaused mpv")
         self.playing = True
 
-    def quit(self):
-        self.send_cmd("quit")
-        self.print_debug("player: sent message 'quit' to mpv", 2)
+    # throw away everything mpv has buffered (e.g. the rest of the track we just skipped), so it
+    # plays whatever it reads from the fifo next right away. waits until mpv has done it
+    async def drop_buffers(self):
+        if await self.send_cmd(["drop-buffers"], wait=COMMAND_TIMEOUT) != None:
+            debug(2, "player: dropped mpv's buffers")
+
+    async def quit(self):
+        await self.send_cmd(["quit"])
+        debug(2, "player: sent message 'quit' to mpv")
         self.mpv_running = False
+        self.playing = False
+        self.close_ipc()
+        if self.reader != None:
+            await self.reader
+            self.reader = None
+        self.properties = {}
+        self.pending = {}
@@ -0,0 +1,73 @@
+# mpd-remote-streamer
+# Dylan Forbes
+# Computer Networks
+
+
+# if more than this fraction of the queue is new to us, it's cheaper to just fetch the whole
+# thing with playlistinfo than to ask for each new song separately
+FULL_FETCH_FRACTION = 0.5
+
+# local copy of mpd's queue, kept up to date with plchangesposid. mpd gives each version of the
+# queue a number (status.playlist), and plchangesposid <version> tells us the position and id
+# of every entry that's different now. songs we've seen before (e.g. ones that just moved) we
+# already have the tags for, so only songs that are actually new have to be downloaded
+class playlist_cache():
+    def __init__(self):
+        self.version = None # playlist version we're in sync with, None if we've never synced
+        self.entries = [] # one dict of tags per queue position
+        self.by_id = {} # song id -> the same dicts
+
+    def song(self, songid):
+        return self.by_id.get(songid)
+
+    # the command that fetches what changed since we last synced (None if we've never synced,
+    # in which case the whole queue has to be fetched with playlistinfo)
+    def changes_cmd(self):
+        if self.version == None:
+            return None
+        return "plchangesposid " + str(self.version)
+
+    # apply the response to changes_cmd(). returns the ids of the songs we don't have the tags for,
+    # which the caller should fetch (with playlistid) and pass to add_songs(), or None if so much
+    # is missing that the caller should fetch everything with playlistinfo and pass it to replace()
+    def apply_changes(self, pairs, version, length):
+        entries = self.entries[:length]
+        missing = []
+        pos = None
+        for key, value in pairs:
+            if key == "cpos":
+                pos = int(value)
+            elif key == "Id" and pos != None:
+                if pos >= len(entries):
+                    entries.extend([None] * (pos + 1 - len(entries)))
+                entry = self.by_id.get(value)
+                if entry == None:
+                    missing.append(value)
+                    entry = {"Id": value}
+                entry["Pos"] = str(pos)
+                entries[pos] = entry
+                pos = None
+        if len(missing) > FULL_FETCH_FRACTION * length:
+            return None
+        self.set_entries(entries)
+        self.version = version
+        return missing
+
+    def add_songs(self, songs):
+        for song in songs:
+            pos = int(song["Pos"])
+            if pos < len(self.entries):
+                self.entries[pos] = song
+                self.by_id[song["Id"]] = song
+
+    # replace the whole cache with the songs from a playlistinfo response
+    def replace(self, songs, version):
+        self.set_entries(list(songs))
+        self.version = version
+
+    def set_entries(self, entries):
+        self.entries = entries
+        self.by_id = {}
+        for entry in entries:
+            if entry != None:
+                self.by_id[entry["Id"]] = entry
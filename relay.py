@@ -0,0 +1,295 @@
+# mpd-remote-streamer
+# Dylan Forbes
+# Computer Networks
+
+# re-serves the stream an http_client receives to any number of local listeners over http, so
+# a whole lan can listen with only one connection to mpd's http server. anything that can play
+# an http stream can listen (mpv http://<host>:<port>/, or another mpdrs). run it on its own with:
+#     python3 relay.py <http server ip> <http server port> <relay port>
+# or set RELAY_PORT in mpdrs.py to relay what mpdrs is playing. the listeners are served on the
+# event loop (see engine.py), alongside the streamer that feeds them
+
+
+import sys, os, socket, collections, time
+import http_client, demux, metrics, log, engine
+
+# how far behind the stream a listener can fall (about 8 s at 128 kbps) before we start
+# dropping its oldest pages, so one slow listener can't hold up the others or use up memory
+CLIENT_QUEUE_BYTES = 131072
+# the kernel's send buffer for each listener. kept small, so most of a stalled listener's backlog
+# is in its queue, where it's bounded and dropped a page at a time, rather than in the kernel
+SEND_BUFFER_BYTES = 65536
+# the longest http request we'll wait for from a listener
+MAX_REQUEST_BYTES = 8192
+# when run on its own, how long to wait before connecting to the http server again when mpd
+# isn't playing
+RETRY_SECONDS = 2
+
+# what a queued page is, which decides whether it can be dropped
+DATA = 0
+HEADER = 1 # a codec header page: the listener can't decode the track without it
+TRACK_START = 2 # a track's first (beginning-of-stream) page, also a header
+RESPONSE = 3 # our http response
+
+debug = log.get("relay")
+
+class relay_client():
+    def __init__(self, sock, address):
+        self.sock = sock
+        self.address = address
+        self.request = b''
+        self.pages = collections.deque() # (page (or batch of them), kind) waiting to be sent
+        self.queued = 0 # bytes in pages
+        self.sent = 0 # how much of pages[0] has been sent already
+        self.writable = False # if the loop is waiting for the socket to be writable
+
+    # returns how many bytes had to be dropped to make room
+    def queue(self, page, kind=DATA):
+        self.pages.append((page, kind))
+        self.queued += len(page)
+        dropped = 0
+        # drop whole pages (never the one that's half sent, or the newest), so what the listener gets can still be decoded
+        while self.queued > CLIENT_QUEUE_BYTES:
+            index = self.droppable()
+            if index == None:
+                break
+            page, kind = self.pages[index]
+            del self.pages[index]
+            self.queued -= len(page)
+            dropped += len(page)
+        return dropped
+
+    # the oldest page we can drop, if there is one. codec headers are kept until a newer track
+    # has started in the queue: without them, nothing after them could be decoded
+    def droppable(self):
+        first = 1 if self.sent else 0
+        index = None
+        newer_track = False
+        for i in range(len(self.pages) - 1, first - 1, -1):
+            kind = self.pages[i][1]
+            if i < len(self.pages) - 1 and (kind == DATA or (kind != RESPONSE and newer_track)):
+                index = i
+            if kind == TRACK_START:
+                newer_track = True
+        return index
+
+class relay():
+    def __init__(self, streamer, port, address=""):
+        self.listener = socket.create_server((address, port))
+        self.listener.setblocking(False)
+        self.port = self.listener.getsockname()[1]
+        # the streamer calls the tap methods on the loop, so nothing here needs a lock
+        self.engine = engine.get()
+        self.loop = self.engine.loop
+        self.content_type = None # of the current stream, or None if there isn't one
+        self.demux = None
+        self.pending = bytearray() # the stream from pending_offset on, not yet split into whole pages
+        self.pending_offset = 0
+        self.frames = collections.deque() # (offset, length, starts a track, codec header) of pages found in pending
+        self.headers = [] # the pages a listener needs first to be able to decode the rest
+        self.in_headers = False # if we're still reading the current stream's codec headers
+        self.clients = [] # listeners being sent the stream
+        self.finished = [] # listeners to the last stream, waiting to be disconnected
+        self.sent_total = metrics.counter("relay_sent_bytes_total", "bytes sent to relay listeners")
+        self.dropped_total = metrics.counter("relay_dropped_bytes_total", "bytes dropped because a relay listener fell behind")
+        self.accepted_total = metrics.counter("relay_listeners_total", "relay listeners that have connected")
+        metrics.function("gauge", "relay_listeners", "relay listeners connected now", lambda: len(self.clients))
+        self.engine.call_soon(self.loop.add_reader, self.listener, self.accept)
+        streamer.add_tap(self)
+        debug(1, "relay: listening on port %d", self.port)
+
+    # tap methods, called by the streamer (on the loop)
+
+    def started(self, content_type):
+        self.content_type = content_type or "audio/ogg"
+        self.demux = demux.for_content_type(content_type)
+        if self.demux != None:
+            self.demux.on_frame = self.frame_found
+        self.pending = bytearray()
+        self.pending_offset = 0
+        self.frames.clear()
+        self.headers = []
+        self.in_headers = False
+
+    def received(self, data):
+        if self.demux == None:
+            # no idea where the pages are: pass it on as it comes
+            self.publish(bytes(data))
+        else:
+            self.pending += data
+            self.demux.feed(data)
+            self.split_pages()
+        self.flush_all()
+
+    def ended(self):
+        # the server closed the connection, so close the listeners' too, like it would have
+        self.content_type = None
+        self.demux = None
+        self.finished += self.clients
+        self.clients = []
+        self.flush_all()
+
+    def frame_found(self, offset, length, track_start, codec_header):
+        self.frames.append((offset, length, track_start, codec_header))
+
+    # send every whole page we have to the listeners, in one batch apart from codec headers,
+    # which are remembered for listeners that join later
+    def split_pages(self):
+        batch_start = None
+        end = self.pending_offset
+        while self.frames and self.frames[0][0] + self.frames[0][1] <= self.pending_offset + len(self.pending):
+            offset, length, track_start, codec_header = self.frames.popleft()
+            if track_start:
+                self.headers = []
+                self.in_headers = True
+            elif self.in_headers and not codec_header:
+                self.in_headers = False
+            if self.in_headers:
+                if batch_start != None:
+                    self.publish(bytes(self.pending[batch_start - self.pending_offset:offset - self.pending_offset]))
+                    batch_start = None
+                page = bytes(self.pending[offset - self.pending_offset:offset - self.pending_offset + length])
+                self.headers.append(page)
+                self.publish(page, TRACK_START if track_start else HEADER)
+            elif batch_start == None:
+                batch_start = offset
+            end = offset + length
+        if batch_start != None:
+            self.publish(bytes(self.pending[batch_start - self.pending_offset:end - self.pending_offset]))
+        # keep only what might still become part of a page
+        keep = self.frames[0][0] if self.frames else self.demux.safe_offset()
+        del self.pending[:keep - self.pending_offset]
+        self.pending_offset = keep
+
+    def publish(self, page, kind=DATA):
+        dropped = 0
+        for client in self.clients:
+            dropped += client.queue(page, kind)
+        if dropped:
+            self.dropped_total.inc(dropped)
+
+    # the loop calls these when the listening socket and the listeners' sockets are ready
+
+    def accept(self):
+        try:
+            sock, address = self.listener.accept()
+        except OSError:
+            return
+        sock.setblocking(False)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, SEND_BUFFER_BYTES)
+        client = relay_client(sock, address)
+        self.loop.add_reader(sock, self.read, client)
+
+    # read the listener's http request, then start sending it the stream. after that, the only
+    # thing it can send us is the end of the connection
+    def read(self, client):
+        try:
+            data = client.sock.recv(4096)
+        except BlockingIOError:
+            return
+        except OSError:
+            data = b''
+        if not data:
+            self.disconnect(client)
+            return
+        if client.request == None:
+            return
+        client.request += data
+        if b'\r\n\r\n' not in client.request:
+            if len(client.request) > MAX_REQUEST_BYTES:
+                self.disconnect(client)
+            return
+        client.request = None
+        if self.content_type == None:
+            # not streaming: turn it away, like mpd's http server does when mpd isn't playing
+            self.disconnect(client)
+            return
+        client.queue(("HTTP/1.1 200 OK\r\nContent-Type: %s\r\nCache-Control: no-cache\r\nConnection: close\r\n\r\n"
+                      % self.content_type).encode("ascii"), RESPONSE)
+        for i, page in enumerate(self.headers):
+            client.queue(page, TRACK_START if i == 0 else HEADER)
+        self.clients.append(client)
+        self.accepted_total.inc()
+        debug(2, "relay: %s:%d is listening", *client.address[:2])
+        self.flush(client)
+
+    def flush_all(self):
+        for client in self.finished:
+            self.disconnect(client)
+        self.finished = []
+        for client in list(self.clients):
+            if client.pages and not client.writable:
+                self.flush(client)
+
+    # send as much of the listener's queue as its socket will take without blocking
+    def flush(self, client):
+        try:
+            while client.pages:
+                page = client.pages[0][0]
+                n = client.sock.send(memoryview(page)[client.sent:])
+                self.sent_total.inc(n)
+                client.sent += n
+                if client.sent < len(page):
+                    break
+                client.pages.popleft()
+                client.queued -= len(page)
+                client.sent = 0
+            waiting = bool(client.pages)
+        except BlockingIOError:
+            waiting = True
+        except OSError:
+            self.disconnect(client)
+            return
+        if waiting != client.writable:
+            client.writable = waiting
+            if waiting:
+                self.loop.add_writer(client.sock, self.flush, client)
+            else:
+                self.loop.remove_writer(client.sock)
+
+    def disconnect(self, client):
+        if client in self.clients:
+            self.clients.remove(client)
+        self.loop.remove_reader(client.sock)
+        self.loop.remove_writer(client.sock)
+        client.sock.close()
+        debug(2, "relay: %s:%d went away", *client.address[:2])
+
+    # stop serving (on the loop: through engine.blocking(), from anywhere else)
+    def close(self):
+        for client in self.clients + self.finished:
+            self.loop.remove_reader(client.sock)
+            self.loop.remove_writer(client.sock)
+            client.sock.close()
+        self.clients = []
+        self.finished = []
+        self.loop.remove_reader(self.listener)
+        self.listener.close()
+
+def usage():
+    print("Usage: python3 relay.py <http server ip> <http server port> <relay port>")
+    sys.exit(1)
+
+# relay on its own, without playing anything locally (the streamer writes to /dev/null)
+def main():
+    if len(sys.argv) != 4:
+        usage()
+    try:
+        ip, http_port, port = sys.argv[1], int(sys.argv[2]), int(sys.argv[3])
+    except ValueError:
+        usage()
+    streamer = engine.blocking(http_client.http_client(ip, http_port, os.devnull, http_client.MIN_BUFFER_MS))
+    server = engine.blocking(relay(streamer, port))
+    try:
+        while True:
+            # mpd's http server only sends anything while mpd is playing, so keep trying
+            if not streamer.streaming:
+                streamer.play()
+            time.sleep(RETRY_SECONDS)
+    except KeyboardInterrupt:
+        pass
+    streamer.quit()
+    server.close()
+
+if __name__ == "__main__":
+    main()
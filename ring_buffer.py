@@ -0,0 +1,87 @@
+# mpd-remote-streamer
+# Dylan Forbes
+# Computer Networks
+
+
+# fixed-size circular byte buffer for the audio path. the storage is allocated once
+# and only ever accessed through memoryview slices, so moving data from the socket
+# to the fifo never creates intermediate bytes objects
+class ring_buffer():
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.buf = bytearray(capacity)
+        self.view = memoryview(self.buf)
+        self.start = 0 # index of the oldest unread byte
+        self.size = 0 # number of unread bytes
+        self.high_water = 0 # the most bytes we've ever held at once
+        # stream offsets: how many bytes have ever been read out of / written into the ring
+        self.read_total = 0
+        self.write_total = 0
+        self.on_receive = None # if set, called with a view of each chunk of new data as it comes in
+
+    def __len__(self):
+        return self.size
+
+    def free(self):
+        return self.capacity - self.size
+
+    def clear(self):
+        self.read_total += self.size
+        self.start = 0
+        self.size = 0
+
+    # throw away everything before stream offset `offset`
+    def drop_to(self, offset):
+        self.consume(max(0, min(offset, self.write_total) - self.read_total))
+
+    # largest contiguous free region, starting right after the last unread byte
+    def free_region(self):
+        end = (self.start + self.size) % self.capacity
+        if self.size == self.capacity:
+            return self.view[end:end]
+        if end >= self.start:
+            return self.view[end:]
+        return self.view[end:self.start]
+
+    # largest contiguous unread region, starting at the oldest unread byte
+    def data_region(self):
+        return self.view[self.start:min(self.start + self.size, self.capacity)]
+
+    def commit(self, nbytes):
+        self.size += nbytes
+        self.write_total += nbytes
+        if self.size > self.high_water:
+            self.high_water = self.size
+
+    def consume(self, nbytes):
+        self.read_total += nbytes
+        self.start = (self.start + nbytes) % self.capacity
+        self.size -= nbytes
+        if self.size == 0:
+            self.start = 0 # keep the free region as big as possible
+
+    # copy some bytes in (only used for the data that arrives with the http header)
+    def feed(self, data):
+        data = memoryview(data)
+        while data:
+            region = self.free_region()
+            n = min(len(region), len(data))
+            if n == 0:
+                raise BufferError("ring buffer full")
+            region[:n] = data[:n]
+            self.commit(n)
+            if self.on_receive:
+                self.on_receive(region[:n])
+            data = data[n:]
+
+    # recv straight into the free space. returns the number of bytes received, which
+    # is 0 if the connection was closed, or None (without touching the socket) if the buffer is full
+    def recv_into(self, sock):
+        region = self.free_region()
+        if not region:
+            return None
+        n = sock.recv_into(region)
+        self.commit(n)
+        if n and self.on_receive:
+            self.on_receive(region[:n])
+        return n
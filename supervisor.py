@@ -0,0 +1,124 @@
+# mpd-remote-streamer
+# Dylan Forbes
+# Computer Networks
+
+# keeps track of whether a connection (to mpd, or to its http server) is working, and when to
+# try again if it isn't. the states are:
+#     up            working, as far as we know
+#     reconnecting  lost; trying again, waiting longer after each failed attempt
+#     down          still failing after DOWN_AFTER_SECONDS (we keep trying, at most
+#                   RECONNECT_MAX_SECONDS apart)
+# given a reconnect coroutine, it runs the attempts itself, in a task on the event loop (see
+# engine.py) started whenever the connection is lost, so whoever found the connection broken
+# doesn't have to wait for it. otherwise its owner makes the attempts, and tells it how they went
+# with attempted(). everything but up() and the state is only for code on the loop
+
+
+import asyncio, random, time
+import metrics, engine
+
+# the first attempt is about RECONNECT_BASE_SECONDS after the connection is lost, and each one
+# after that about twice as long after the one before, up to RECONNECT_MAX_SECONDS. every delay
+# is between half and all of that, at random, so clients that lost the server at the same time
+# don't all come back to it at once
+RECONNECT_BASE_SECONDS = 0.25
+RECONNECT_MAX_SECONDS = 30
+DOWN_AFTER_SECONDS = 10
+# how long to wait for a connection to be accepted (a server that's gone away without closing
+# the connection would otherwise keep us waiting for minutes)
+CONNECT_TIMEOUT = 3
+# histogram buckets for how long outages last, in seconds
+OUTAGE_BUCKETS = [0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300, 900]
+
+UP = "up"
+RECONNECTING = "reconnecting"
+DOWN = "down"
+STATES = [UP, RECONNECTING, DOWN]
+
+class supervisor():
+    def __init__(self, name, reconnect=None):
+        self.name = name
+        self.reconnect = reconnect # a coroutine function; raises OSError if it fails
+        self.state = UP
+        self.lost_at = None # when the current outage started
+        self.attempts = 0 # failed attempts in the current outage
+        self.callbacks = [] # see on_recovered()
+        self.closed = False
+        self.changes = engine.condition()
+        self.task = None # the one making the attempts, while there is one
+        self.attempts_total = metrics.counter(name + "_reconnect_attempts_total", "attempts to reconnect after losing the connection")
+        self.outages = metrics.histogram(name + "_outage_seconds", "time from losing the connection to getting it back", OUTAGE_BUCKETS)
+        metrics.function("gauge", name + "_health", "0 if the connection is up, 1 if reconnecting, 2 if down", lambda: STATES.index(self.state))
+
+    # call callback() (on the loop) whenever the connection comes back
+    def on_recovered(self, callback):
+        self.callbacks.append(callback)
+
+    def up(self):
+        return self.state == UP
+
+    # the connection's broken. returns right away: the attempts to get it back happen elsewhere
+    def lost(self):
+        if self.state != UP or self.closed:
+            return
+        self.state = RECONNECTING
+        self.lost_at = time.monotonic()
+        self.attempts = 0
+        self.changes.notify_all()
+        if self.reconnect != None and (self.task == None or self.task.done()):
+            self.task = asyncio.get_running_loop().create_task(self.run())
+
+    # how long to wait before the next attempt
+    def backoff(self):
+        delay = min(RECONNECT_MAX_SECONDS, RECONNECT_BASE_SECONDS * 2 ** self.attempts)
+        return random.uniform(delay / 2, delay)
+
+    # record an attempt to reconnect. returns how long to wait before the next one, if it failed
+    def attempted(self, ok):
+        self.attempts_total.inc()
+        if ok:
+            self.recovered()
+            return None
+        self.attempts += 1
+        if self.state == RECONNECTING and time.monotonic() - self.lost_at >= DOWN_AFTER_SECONDS:
+            self.state = DOWN
+        return self.backoff()
+
+    def recovered(self):
+        if self.state == UP:
+            return
+        self.outages.observe(time.monotonic() - self.lost_at)
+        self.state = UP
+        self.changes.notify_all()
+        for callback in self.callbacks:
+            callback()
+
+    # stop trying without having got the connection back (e.g. it's not wanted any more)
+    def cancel(self):
+        self.state = UP
+        self.changes.notify_all()
+
+    # waits until the connection is up. returns False if `timeout` runs out (or we're closing) first
+    async def wait_up(self, timeout=None):
+        await self.changes.wait_for(lambda: self.state == UP or self.closed, timeout)
+        return self.state == UP and not self.closed
+
+    def close(self):
+        self.closed = True
+        self.changes.notify_all()
+        if self.task != None:
+            self.task.cancel()
+
+    # the reconnecting task: one attempt after each backoff, until one works (or someone else
+    # gets the connection back in the meantime)
+    async def run(self):
+        while self.state != UP:
+            await self.changes.wait_for(lambda: self.state == UP, self.backoff())
+            if self.state == UP:
+                return
+            try:
+                await self.reconnect()
+                ok = True
+            except OSError:
+                ok = False
+            self.attempted(ok)
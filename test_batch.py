@@ -0,0 +1,81 @@
+# mpd-remote-streamer
+# Dylan Forbes
+# Computer Networks
+
+# batch.py's non-interactive mode, against fake_server.py. run with:
+#     python3 -m unittest test_batch      (or pytest)
+
+
+import unittest, io, json, os, tempfile
+import batch, engine, fake_server, log, mpd_client
+
+class test_batch(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        log.set_all(-1)
+        cls.process, cls.port, http_port = fake_server.spawn(library=100, queue=0)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.process.terminate()
+
+    def setUp(self):
+        self.client = engine.blocking(mpd_client.mpd_client("127.0.0.1", self.port))
+        self.client.connect_cmd_conn()
+        self.out = io.StringIO()
+        self.err = io.StringIO()
+        self.client.send_cmd("clear")
+
+    def tearDown(self):
+        self.client.quit()
+
+    def run_lines(self, lines, json_output=True):
+        return batch.batch(self.client, json_output, self.out, self.err).run(lines)
+
+    def results(self):
+        return [json.loads(line) for line in self.out.getvalue().splitlines()]
+
+    def test_repeated_tags_are_lists(self):
+        self.assertEqual(self.run_lines(['find title "track 0"']), batch.EXIT_OK)
+        song, = self.results()[0]["result"]
+        self.assertEqual(song["Genre"], ["rock", "live"])
+        self.assertEqual(song["Artist"], ["artist 0"])
+        self.assertEqual(song["Title"], "track 0")
+
+    def test_enqueue(self):
+        with tempfile.NamedTemporaryFile("w", suffix=".m3u", delete=False) as f:
+            f.write("#EXTM3U\n")
+            f.write(fake_server.make_song(1)["file"] + "\n")
+            f.write("not/in/the/library.ogg\n")
+            f.write(fake_server.make_song(2)["file"] + "\n")
+        try:
+            code = self.run_lines(["enqueue " + f.name, "status"])
+        finally:
+            os.unlink(f.name)
+        # the songs it has are added; the missing one fails the script, by its line number
+        self.assertEqual(code, batch.EXIT_FAILED)
+        self.assertIn(":3: not/in/the/library.ogg", self.err.getvalue())
+        self.assertEqual(self.results()[-1]["error"], "added 2 of 3")
+        code, response = self.client.send_cmd("status")
+        self.assertEqual(dict(response)["playlistlength"], "2")
+
+    def test_prompt_only_commands(self):
+        code = self.run_lines(["ping", "rewind 10", "ping"])
+        self.assertEqual(code, batch.EXIT_USAGE)
+        results = self.results()
+        self.assertEqual(len(results), 2)
+        self.assertTrue(results[0]["ok"])
+        self.assertFalse(results[1]["ok"])
+        self.assertEqual(results[1]["command"], "rewind 10")
+
+    def test_lists_are_capped_by_size(self):
+        cmds = ["add " + mpd_client.quote("x" * 100000)] * 30
+        self.assertEqual(mpd_client.list_end(cmds, 0, batch.MAX_LIST_LENGTH), 10)
+        self.assertEqual(mpd_client.list_end(cmds, 20, batch.MAX_LIST_LENGTH), 30)
+        # a command that's too big on its own still goes, in a list by itself
+        huge = ["add " + mpd_client.quote("x" * 2000000), "ping"]
+        self.assertEqual(mpd_client.list_end(huge, 0, batch.MAX_LIST_LENGTH), 1)
+        self.assertEqual(mpd_client.list_end(["ping"] * 300, 0, batch.MAX_LIST_LENGTH), 256)
+
+if __name__ == "__main__":
+    unittest.main()
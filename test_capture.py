@@ -0,0 +1,116 @@
+# mpd-remote-streamer
+# Dylan Forbes
+# Computer Networks
+
+# the rolling capture behind "rewind" (capture.py): wrapping round its file, and finding where
+# to play from. run with:
+#     python3 -m unittest test_capture      (or pytest)
+
+
+import unittest, os, tempfile
+from unittest import mock
+import capture
+from test_demux import ogg_page
+
+# stands in for the time module, so pages "arrive" when the test says
+class clock():
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self):
+        return self.now
+
+class test_capture(unittest.TestCase):
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp()
+        os.close(fd)
+        self.clock = clock()
+        patcher = mock.patch.object(capture, "time", self.clock)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.captures = []
+
+    def tearDown(self):
+        for c in self.captures:
+            c.close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+    def make(self, size):
+        c = capture.capture(self.path, size)
+        self.captures.append(c)
+        return c
+
+    # a track's pages: a beginning-of-stream page, a codec header page, then `count` audio
+    # pages, one every 0.5 s. returns the offset of each audio page
+    def track(self, c, count, body=200):
+        c.received(ogg_page(30, bos=True, granule=0))
+        c.received(ogg_page(40, granule=0))
+        offsets = []
+        for i in range(count):
+            offsets.append(c.total)
+            c.received(ogg_page(body))
+            self.clock.now += 0.5
+        return offsets
+
+    def test_wraps_around(self):
+        c = self.make(100)
+        data = bytes(range(256)) * 2
+        for i in range(0, len(data), 30):
+            c.received(data[i:i + 30])
+        self.assertEqual(c.total, len(data))
+        self.assertEqual(c.copy(len(data) - 100, 100), data[-100:])
+        self.assertIsNone(c.read(len(data) - 101, 10)) # overwritten
+        # a read stops where the file wraps round
+        offset = len(data) - 100
+        view = c.read(offset, 100)
+        self.assertEqual(bytes(view), data[offset:offset + len(view)])
+        self.assertEqual(len(view), 100 - offset % 100)
+
+    def test_chunk_bigger_than_the_file(self):
+        c = self.make(100)
+        c.received(b'x' * 30)
+        data = bytes(range(250))
+        c.received(data)
+        self.assertEqual(c.total, 280)
+        self.assertEqual(c.copy(180, 100), data[-100:])
+
+    def test_seek(self):
+        c = self.make(1 << 20)
+        c.started("audio/ogg")
+        first = self.track(c, 10)
+        headers = c.copy(0, first[0])
+        # the page that arrived at (or just before) the time asked for, with the headers first
+        self.assertEqual(c.seek(1000.0 + 3 * 0.5 + 0.1), (first[3], headers))
+        self.assertEqual(c.seek(0), (first[0], headers))
+        self.assertEqual(c.seek(1e9), (first[-1], headers))
+        self.assertEqual(c.time_at(first[4] + 5), 1000.0 + 4 * 0.5)
+        # a second track: seeking into the first still gets the first's headers
+        start = c.total
+        second = self.track(c, 4)
+        self.assertEqual(c.seek(self.clock.now)[1], c.copy(start, second[0] - start))
+        self.assertEqual(c.seek(1000.0)[1], headers)
+
+    def test_nothing_captured(self):
+        c = self.make(1000)
+        self.assertIsNone(c.seek(self.clock.now))
+        c.started("audio/ogg")
+        c.received(ogg_page(30, bos=True, granule=0))
+        self.assertIsNone(c.seek(self.clock.now)) # (headers aren't somewhere to play from)
+        self.assertEqual(c.seconds(), 0)
+
+    def test_forgets_what_is_overwritten(self):
+        c = self.make(4000)
+        c.started("audio/ogg")
+        first = self.track(c, 5)
+        second = self.track(c, 30)
+        # only pages still in the file can be played, and the first track's gone with them
+        offset, headers = c.seek(0)
+        self.assertGreaterEqual(offset, c.total - c.size)
+        self.assertIsNotNone(c.read(offset, 1))
+        self.assertEqual(len(c.tracks), 1)
+        self.assertEqual(headers, b''.join(c.tracks[0][1]))
+        self.assertEqual(headers[:4], b'OggS')
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,121 @@
+# mpd-remote-streamer
+# Dylan Forbes
+# Computer Networks
+
+# finding ogg pages and mp3 frames in the stream (demux.py), however it's split into chunks.
+# run with:
+#     python3 -m unittest test_demux      (or pytest)
+
+
+import unittest, struct
+import demux
+
+# an ogg page with a `length`-byte body. granule 0 marks it as one of the codec's headers
+def ogg_page(length, bos=False, granule=1024, fill=b'\0'):
+    segments = [255] * (length // 255) + [length % 255]
+    header = struct.pack("<4sBBqIIIB", b'OggS', 0, 2 if bos else 0, granule, 1, 0, 0, len(segments))
+    return header + bytes(segments) + (fill * length)[:length]
+
+# an mpeg 1 layer 3 frame, 128 kbps at 44100 Hz: 417 bytes
+MP3_FRAME = b'\xff\xfb\x90\x00' + bytes(413)
+
+def feed_in_chunks(dm, data, size):
+    for i in range(0, len(data), size):
+        dm.feed(data[i:i + size])
+
+# (offset, length) of each page in `pages`, laid end to end from `start`
+def offsets(pages, start=0):
+    found = []
+    for page in pages:
+        found.append((start, len(page)))
+        start += len(page)
+    return found
+
+class test_demux(unittest.TestCase):
+    def setUp(self):
+        # two tracks' worth: each starts with a beginning-of-stream page and a codec header page.
+        # one body has something that looks like a page in it
+        self.pages = [ogg_page(30, bos=True, granule=0), ogg_page(3000, granule=0), ogg_page(600, fill=b'OggS'),
+                      ogg_page(0), ogg_page(255), ogg_page(30, bos=True, granule=0), ogg_page(4080)]
+        self.stream = b''.join(self.pages)
+
+    def frames(self, dm):
+        found = []
+        dm.on_frame = lambda offset, length, track_start, codec_header: found.append((offset, length, track_start, codec_header))
+        return found
+
+    def test_ogg_any_chunking(self):
+        expected = [(offset, length) for offset, length in offsets(self.pages)]
+        for size in [1, 2, 3, 5, 26, 27, 28, 255, 1000, len(self.stream)]:
+            dm = demux.ogg_demux()
+            found = self.frames(dm)
+            feed_in_chunks(dm, self.stream, size)
+            self.assertEqual([(offset, length) for offset, length, track, codec in found], expected, "chunks of %d" % size)
+            self.assertEqual([track for offset, length, track, codec in found], [True, False, False, False, False, True, False])
+            self.assertEqual([codec for offset, length, track, codec in found], [True, True, False, False, False, True, False])
+            self.assertEqual(dm.offset, len(self.stream))
+
+    def test_starts_mid_stream(self):
+        # joining partway through a page: the rest of it is skipped until a real page turns up,
+        # even with a sync pattern in it that isn't one
+        start = len(self.pages[0]) + len(self.pages[1]) + 100 # in the body full of "OggS"
+        for size in [1, 4, 7, 1000]:
+            dm = demux.ogg_demux(start)
+            found = self.frames(dm)
+            feed_in_chunks(dm, self.stream[start:], size)
+            self.assertEqual([offset for offset, length, track, codec in found],
+                             [offset for offset, length in offsets(self.pages)[3:]], "chunks of %d" % size)
+
+    def test_resync_after_a_gap(self):
+        # what the streamer does after data's been spliced past the demux: it was in the middle of
+        # a page, and the next thing it's fed is the start of a new track
+        dm = demux.ogg_demux()
+        found = self.frames(dm)
+        dm.feed(self.stream[:len(self.pages[0]) + 100])
+        gap = len(self.pages[0]) + len(self.pages[1]) + len(self.pages[2]) + len(self.pages[3]) + len(self.pages[4])
+        dm.resync(5000) # (in the ring's offsets, which don't count what was spliced)
+        dm.feed(self.stream[gap:])
+        self.assertEqual([(offset, track) for offset, length, track, codec in found], [(0, True), (len(self.pages[0]), False),
+                                                                                      (5000, True), (5000 + len(self.pages[5]), False)])
+        self.assertEqual(dm.next_boundary(1, track=True), 5000)
+
+    def test_boundaries(self):
+        dm = demux.ogg_demux()
+        feed_in_chunks(dm, self.stream, 1000)
+        starts = [offset for offset, length in offsets(self.pages)]
+        track = starts[5]
+        self.assertEqual(dm.next_boundary(1), starts[1])
+        self.assertEqual(dm.next_boundary(1, track=True), track)
+        self.assertEqual(dm.latest_boundary(0), starts[-1])
+        self.assertEqual(dm.latest_boundary(0, track=True), track)
+        self.assertIsNone(dm.latest_boundary(track + 1, track=True))
+        self.assertIsNone(dm.next_boundary(starts[-1] + 1))
+        dm.prune(starts[3])
+        self.assertEqual(dm.next_boundary(0), starts[3])
+
+    def test_safe_offset(self):
+        dm = demux.ogg_demux()
+        dm.feed(self.stream[:len(self.pages[0]) + 10]) # partway through the second page's header
+        self.assertEqual(dm.safe_offset(), len(self.pages[0]))
+        dm.feed(self.stream[len(self.pages[0]) + 10:len(self.pages[0]) + 500]) # into its body
+        self.assertEqual(dm.safe_offset(), len(self.pages[0]) + 500)
+        dm = demux.ogg_demux()
+        dm.feed(b'xxxxOgg') # the sync pattern might be about to finish
+        self.assertEqual(dm.safe_offset(), 4)
+
+    def test_mp3_any_chunking(self):
+        stream = b'junk\xff' + MP3_FRAME * 5
+        for size in [1, 2, 3, 4, 5, 416, 417, 418, len(stream)]:
+            dm = demux.for_content_type("audio/mpeg")
+            found = self.frames(dm)
+            feed_in_chunks(dm, stream, size)
+            self.assertEqual([(offset, length) for offset, length, track, codec in found],
+                             [(5 + i * 417, 417) for i in range(5)], "chunks of %d" % size)
+
+    def test_content_types(self):
+        self.assertIsInstance(demux.for_content_type(None), demux.ogg_demux)
+        self.assertIsInstance(demux.for_content_type("audio/mp3"), demux.mp3_demux)
+        self.assertIsNone(demux.for_content_type("audio/flac"))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,57 @@
+# mpd-remote-streamer
+# Dylan Forbes
+# Computer Networks
+
+# the info display has to catch up with a change as soon as it's made, whether by our own
+# command or by another client, with no polling. these drive mpdrs's real REPL loop and watcher
+# against fake_server.py (see bench.display_rig). run with:
+#     python3 -m unittest test_display      (or pytest)
+
+
+import unittest, time
+import bench, log
+
+COUNT = 20
+
+class test_display(unittest.TestCase):
+    def setUp(self):
+        log.set_all(-1)
+        self.rig = bench.display_rig(queue=COUNT * 2 + 2)
+        self.assertIsNotNone(self.rig.wait_drawn(self.rig.command("play")))
+
+    def tearDown(self):
+        self.rig.close()
+
+    def title(self):
+        return self.rig.app.remote.status.song_title
+
+    def test_own_command(self):
+        for i in range(COUNT):
+            before = self.title()
+            start = self.rig.command("next")
+            drawn = self.rig.wait_drawn(start)
+            self.assertIsNotNone(drawn, "the display wasn't redrawn after next")
+            when, title = drawn
+            self.assertNotEqual(title, before)
+            self.assertLess(when - start, bench.DISPLAY_LATENCY_BOUND)
+        # our own commands refresh the status themselves, so the watcher doesn't draw it again
+        time.sleep(0.2)
+        self.assertEqual(self.rig.draws_since(start), 1)
+
+    def test_other_client(self):
+        other = bench.other_client(self.rig.app.remote.port)
+        try:
+            for i in range(COUNT):
+                before = self.title()
+                start = time.perf_counter()
+                other.command("next")
+                drawn = self.rig.wait_drawn(start)
+                self.assertIsNotNone(drawn, "the watcher didn't redraw after another client's next")
+                when, title = drawn
+                self.assertNotEqual(title, before)
+                self.assertLess(when - start, bench.DISPLAY_LATENCY_BOUND)
+        finally:
+            other.close()
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,85 @@
+# mpd-remote-streamer
+# Dylan Forbes
+# Computer Networks
+
+# bulk queue loading (enqueue.py and mpd_client.send_bulk), against fake_server.py: the songs mpd
+# hasn't got are found by the index in mpd's ACK, wherever they fall in a command list. run with:
+#     python3 -m unittest test_enqueue      (or pytest)
+
+
+import unittest
+import engine, enqueue, fake_server, log, mpd_client
+from mpd_client import BULK_LIST_LENGTH
+
+LIBRARY = 50
+
+class test_enqueue(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        log.set_all(-1)
+        cls.process, cls.port, http_port = fake_server.spawn(library=LIBRARY, queue=0)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.process.terminate()
+
+    def setUp(self):
+        self.client = engine.blocking(mpd_client.mpd_client("127.0.0.1", self.port))
+        self.client.connect_cmd_conn()
+        self.client.send_cmd("clear")
+
+    def tearDown(self):
+        self.client.quit()
+
+    # a list of `count` songs, with the ones at the indexes in `missing` not in the library
+    def song_list(self, count, missing):
+        lines = []
+        for i in range(count):
+            if i in missing:
+                lines.append("missing/song %d.ogg" % i)
+            else:
+                lines.append(fake_server.make_song(i % LIBRARY)["file"])
+        return lines
+
+    def queue(self):
+        code, response = self.client.send_cmd("playlistinfo")
+        return [value for key, value in response if key == "file"]
+
+    def check(self, count, missing):
+        lines = self.song_list(count, missing)
+        added, failures = enqueue.load(self.client, enqueue.commands_for(lines))
+        self.assertEqual(added, count - len(missing))
+        self.assertEqual([(lineno, line) for lineno, line, error in failures],
+                         [(i + 1, lines[i]) for i in sorted(missing)])
+        for lineno, line, error in failures:
+            self.assertEqual(error, "No such directory")
+        # everything else is queued, once each and in order
+        self.assertEqual(self.queue(), [line for i, line in enumerate(lines) if i not in missing])
+
+    def test_nothing_missing(self):
+        self.check(10, set())
+
+    def test_first_and_last(self):
+        self.check(10, {0, 9})
+
+    def test_all_missing(self):
+        self.check(5, set(range(5)))
+
+    def test_one_after_another(self):
+        self.check(10, {3, 4, 5})
+
+    def test_across_lists(self):
+        # either side of where one command list ends and the next starts, and the very end
+        n = BULK_LIST_LENGTH
+        self.check(2 * n + 10, {0, n - 1, n, n + 1, 2 * n - 1, 2 * n + 9})
+
+    def test_queries(self):
+        lines = ['findadd title "track 3"', 'findadd title "no such track"', "findadd title"]
+        added, failures = enqueue.load(self.client, enqueue.commands_for(lines))
+        # a query that finds nothing isn't an error, but one mpd can't make sense of is
+        self.assertEqual(added, 2)
+        self.assertEqual(failures, [(3, "findadd title", "incorrect arguments")])
+        self.assertEqual(self.queue(), [fake_server.make_song(3)["file"]])
+
+if __name__ == "__main__":
+    unittest.main()
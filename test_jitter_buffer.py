@@ -0,0 +1,87 @@
+# mpd-remote-streamer
+# Dylan Forbes
+# Computer Networks
+
+# the adaptive prebuffer (jitter_buffer.py), against bench.py's synthetic arrival traces. it
+# should start sooner than the old fixed 7000-byte buffer, and underrun less often on a link
+# that stalls. (it doesn't spend less time stalled: the target it refills to after an underrun
+# has grown.) run with:
+#     python3 -m unittest test_jitter_buffer      (or pytest)
+
+
+import unittest, os, tempfile
+import bench, http_client, jitter_buffer
+
+FIXED_BYTES = 7000
+SEEDS = range(1, 11)
+
+def adaptive():
+    return jitter_buffer.jitter_buffer(http_client.MIN_BUFFER_MS, http_client.MIN_BUFFER_MS, http_client.MAX_BUFFER_MS)
+
+def replay_adaptive(trace):
+    jitter = adaptive()
+    return bench.replay(trace, jitter.target_bytes, jitter.underrun, jitter.record_arrival)
+
+class test_jitter_buffer(unittest.TestCase):
+    def test_steady_links(self):
+        for jitter in [0.005, 0.3]:
+            for seed in SEEDS:
+                trace = bench.steady_trace(300, jitter, seed)
+                fixed_start, fixed_underruns, fixed_stalled = bench.replay(trace, lambda: FIXED_BYTES)
+                start, underruns, stalled = replay_adaptive(trace)
+                self.assertLess(start, fixed_start)
+                # it starts out below 300 ms of jitter, so it can take one underrun to learn it
+                self.assertLessEqual(underruns, 0 if jitter < 0.1 else 1)
+
+    def test_stalling_link(self):
+        fixed_total = 0
+        total = 0
+        for seed in SEEDS:
+            trace = bench.stalling_trace(300, seed)
+            fixed_start, fixed_underruns, fixed_stalled = bench.replay(trace, lambda: FIXED_BYTES)
+            start, underruns, stalled = replay_adaptive(trace)
+            self.assertLess(start, fixed_start)
+            self.assertLessEqual(underruns, fixed_underruns, "seed %d" % seed)
+            fixed_total += fixed_underruns
+            total += underruns
+        self.assertLess(total, fixed_total * 0.75)
+
+    def test_underrun_covers_the_gap(self):
+        jitter = adaptive()
+        jitter.underrun(10, 1.0)
+        self.assertGreaterEqual(jitter.target_ms, 1000 * jitter_buffer.GAP_FACTOR)
+        # a short gap still grows it
+        target = jitter.target_ms
+        jitter.underrun(11, 0.01)
+        self.assertEqual(jitter.target_ms, min(jitter.max_ms, target * jitter_buffer.GROW_FACTOR))
+        jitter.underrun(12, 1000)
+        self.assertEqual(jitter.target_ms, jitter.max_ms)
+
+    def test_shrinks_after_a_quiet_minute(self):
+        jitter = adaptive()
+        jitter.underrun(0, 1.0)
+        grown = jitter.target_ms
+        jitter.record_arrival(1000, 1)
+        jitter.record_arrival(1000, 1 + jitter_buffer.SHRINK_AFTER + 1)
+        self.assertAlmostEqual(jitter.target_ms, grown * jitter_buffer.SHRINK_FACTOR)
+
+    def test_trace(self):
+        fd, path = tempfile.mkstemp(suffix=".csv")
+        os.close(fd)
+        try:
+            jitter = adaptive()
+            jitter.record_trace(path)
+            arrivals = jitter_buffer.TRACE_FLUSH + 5
+            for i in range(arrivals):
+                jitter.record_arrival(1000, i / 16)
+            # a whole batch is written as soon as it's there, and the rest when the stream stops
+            self.assertEqual(len(bench.load_trace(path)), jitter_buffer.TRACE_FLUSH)
+            jitter.reset_arrivals()
+            trace = bench.load_trace(path)
+            self.assertEqual(len(trace), arrivals)
+            self.assertEqual(trace[-1], ((arrivals - 1) / 16, 1000))
+        finally:
+            os.unlink(path)
+
+if __name__ == "__main__":
+    unittest.main()
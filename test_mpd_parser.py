@@ -0,0 +1,92 @@
+# mpd-remote-streamer
+# Dylan Forbes
+# Computer Networks
+
+# the incremental response parser and record grouping (mpd_parser.py). run with:
+#     python3 -m unittest test_mpd_parser      (or pytest)
+
+
+import unittest
+import mpd_parser
+
+# a response with a bit of everything: a multi-byte character, and a binary payload that has
+# a newline and something that looks like the end of the response in it
+PICTURE = b'\x89PNG\nOK\nACK [5@0] \xff'
+RESPONSE = (b'file: a.ogg\nArtist: Bj\xc3\xb6rk\nGenre: rock\nGenre: live\n'
+            b'size: %d\ntype: image/png\nbinary: %d\n' % (len(PICTURE), len(PICTURE)) + PICTURE + b'\nOK\n')
+EXPECTED = [("file", "a.ogg"), ("Artist", "Björk"), ("Genre", "rock"), ("Genre", "live"),
+            ("size", str(len(PICTURE))), ("type", "image/png"), ("binary", PICTURE)]
+
+# reads from `data`, `size` bytes at a time
+def reader(data, size):
+    chunks = [data[i:i + size] for i in range(0, len(data), size)]
+    return lambda: chunks.pop(0) if chunks else b''
+
+class test_mpd_parser(unittest.TestCase):
+    def test_any_chunking(self):
+        for size in range(1, len(RESPONSE) + 1):
+            parser = mpd_parser.response_parser()
+            self.assertEqual(list(mpd_parser.pairs(parser, reader(RESPONSE, size))), EXPECTED, "chunks of %d" % size)
+            self.assertEqual(parser.code, "OK")
+
+    def test_nothing_taken_until_a_pair_is_complete(self):
+        parser = mpd_parser.response_parser()
+        parser.feed(b'binary: 4\nab')
+        self.assertIsNone(parser.next_pair())
+        parser.feed(b'cd') # (the newline after the payload isn't here yet)
+        self.assertIsNone(parser.next_pair())
+        parser.feed(b'\nOK\n')
+        self.assertEqual(parser.next_pair(), ("binary", b'abcd'))
+        self.assertIs(parser.next_pair(), mpd_parser.END)
+
+    def test_ack(self):
+        parser = mpd_parser.response_parser()
+        read = reader(b'volume: 50\nACK [50@3] {add} No such directory\n', 7)
+        self.assertEqual(list(mpd_parser.pairs(parser, read)), [("volume", "50")])
+        self.assertEqual(parser.code, "ACK [50@3] {add} No such directory")
+
+    def test_lost_connection(self):
+        parser = mpd_parser.response_parser()
+        self.assertEqual(list(mpd_parser.pairs(parser, reader(b'state: play\nsongid: ', 5))), [("state", "play")])
+        self.assertIsNone(parser.code)
+
+    def test_responses_back_to_back(self):
+        # a command list's responses, all in one read: each one ends at its own list_OK
+        parser = mpd_parser.response_parser()
+        read = reader(b'state: stop\nlist_OK\nvolume: 10\nlist_OK\nOK\n', 1000)
+        self.assertEqual(list(mpd_parser.pairs(parser, read)), [("state", "stop")])
+        self.assertEqual(parser.code, "list_OK")
+        self.assertEqual(list(mpd_parser.pairs(parser, read)), [("volume", "10")])
+        self.assertEqual(list(mpd_parser.pairs(parser, read)), [])
+        self.assertEqual(parser.code, "OK")
+
+    def test_reset(self):
+        parser = mpd_parser.response_parser()
+        parser.feed(b'half a li')
+        parser.reset()
+        parser.feed(b'OK MPD 0.23.5\n')
+        self.assertEqual(parser.readline(), b'OK MPD 0.23.5')
+        self.assertIsNone(parser.readline())
+
+    def test_records(self):
+        pairs = [("directory", "music"), ("Last-Modified", "x"),
+                 ("file", "music/a.ogg"), ("Artist", "one"), ("Artist", "two"), ("Title", "a"),
+                 ("file", "music/b.ogg"), ("Title", "b"), ("Title", "b again"),
+                 ("playlist", "mix")]
+        records = list(mpd_parser.records(pairs, multiple=("Artist",)))
+        self.assertEqual(records, [{"directory": "music", "Last-Modified": "x"},
+                                   {"file": "music/a.ogg", "Artist": ["one", "two"], "Title": "a"},
+                                   {"file": "music/b.ogg", "Title": "b again"},
+                                   {"playlist": "mix"}])
+
+    def test_records_across_batches(self):
+        pairs = [("volume", "5"), ("file", "a"), ("Genre", "rock"), ("Genre", "live"), ("file", "b"), ("Genre", "pop")]
+        for split in range(len(pairs) + 1):
+            grouper = mpd_parser.record_grouper(multiple=("Genre",))
+            records = list(grouper.feed(pairs[:split])) + list(grouper.feed(pairs[split:])) + list(grouper.finish())
+            # (pairs before the first entry aren't part of any)
+            self.assertEqual(records, [{"file": "a", "Genre": ["rock", "live"]}, {"file": "b", "Genre": ["pop"]}], "split at %d" % split)
+        self.assertEqual(list(mpd_parser.records([])), [])
+
+if __name__ == "__main__":
+    unittest.main()
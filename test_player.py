@@ -0,0 +1,105 @@
+# mpd-remote-streamer
+# Dylan Forbes
+# Computer Networks
+
+# player.py's json ipc, against a stand-in for mpv's socket on the event loop. run with:
+#     python3 -m unittest test_player      (or pytest)
+
+
+import unittest, asyncio, json, os, shutil, tempfile
+import engine, log, player
+
+# mpv, as far as its ipc socket goes: it answers "slow" after the next command's answer (so
+# replies arrive out of order), never answers "ignore", and sends a property-change event
+# for every set_property
+class fake_mpv():
+    def __init__(self, path):
+        self.path = path
+        self.writers = []
+        self.received = []
+
+    async def start(self):
+        self.server = await asyncio.start_unix_server(self.serve, self.path)
+
+    async def serve(self, reader, writer):
+        self.writers.append(writer)
+        held = None
+        while True:
+            line = await reader.readline()
+            if not line:
+                break
+            msg = json.loads(line)
+            self.received.append(msg["command"])
+            name = msg["command"][0]
+            reply = json.dumps({"request_id": msg["request_id"], "error": "success", "data": name}) + "\n"
+            if name == "ignore":
+                continue
+            if name == "slow":
+                held = reply
+                continue
+            writer.write(reply.encode("UTF-8"))
+            if held != None:
+                writer.write(held.encode("UTF-8"))
+                held = None
+            if name == "set_property":
+                event = {"event": "property-change", "name": msg["command"][1], "data": msg["command"][2]}
+                writer.write((json.dumps(event) + "\n").encode("UTF-8"))
+            await writer.drain()
+
+    async def close(self):
+        for writer in self.writers:
+            writer.close()
+        self.server.close()
+        await self.server.wait_closed()
+
+class test_player(unittest.TestCase):
+    def setUp(self):
+        log.set_all(-1)
+        self.engine = engine.get()
+        self.dir = tempfile.mkdtemp()
+        path = os.path.join(self.dir, "mpv.sock")
+        self.mpv = fake_mpv(path)
+        self.engine.call(self.mpv.start)
+        self.player = player.player(["mpv"], path)
+        self.engine.call(self.player.connect_ipc)
+        self.player.mpv_running = True
+
+    def tearDown(self):
+        self.engine.call(self.player.close_ipc)
+        self.engine.call(self.mpv.close)
+        shutil.rmtree(self.dir)
+
+    def test_replies_are_matched_by_request_id(self):
+        async def both():
+            slow = asyncio.get_running_loop().create_task(self.player.send_cmd(["slow"], wait=1))
+            await asyncio.sleep(0.01)
+            fast = await self.player.send_cmd(["fast"], wait=1)
+            return await slow, fast
+        slow, fast = self.engine.call(both)
+        self.assertEqual(slow["data"], "slow")
+        self.assertEqual(fast["data"], "fast")
+        self.assertEqual(self.player.pending, {})
+
+    def test_no_reply(self):
+        self.assertIsNone(self.engine.call(self.player.send_cmd, ["ignore"], 0.05))
+        self.assertEqual(self.player.pending, {})
+        # (and nothing's left waiting for it that would get in the way of the next one)
+        self.assertEqual(self.engine.call(self.player.send_cmd, ["fast"], 1)["data"], "fast")
+
+    def test_property_changes(self):
+        seen = []
+        self.player.on_property_change("paused-for-cache", seen.append)
+        self.engine.call(self.player.send_cmd, ["set_property", "paused-for-cache", True], 1)
+        self.assertEqual(seen, [True])
+        self.assertEqual(self.player.properties["paused-for-cache"], True)
+
+    def test_mpv_going_away(self):
+        self.engine.call(self.mpv.close)
+        async def wait_for_reader():
+            await self.player.reader
+        self.engine.call(asyncio.wait_for, wait_for_reader(), 1)
+        self.assertFalse(self.player.mpv_running)
+        self.assertIsNone(self.engine.call(self.player.send_cmd, ["fast"], 0.05))
+
+if __name__ == "__main__":
+    unittest.main()
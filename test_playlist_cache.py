@@ -0,0 +1,119 @@
+# mpd-remote-streamer
+# Dylan Forbes
+# Computer Networks
+
+# the local queue cache (playlist_cache.py), kept in sync the way mpd_client does it: apply
+# plchangesposid's answer, then fetch only the songs it hasn't got. run with:
+#     python3 -m unittest test_playlist_cache      (or pytest)
+
+
+import unittest, random
+from playlist_cache import playlist_cache, FULL_FETCH_FRACTION
+
+def song(songid, pos):
+    return {"file": "song %s.ogg" % songid, "Title": "song " + songid, "Id": songid, "Pos": str(pos)}
+
+# what plchangesposid answers: the position and id of every entry that's different now
+def changes(old, new):
+    pairs = []
+    for pos, songid in enumerate(new):
+        if pos >= len(old) or old[pos] != songid:
+            pairs += [("cpos", str(pos)), ("Id", songid)]
+    return pairs
+
+class test_playlist_cache(unittest.TestCase):
+    def setUp(self):
+        self.fetched = [] # the ids we had to fetch the tags of
+
+    def cached(self, ids):
+        cache = playlist_cache()
+        cache.replace([song(songid, pos) for pos, songid in enumerate(ids)], 1)
+        return cache
+
+    # sync `cache` from `old` to `new`. returns whether it could do it without a full fetch
+    def sync(self, cache, old, new):
+        missing = cache.apply_changes(changes(old, new), cache.version + 1, len(new))
+        if missing == None:
+            return False
+        self.fetched += missing
+        cache.add_songs([song(songid, new.index(songid)) for songid in missing])
+        return True
+
+    def check(self, cache, ids):
+        self.assertEqual([entry["Id"] for entry in cache.entries], ids)
+        self.assertEqual([entry["Pos"] for entry in cache.entries], [str(pos) for pos in range(len(ids))])
+        for songid in ids:
+            self.assertEqual(cache.song(songid)["Title"], "song " + songid)
+
+    def test_delete(self):
+        old = ["1", "2", "3", "4"]
+        cache = self.cached(old)
+        new = ["1", "3", "4"]
+        self.assertTrue(self.sync(cache, old, new))
+        self.check(cache, new)
+        self.assertEqual(self.fetched, [])
+        self.assertIsNone(cache.song("2"))
+
+    def test_move_needs_no_fetch(self):
+        old = ["1", "2", "3", "4"]
+        cache = self.cached(old)
+        new = ["4", "1", "2", "3"]
+        self.assertTrue(self.sync(cache, old, new))
+        self.check(cache, new)
+        self.assertEqual(self.fetched, [])
+        self.assertEqual(cache.version, 2)
+
+    def test_add_fetches_only_new_songs(self):
+        old = ["1", "2", "3", "4"]
+        cache = self.cached(old)
+        new = ["1", "5", "2", "3", "4"]
+        self.assertTrue(self.sync(cache, old, new))
+        self.check(cache, new)
+        self.assertEqual(self.fetched, ["5"])
+
+    def test_mostly_new_means_a_full_fetch(self):
+        old = ["1", "2"]
+        cache = self.cached(old)
+        new = ["1", "2", "3", "4", "5"]
+        self.assertGreater(3, FULL_FETCH_FRACTION * len(new))
+        self.assertFalse(self.sync(cache, old, new))
+        # (and it's left for the caller to replace)
+        self.assertEqual(cache.version, 1)
+        self.assertEqual([entry["Id"] for entry in cache.entries], old)
+
+    def test_clear(self):
+        cache = self.cached(["1", "2"])
+        self.assertEqual(cache.apply_changes([], 2, 0), [])
+        self.assertEqual(cache.entries, [])
+        self.assertIsNone(cache.song("1"))
+
+    def test_never_synced(self):
+        cache = playlist_cache()
+        self.assertIsNone(cache.changes_cmd())
+        cache.replace([], 7)
+        self.assertEqual(cache.changes_cmd(), "plchangesposid 7")
+
+    # random deletes, moves and adds, synced after each handful
+    def test_random_edits(self):
+        rng = random.Random(1)
+        ids = [str(i) for i in range(50)]
+        cache = self.cached(ids)
+        next_id = 50
+        for round in range(200):
+            new = list(ids)
+            for i in range(rng.randint(1, 4)):
+                op = rng.random()
+                if op < 0.3 and new:
+                    del new[rng.randrange(len(new))]
+                elif op < 0.6 and new:
+                    new.insert(rng.randrange(len(new) + 1), new.pop(rng.randrange(len(new))))
+                else:
+                    new.insert(rng.randrange(len(new) + 1), str(next_id))
+                    next_id += 1
+            if not self.sync(cache, ids, new):
+                cache.replace([song(songid, pos) for pos, songid in enumerate(new)], cache.version + 1)
+            ids = new
+            self.check(cache, ids)
+
+if __name__ == "__main__":
+    unittest.main()
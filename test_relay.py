@@ -0,0 +1,86 @@
+# mpd-remote-streamer
+# Dylan Forbes
+# Computer Networks
+
+# what the relay drops from a listener's queue when it falls behind (relay.relay_client). run with:
+#     python3 -m unittest test_relay      (or pytest)
+
+
+import unittest
+import relay
+from relay import DATA, HEADER, TRACK_START, RESPONSE
+
+PAGE = 4096
+
+def page(name):
+    return name.encode("ascii").ljust(PAGE, b'.')
+
+class test_relay(unittest.TestCase):
+    def setUp(self):
+        self.client = relay.relay_client(None, None)
+
+    def queue(self, name, kind=DATA):
+        return self.client.queue(page(name), kind)
+
+    def names(self):
+        return [bytes(p[:p.index(b'.')]).decode("ascii") for p, kind in self.client.pages]
+
+    # fill the queue to its limit with data pages
+    def fill(self):
+        i = 0
+        while self.client.queued + PAGE <= relay.CLIENT_QUEUE_BYTES:
+            self.assertEqual(self.queue("d%d" % i), 0)
+            i += 1
+        return i
+
+    def test_drops_the_oldest_data_first(self):
+        self.queue("response", RESPONSE)
+        self.queue("bos", TRACK_START)
+        self.queue("header", HEADER)
+        count = self.fill()
+        self.assertEqual(self.queue("new"), PAGE)
+        # the response and codec headers stay, and so does the order of the rest
+        names = self.names()
+        self.assertEqual(names[:3], ["response", "bos", "header"])
+        self.assertEqual(names[3:], ["d%d" % i for i in range(1, count)] + ["new"])
+        self.assertLessEqual(self.client.queued, relay.CLIENT_QUEUE_BYTES)
+        self.assertEqual(self.client.queued, sum(len(p) for p, kind in self.client.pages))
+
+    def test_never_drops_the_page_being_sent(self):
+        self.fill()
+        self.client.sent = 100 # (partway through d0)
+        self.assertEqual(self.queue("new"), PAGE)
+        self.assertEqual(self.names()[:2], ["d0", "d2"])
+
+    def test_never_drops_the_newest(self):
+        big = b'x' * (relay.CLIENT_QUEUE_BYTES + 1)
+        self.assertEqual(self.client.queue(big), 0)
+        self.assertEqual(len(self.client.pages), 1)
+        # the next one pushes the oversized page out, but not itself
+        self.assertEqual(self.queue("new"), len(big))
+        self.assertEqual(self.names(), ["new"])
+
+    def test_old_headers_go_once_a_new_track_has_started(self):
+        self.queue("bos1", TRACK_START)
+        self.queue("header1", HEADER)
+        self.queue("data1")
+        self.queue("bos2", TRACK_START)
+        self.queue("header2", HEADER)
+        self.fill()
+        # with a newer track queued, the first track's headers are just the oldest pages
+        for name in ["bos1", "header1", "data1"]:
+            self.assertEqual(self.names()[0], name)
+            self.assertEqual(self.queue("new"), PAGE)
+        # but the second track's stay
+        self.assertEqual(self.names()[:3], ["bos2", "header2", "d0"])
+        self.queue("new")
+        self.assertEqual(self.names()[:3], ["bos2", "header2", "d1"])
+
+    def test_only_headers_left(self):
+        # nothing can be dropped, so the queue goes over its limit rather than break the stream
+        for i in range(relay.CLIENT_QUEUE_BYTES // PAGE + 4):
+            self.assertEqual(self.queue("h%d" % i, HEADER), 0)
+        self.assertGreater(self.client.queued, relay.CLIENT_QUEUE_BYTES)
+
+if __name__ == "__main__":
+    unittest.main()
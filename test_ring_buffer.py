@@ -0,0 +1,121 @@
+# mpd-remote-streamer
+# Dylan Forbes
+# Computer Networks
+
+# the streamer's ring buffer (ring_buffer.py). run with:
+#     python3 -m unittest test_ring_buffer      (or pytest)
+
+
+import unittest, socket, random
+from ring_buffer import ring_buffer
+
+# everything that's unread, in order, going round the end if it has to
+def unread(ring):
+    data = b''
+    while len(data) < len(ring):
+        start = (ring.start + len(data)) % ring.capacity
+        data += bytes(ring.view[start:min(start + len(ring) - len(data), ring.capacity)])
+    return data
+
+class test_ring_buffer(unittest.TestCase):
+    def test_wraps_around(self):
+        ring = ring_buffer(10)
+        ring.feed(b'abcdefgh')
+        ring.consume(6)
+        ring.feed(b'ijklmn') # 2 bytes at the end, then 4 at the start
+        self.assertEqual(unread(ring), b'ghijklmn')
+        # the data comes out in two pieces, the end first
+        self.assertEqual(bytes(ring.data_region()), b'ghij')
+        ring.consume(4)
+        self.assertEqual(bytes(ring.data_region()), b'klmn')
+        self.assertEqual((ring.read_total, ring.write_total), (10, 14))
+
+    def test_full(self):
+        ring = ring_buffer(8)
+        ring.feed(b'12345678')
+        self.assertEqual(ring.free(), 0)
+        self.assertEqual(len(ring.free_region()), 0)
+        self.assertRaises(BufferError, ring.feed, b'9')
+        a, b = socket.socketpair()
+        try:
+            b.sendall(b'more')
+            # a full ring doesn't read from the socket at all
+            self.assertIsNone(ring.recv_into(a))
+            ring.consume(3)
+            self.assertEqual(ring.recv_into(a), 3)
+            self.assertEqual(unread(ring), b'45678mor')
+        finally:
+            a.close()
+            b.close()
+
+    def test_empty_ring_starts_at_the_beginning(self):
+        ring = ring_buffer(8)
+        ring.feed(b'12345')
+        ring.consume(5)
+        # emptying it moves back to the start, so the next read can fill the whole thing at once
+        self.assertEqual(len(ring.free_region()), 8)
+
+    def test_closed_socket(self):
+        ring = ring_buffer(8)
+        a, b = socket.socketpair()
+        b.close()
+        try:
+            self.assertEqual(ring.recv_into(a), 0)
+            self.assertEqual(ring.write_total, 0)
+        finally:
+            a.close()
+
+    def test_offsets(self):
+        ring = ring_buffer(16)
+        ring.feed(b'0123456789')
+        ring.drop_to(4)
+        self.assertEqual(unread(ring), b'456789')
+        ring.drop_to(2) # already gone
+        self.assertEqual(ring.read_total, 4)
+        ring.drop_to(100) # (only as far as what's arrived)
+        self.assertEqual((len(ring), ring.read_total), (0, 10))
+        ring.feed(b'abc')
+        ring.clear()
+        self.assertEqual((len(ring), ring.read_total, ring.write_total), (0, 13, 13))
+        self.assertEqual(ring.high_water, 10)
+
+    def test_on_receive_sees_every_chunk(self):
+        ring = ring_buffer(10)
+        seen = []
+        ring.on_receive = lambda view: seen.append(bytes(view))
+        ring.feed(b'abcdefgh')
+        ring.consume(8)
+        ring.feed(b'ijklmnopqr')
+        a, b = socket.socketpair()
+        try:
+            ring.consume(3)
+            b.sendall(b'st')
+            ring.recv_into(a)
+        finally:
+            a.close()
+            b.close()
+        self.assertEqual(b''.join(seen), b'abcdefghijklmnopqrst')
+
+    # random feeds and consumes, against a plain bytes object doing the same
+    def test_against_a_model(self):
+        rng = random.Random(1)
+        ring = ring_buffer(64)
+        model = b''
+        written = 0
+        for i in range(5000):
+            if rng.random() < 0.5:
+                n = rng.randint(0, ring.free())
+                data = bytes((written + j) % 251 for j in range(n))
+                ring.feed(data)
+                model += data
+                written += n
+            else:
+                n = rng.randint(0, len(ring.data_region()))
+                self.assertEqual(bytes(ring.data_region()[:n]), model[:n])
+                ring.consume(n)
+                model = model[n:]
+            self.assertEqual(unread(ring), model)
+            self.assertEqual(ring.write_total - ring.read_total, len(model))
+
+if __name__ == "__main__":
+    unittest.main()